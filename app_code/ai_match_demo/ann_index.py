@@ -0,0 +1,221 @@
+''' approximate nearest neighbour index over trial cohort embeddings, for
+catalogues far larger than the DFCI trial list (e.g. all ClinicalTrials.gov
+oncology trials from notebook 2). An inverted file (IVF) index in numpy:
+cohorts are bucketed by their nearest k-means centroid and a query only
+scores the `nprobe` closest buckets.
+
+    python ann_index.py --benchmark --cohorts 200000 --dim 256
+'''
+# system
+import os
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+
+# app
+import catalog
+import ranking
+import local_similarity
+
+# parameters
+ANN_INDEX = os.getenv('ANN_INDEX', os.path.join(catalog.DATA_DIR, 'trial_cohort_ivf.npz'))
+ANN_NLIST = int(os.getenv('ANN_NLIST', 0))
+ANN_NPROBE = int(os.getenv('ANN_NPROBE', 16))
+ANN_CANDIDATES = int(os.getenv('ANN_CANDIDATES', 200))
+
+logger = logging.getLogger(__name__)
+
+# process wide state
+_index = None
+
+
+def kmeans(x, k, iters=10, sample=50000, seed=0):
+    ''' spherical k-means centroids of the unit rows of x '''
+    rng = np.random.default_rng(seed)
+    if x.shape[0] > sample:
+        x = x[rng.choice(x.shape[0], sample, replace=False)]
+    centroids = x[rng.choice(x.shape[0], k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        for c in range(k):
+            members = x[assign == c]
+            if members.shape[0] > 0:
+                centroids[c] = members.sum(axis=0)
+        centroids = local_similarity.normalize(centroids)
+    return centroids
+
+
+class IVFIndex:
+    ''' cosine similarity IVF index. Vectors are kept in one float32 matrix
+    ordered by list so each probe is a contiguous slice; additions go to a
+    small unordered tail and removals are tombstones, both folded back in
+    by compact(). '''
+
+    def __init__(self, centroids, embeddings, nct_ids, list_starts):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.nct_ids = np.asarray(nct_ids, dtype=object)
+        self.list_starts = np.asarray(list_starts, dtype=np.int64)
+        self.alive = np.ones(self.embeddings.shape[0], dtype=bool)
+
+        # incremental additions, scanned exhaustively until compact()
+        self.tail_embeddings = np.zeros((0, self.centroids.shape[1]), dtype=np.float32)
+        self.tail_nct_ids = np.zeros(0, dtype=object)
+
+    @classmethod
+    def build(cls, embeddings, nct_ids, nlist=ANN_NLIST):
+        ''' trains centroids and buckets every cohort embedding '''
+        embeddings = local_similarity.normalize(embeddings)
+        nct_ids = np.asarray(nct_ids, dtype=object)
+        if not nlist:
+            nlist = max(1, int(np.sqrt(embeddings.shape[0])))
+        centroids = kmeans(embeddings, min(nlist, embeddings.shape[0]))
+
+        # sort vectors by list
+        assign = np.argmax(embeddings @ centroids.T, axis=1)
+        order = np.argsort(assign, kind='stable')
+        list_starts = np.searchsorted(assign[order], np.arange(centroids.shape[0] + 1))
+        return cls(centroids, embeddings[order], nct_ids[order], list_starts)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            index = cls(data['centroids'], data['embeddings'], data['nct_ids'], data['list_starts'])
+            index.alive = data['alive']
+            index.tail_embeddings = data['tail_embeddings']
+            index.tail_nct_ids = data['tail_nct_ids'].astype(object)
+        return index
+
+    def save(self, path):
+        ''' ids are written as fixed width strings, so loading needs no pickle '''
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, centroids=self.centroids, embeddings=self.embeddings, nct_ids=self.nct_ids.astype(str), \
+            list_starts=self.list_starts, alive=self.alive, tail_embeddings=self.tail_embeddings, \
+            tail_nct_ids=self.tail_nct_ids.astype(str))
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return int(self.alive.sum()) + self.tail_embeddings.shape[0]
+
+    def add(self, embeddings, nct_ids):
+        ''' adds cohort embeddings, e.g. for newly registered trials '''
+        self.tail_embeddings = np.vstack([self.tail_embeddings, local_similarity.normalize(embeddings)])
+        self.tail_nct_ids = np.concatenate([self.tail_nct_ids, np.asarray(nct_ids, dtype=object)])
+
+    def remove(self, nct_ids):
+        ''' drops every cohort of the given trials '''
+        nct_ids = np.asarray(list(nct_ids), dtype=object)
+        self.alive &= ~np.isin(self.nct_ids, nct_ids)
+        keep = ~np.isin(self.tail_nct_ids, nct_ids)
+        self.tail_embeddings = self.tail_embeddings[keep]
+        self.tail_nct_ids = self.tail_nct_ids[keep]
+
+    def compact(self):
+        ''' folds additions and removals back into the lists, keeping the
+        trained centroids '''
+        embeddings = np.vstack([self.embeddings[self.alive], self.tail_embeddings])
+        nct_ids = np.concatenate([self.nct_ids[self.alive], self.tail_nct_ids])
+        assign = np.argmax(embeddings @ self.centroids.T, axis=1)
+        order = np.argsort(assign, kind='stable')
+        list_starts = np.searchsorted(assign[order], np.arange(self.centroids.shape[0] + 1))
+        self.__init__(self.centroids, embeddings[order], nct_ids[order], list_starts)
+
+    def _candidates(self, query, nprobe):
+        ''' cohort scores and trial ids from the nprobe nearest lists and
+        the tail '''
+        probes = ranking.top_k(self.centroids @ query, nprobe)
+        rows = np.concatenate([np.arange(self.list_starts[x], self.list_starts[x + 1]) for x in probes])
+        rows = rows[self.alive[rows]]
+        scores = np.concatenate([self.embeddings[rows] @ query, self.tail_embeddings @ query])
+        nct_ids = np.concatenate([self.nct_ids[rows], self.tail_nct_ids])
+        return scores, nct_ids
+
+    def search(self, query, k=10, minimum_similarity=-1.0, nprobe=ANN_NPROBE, trial_ids=None):
+        ''' top k trials by max cohort similarity >= minimum_similarity, as
+        a series of scores indexed by nct_id, best first. With trial_ids
+        only those trials are considered, before the top k are taken. '''
+        query = local_similarity.normalize(query).reshape(-1)
+        scores, nct_ids = self._candidates(query, nprobe)
+        if trial_ids is not None:
+            keep = pd.Index(nct_ids).isin(trial_ids)
+            scores, nct_ids = scores[keep], nct_ids[keep]
+        return _top_trials(scores, nct_ids, k, minimum_similarity)
+
+    def search_exact(self, query, k=10, minimum_similarity=-1.0, trial_ids=None):
+        ''' brute force reference for search '''
+        return self.search(query, k, minimum_similarity, nprobe=self.centroids.shape[0], trial_ids=trial_ids)
+
+
+def _top_trials(scores, nct_ids, k, minimum_similarity):
+    keep = scores >= minimum_similarity
+    scores, nct_ids = scores[keep], nct_ids[keep]
+
+    # best cohort per trial, then the top k trials
+    order = np.argsort(-scores, kind='stable')
+    _, first = np.unique(nct_ids[order], return_index=True)
+    best = order[first]
+    best = best[ranking.top_k(scores[best], k)]
+    return pd.Series(scores[best], index=nct_ids[best], dtype='float32')
+
+
+def get_index():
+    ''' returns the process wide index loaded from ANN_INDEX '''
+    global _index
+    if _index is None:
+        _index = IVFIndex.load(ANN_INDEX)
+    return _index
+
+
+def benchmark(n_cohorts=100000, dim=256, n_queries=200, k=10, nprobe=ANN_NPROBE, cohorts_per_trial=4, seed=0):
+    ''' recall@k and latency of search against search_exact on clustered
+    synthetic embeddings '''
+    rng = np.random.default_rng(seed)
+    centers = local_similarity.normalize(rng.standard_normal((256, dim)))
+    embeddings = centers[rng.integers(0, 256, n_cohorts)] + 0.5 * rng.standard_normal((n_cohorts, dim)) / np.sqrt(dim)
+    nct_ids = np.array([f'NCT{x // cohorts_per_trial:08d}' for x in range(n_cohorts)], dtype=object)
+    queries = centers[rng.integers(0, 256, n_queries)] + 0.5 * rng.standard_normal((n_queries, dim)) / np.sqrt(dim)
+
+    tick = time.perf_counter()
+    index = IVFIndex.build(embeddings, nct_ids)
+    build_secs = time.perf_counter() - tick
+
+    recalls, approx_ms, exact_ms = [], [], []
+    for query in queries:
+        tick = time.perf_counter()
+        approx = index.search(query, k, nprobe=nprobe)
+        approx_ms.append((time.perf_counter() - tick) * 1000)
+        tick = time.perf_counter()
+        exact = index.search_exact(query, k)
+        exact_ms.append((time.perf_counter() - tick) * 1000)
+        recalls.append(len(set(approx.index) & set(exact.index)) / max(1, len(exact)))
+
+    return {'cohorts': n_cohorts, 'lists': index.centroids.shape[0], 'nprobe': nprobe, 'build_s': build_secs, \
+        f'recall@{k}': float(np.mean(recalls)), 'p50_ms': float(np.percentile(approx_ms, 50)), \
+        'p99_ms': float(np.percentile(approx_ms, 99)), 'exact_p50_ms': float(np.percentile(exact_ms, 50))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--benchmark', action='store_true', help='report recall@k and latency vs exact search')
+    parser.add_argument('--cohorts', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--nprobe', type=int, default=ANN_NPROBE)
+    parser.add_argument('--build', action='store_true', help='build ANN_INDEX from the cohort embeddings')
+    args = parser.parse_args()
+
+    if args.build:
+        embeddings = np.load(local_similarity.COHORT_EMBEDDINGS, mmap_mode='r')
+        nct_ids = np.load(local_similarity.COHORT_NCT_IDS)
+        index = IVFIndex.build(embeddings, nct_ids)
+        index.save(ANN_INDEX)
+        print(f"indexed {len(index)} cohorts in {index.centroids.shape[0]} lists to {ANN_INDEX}")
+
+    if args.benchmark:
+        for key, value in benchmark(args.cohorts, args.dim, nprobe=args.nprobe).items():
+            print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -12,10 +12,22 @@ from bokeh.themes import Theme
 from data_store import DataStore
 from views import HomeView, TrialSimilarityView, SidebarView
 import common
+import metrics
+import catalog
+import warmup
 
 # simplify.
 CD = pathlib.Path(__file__).parent.resolve()
 
+# prometheus endpoint next to the panel server, started once per process
+metrics.start_server()
+
+# new artifacts in the bucket are picked up by new sessions, see catalog.refresh
+catalog.start_refresh()
+
+# demo patients are matched ahead of the first visitors, see warmup.py
+warmup.start()
+
 # global styling
 pn.extension('tabulator')
 ##00629B
@@ -0,0 +1,190 @@
+''' versioned sync of the data artifacts (trials, demo patients, similarity)
+from GCS. The generation and MD5 of each blob are compared with a local
+manifest; changed blobs are downloaded in parallel to temporary files,
+checked against their MD5 and renamed into place, so readers never see a
+partial file. ARTIFACT_SOURCE may also be a local folder standing in for
+the bucket, e.g. for offline work and tests, or `none` to use the files in
+the data folder as they are.
+
+    python artifacts.py --source /tmp/fake_gcs [--sync]
+'''
+# system
+import os
+import json
+import base64
+import shutil
+import hashlib
+import logging
+import argparse
+import concurrent.futures
+from dotenv import load_dotenv
+
+# app
+import common
+import metrics
+
+# parameters
+load_dotenv()
+GCP_CLOUD_FOLDER = os.getenv('GCP_CLOUD_FOLDER')
+ARTIFACT_SOURCE = os.getenv('ARTIFACT_SOURCE') or f'gs://{GCP_CLOUD_FOLDER}'
+ARTIFACT_WORKERS = int(os.getenv('ARTIFACT_WORKERS', 4))
+MANIFEST_NAME = 'artifacts.json'
+
+logger = logging.getLogger(__name__)
+
+
+def md5_base64(path):
+    ''' MD5 of a file, base64 encoded as GCS reports it '''
+    h = hashlib.md5()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(2**20), b''):
+            h.update(block)
+    return base64.b64encode(h.digest()).decode('ascii')
+
+
+class GcsBucket:
+    ''' the artifact bucket '''
+
+    def __init__(self, bucket_name):
+        self.bucket = common.get_storage_client().bucket(bucket_name)
+
+    def stat(self, name):
+        ''' {'generation', 'md5'} of a blob, None when missing '''
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
+        return {'generation': str(blob.generation), 'md5': blob.md5_hash}
+
+    def download(self, name, path, generation):
+        # pin the generation so an upload in between cannot mix versions
+        self.bucket.blob(name, generation=int(generation)).download_to_filename(path)
+
+
+class LocalBucket:
+    ''' a folder standing in for the bucket; the generation is the file's
+    mtime, as GCS bumps it on every upload '''
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"no artifact folder {directory}")
+        self.directory = directory
+
+    def stat(self, name):
+        path = os.path.join(self.directory, name)
+        if not os.path.isfile(path):
+            return None
+        return {'generation': str(os.stat(path).st_mtime_ns), 'md5': md5_base64(path)}
+
+    def download(self, name, path, generation):
+        shutil.copyfile(os.path.join(self.directory, name), path)
+
+
+def open_bucket(source=ARTIFACT_SOURCE):
+    if source.startswith('gs://'):
+        return GcsBucket(source[len('gs://'):])
+    return LocalBucket(source)
+
+
+def load_manifest(path):
+    try:
+        with open(path) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _save_manifest(path, manifest):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as fout:
+        json.dump(manifest, fout, indent=1)
+    os.replace(tmp_path, path)
+
+
+def is_current(entry, stat, local_path):
+    ''' the local file is the blob's current version '''
+    return entry is not None and stat is not None and os.path.isfile(local_path) \
+        and entry.get('generation') == stat['generation'] and entry.get('md5') == stat['md5']
+
+
+def _download(bucket, name, local_path, stat):
+    ''' fetches one blob beside its destination, verifies it and renames it
+    into place '''
+    tmp_path = f'{local_path}.{os.getpid()}.{stat["generation"]}.tmp'
+    try:
+        with metrics.span('gcs_sync', file=name, cache='miss'):
+            bucket.download(name, tmp_path, stat['generation'])
+            if stat['md5'] and md5_base64(tmp_path) != stat['md5']:
+                raise IOError(f"{name} generation {stat['generation']} failed its md5 check")
+            os.replace(tmp_path, local_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def sync(artifacts, data_dir, source=ARTIFACT_SOURCE, workers=ARTIFACT_WORKERS, bucket=None):
+    ''' brings {remote name: local path} up to date with the bucket and
+    returns the remote names that were downloaded. When the bucket cannot
+    be reached the local copies are kept, if there are any. '''
+    if source == 'none' and bucket is None:
+        return []
+    manifest_path = os.path.join(data_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+
+    # versions in the bucket
+    try:
+        bucket = bucket or open_bucket(source)
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            stats = dict(zip(artifacts, pool.map(bucket.stat, artifacts)))
+    except Exception as e:
+        if all(os.path.isfile(x) for x in artifacts.values()):
+            logger.warning(f"unable to reach {source}, keeping local artifacts: {e!r}")
+            return []
+        raise
+
+    missing = [x for x, y in stats.items() if y is None]
+    if missing:
+        raise FileNotFoundError(f"{', '.join(missing)} not found in {source}")
+
+    # download what changed, in parallel
+    changed = [x for x in artifacts if not is_current(manifest.get(x), stats[x], artifacts[x])]
+    for name in artifacts:
+        if name not in changed:
+            metrics.inc('gcs_sync', file=name, cache='hit')
+    if changed:
+        os.makedirs(data_dir, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(_download, bucket, x, artifacts[x], stats[x]) for x in changed]
+            for future in futures:
+                future.result()
+
+        manifest.update({x: stats[x] for x in changed})
+        _save_manifest(manifest_path, manifest)
+        logger.info(f"synced {', '.join(changed)} from {source}")
+    return changed
+
+
+def main():
+    # app
+    import catalog
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', default=ARTIFACT_SOURCE, help='gs://bucket or a local folder')
+    parser.add_argument('--sync', action='store_true', help='download what changed, else only report')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.sync:
+        changed = sync(catalog.ARTIFACTS, catalog.DATA_DIR, args.source)
+        print(f"{len(changed)} of {len(catalog.ARTIFACTS)} artifacts updated")
+        return
+
+    bucket = open_bucket(args.source)
+    manifest = load_manifest(os.path.join(catalog.DATA_DIR, MANIFEST_NAME))
+    for name, path in catalog.ARTIFACTS.items():
+        stat = bucket.stat(name)
+        state = 'missing' if stat is None else 'current' if is_current(manifest.get(name), stat, path) else 'stale'
+        print(f"{name} -> {path}: {state} {stat or ''}")
+
+
+if __name__ == '__main__':
+    main()
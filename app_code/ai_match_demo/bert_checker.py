@@ -0,0 +1,193 @@
+''' distilled trial checker: the ClinicalBERT classifier trained in notebook 5
+to predict the Llama verdict. Scores every (patient, trial) pair on CPU in
+a few padded batches; confident pairs are accepted or rejected outright
+and only the uncertain band goes on to the LLM checker.
+
+    python bert_checker.py --pairs cohort_specific_eligibility_checks.csv --model bert-checker
+'''
+# system
+import os
+import time
+import hashlib
+import logging
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+# app
+import llm_backends
+
+# parameters
+load_dotenv()
+BERT_CHECKER_MODEL = os.getenv('BERT_CHECKER_MODEL')
+BERT_CHECKER_TOKENIZER = os.getenv('BERT_CHECKER_TOKENIZER', 'medicalai/ClinicalBERT')
+BERT_CHECKER_ACCEPT = float(os.getenv('BERT_CHECKER_ACCEPT', 0.9))
+BERT_CHECKER_REJECT = float(os.getenv('BERT_CHECKER_REJECT', 0.1))
+BERT_CHECKER_BATCH = int(os.getenv('BERT_CHECKER_BATCH', 32))
+BERT_CHECKER_MAX_LENGTH = int(os.getenv('BERT_CHECKER_MAX_LENGTH', 512))
+BERT_CHECKER_QUANTIZE = os.getenv('BERT_CHECKER_QUANTIZE', '1') == '1'
+
+logger = logging.getLogger(__name__)
+
+# process wide state
+_bert_checker = None
+_bert_checker_lock = threading.Lock()
+
+
+def pair_text(patient_summary, trial_summary):
+    ''' the input format the classifier was trained on '''
+    return patient_summary + "\nNow here is the trial cohort:" + trial_summary
+
+
+def cohort_lines(trial_summary):
+    ''' the cohorts of a trial summary, one per line, as the classifier
+    saw them in training '''
+    lines = [x.strip() for x in str(trial_summary).split('\n')]
+    return [x for x in lines if x] or [str(trial_summary)]
+
+
+class StubScorer:
+    ''' offline stand-in for the classifier: agrees with the stub LLM
+    verdict with a hash derived confidence '''
+
+    def predict_proba(self, patient_summary, trial_summaries):
+        probs = []
+        for trial_summary in trial_summaries:
+            digest = hashlib.sha256(pair_text(patient_summary, trial_summary).encode('utf-8')).digest()
+            confidence = 0.5 + digest[1] / 511
+            yes = llm_backends.stub_verdict(patient_summary, trial_summary)
+            probs.append(confidence if yes else 1 - confidence)
+        return np.array(probs, dtype=np.float32)
+
+
+class BertChecker:
+    ''' the fine-tuned sequence classifier on CPU, dynamically quantized to
+    int8 linear layers when torch supports it '''
+
+    def __init__(self, model_path=BERT_CHECKER_MODEL, tokenizer=BERT_CHECKER_TOKENIZER, quantize=BERT_CHECKER_QUANTIZE, \
+        batch_size=BERT_CHECKER_BATCH, max_length=BERT_CHECKER_MAX_LENGTH):
+
+        # heavy and optional, only needed when the pre-filter is enabled
+        import torch
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification
+        self.torch = torch
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_path).eval()
+        if quantize:
+            try:
+                self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            except Exception as e:
+                logger.warning(f"dynamic quantization unavailable, using float32: {e!r}")
+
+    def predict_proba(self, patient_summary, trial_summaries):
+        ''' probability the LLM would answer Yes! for each trial: the best of
+        its cohorts, each scored as a (patient, cohort) pair '''
+        texts, owners = [], []
+        for i, trial_summary in enumerate(trial_summaries):
+            for line in cohort_lines(trial_summary):
+                texts.append(pair_text(patient_summary, line))
+                owners.append(i)
+        cohort_probs = np.zeros(len(texts), dtype=np.float32)
+
+        # batch similar lengths together so padding stays short
+        order = np.argsort([len(x) for x in texts], kind='stable')
+        with self.torch.inference_mode():
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start:start + self.batch_size]
+                inputs = self.tokenizer([texts[x] for x in batch], padding=True, truncation=True, \
+                    max_length=self.max_length, return_tensors='pt')
+                logits = self.model(**inputs).logits
+                cohort_probs[batch] = self.torch.softmax(logits, dim=-1)[:, 1].numpy()
+
+        probs = np.zeros(len(trial_summaries), dtype=np.float32)
+        np.maximum.at(probs, np.asarray(owners, dtype=np.intp), cohort_probs)
+        return probs
+
+
+def triage(probs, accept=BERT_CHECKER_ACCEPT, reject=BERT_CHECKER_REJECT):
+    ''' True above accept, False below reject, None (ask the LLM) between '''
+    return [True if x >= accept else False if x <= reject else None for x in probs]
+
+
+def get_bert_checker():
+    ''' returns the process wide pre-filter, or None when BERT_CHECKER_MODEL
+    is not set. Loading the classifier takes seconds, call it off the event
+    loop. '''
+    global _bert_checker
+    if _bert_checker is None and BERT_CHECKER_MODEL:
+        with _bert_checker_lock:
+            if _bert_checker is None:
+                if BERT_CHECKER_MODEL == 'stub':
+                    _bert_checker = StubScorer()
+                else:
+                    _bert_checker = BertChecker()
+    return _bert_checker
+
+
+def auroc(labels, scores):
+    ''' area under the roc curve via the rank statistic '''
+    labels = np.asarray(labels, dtype=bool)
+    ranks = pd.Series(scores).rank().values
+    n_pos, n_neg = labels.sum(), (~labels).sum()
+    if n_pos == 0 or n_neg == 0:
+        return float('nan')
+    return float((ranks[labels].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg))
+
+
+def benchmark(scorer, pairs, accept=BERT_CHECKER_ACCEPT, reject=BERT_CHECKER_REJECT, page_size=10):
+    ''' latency per page of trials and agreement with the LLM verdicts in
+    `pairs` (patient_summary, this_cohort, eligibility_result) '''
+    probs = []
+    latencies = []
+    for _, group in pairs.groupby('patient_summary', sort=False):
+        trials = group['this_cohort'].astype(str).tolist()
+        for start in range(0, len(trials), page_size):
+            tick = time.perf_counter()
+            probs.append(scorer.predict_proba(group['patient_summary'].iloc[0], trials[start:start + page_size]))
+            latencies.append((time.perf_counter() - tick) * 1000)
+    probs = np.concatenate(probs)
+
+    # reorder labels to match the grouped scoring order
+    labels = np.concatenate([g['eligibility_result'].astype(bool).values \
+        for _, g in pairs.groupby('patient_summary', sort=False)])
+    verdicts = np.array(triage(probs, accept, reject), dtype=object)
+    decided = verdicts != None
+    return {'pairs': len(labels), 'auroc': auroc(labels, probs), \
+        'agreement@0.5': float(np.mean((probs >= 0.5) == labels)), \
+        'decided': float(decided.mean()), \
+        'decided_agreement': float(np.mean(verdicts[decided].astype(bool) == labels[decided])) if decided.any() else float('nan'), \
+        'page_p50_ms': float(np.percentile(latencies, 50)), 'page_p99_ms': float(np.percentile(latencies, 99))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', required=True, help='csv with patient_summary, this_cohort and eligibility_result')
+    parser.add_argument('--model', default=BERT_CHECKER_MODEL or 'stub', help="saved classifier path or 'stub'")
+    parser.add_argument('--limit', type=int, default=2000, help='pairs to score')
+    parser.add_argument('--no-quantize', action='store_true')
+    args = parser.parse_args()
+
+    pairs = pd.read_csv(args.pairs)
+    if 'split' in pairs.columns:
+        pairs = pairs[pairs.split != 'train']
+    pairs = pairs.dropna(subset=['patient_summary', 'this_cohort']).head(args.limit)
+
+    if args.model == 'stub':
+        scorers = {'stub': StubScorer()}
+    else:
+        scorers = {'float32': BertChecker(args.model, quantize=False)}
+        if not args.no_quantize:
+            scorers['int8'] = BertChecker(args.model, quantize=True)
+
+    for name, scorer in scorers.items():
+        print(f"## {name}")
+        for key, value in benchmark(scorer, pairs).items():
+            print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+''' converts the trial and similarity csv artifacts into the columnar
+catalog that catalog.TrialCatalog memory maps at startup.
+
+    python build_catalog.py [--out data/catalog]
+'''
+# system
+import argparse
+import time
+
+# app
+import catalog
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default=catalog.CATALOG_DIR, help='output folder')
+    args = parser.parse_args()
+
+    # pull the raw artifacts
+    tick = time.perf_counter()
+    catalog.prep_data_folder()
+    patients_df = catalog.load_patients(catalog.EXAMPLE_PATIENTS)
+
+    # parse and write
+    trial_catalog = catalog.TrialCatalog.from_csv(patients_df)
+    csv_secs = time.perf_counter() - tick
+    trial_catalog.save(args.out)
+
+    # time the columnar load for comparison
+    tick = time.perf_counter()
+    trial_catalog = catalog.TrialCatalog.from_columnar(args.out, patients_df)
+    columnar_secs = time.perf_counter() - tick
+
+    print(f"wrote {trial_catalog.trials_df.shape[0]} trials x {trial_catalog.similarity.shape[0]} patients to {args.out}")
+    print(f"csv load: {csv_secs:.3f}s, columnar load: {columnar_secs:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# system
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    ''' collapses whitespace so trivially different summaries share a key '''
+    return ' '.join(str(text).split())
+
+
+def content_key(*parts):
+    ''' sha256 over the normalized parts '''
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(normalize_text(part).encode('utf-8'))
+        h.update(b'\x1f')
+    return h.hexdigest()
+
+
+class TTLCache:
+    ''' thread safe in-memory LRU cache whose entries also expire after
+    `ttl` seconds; ttl of None keeps entries until evicted '''
+
+    def __init__(self, max_items=1024, ttl=None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        ''' like get, without counting a hit or miss '''
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[1] is None or item[1] > time.monotonic()):
+                self._data.move_to_end(key)
+                return item[0]
+            return default
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and (item[1] is None or item[1] > time.monotonic())
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'items': len(self._data), 'hits': self.hits, 'misses': self.misses, \
+            'hit_rate': self.hits / total if total else 0.0}
@@ -0,0 +1,396 @@
+# system
+import os
+import time
+import pathlib
+import threading
+import logging
+import json
+import numpy as np
+import pandas as pd
+
+# app
+import metrics
+import artifacts
+
+# parameters
+CD = pathlib.Path(__file__).parent.resolve()
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(CD, 'data'))
+
+EXAMPLE_PATIENTS = os.path.join(DATA_DIR, 'demo_patients.csv')
+EXAMPLE_PATIENTS_CLOUD = f'demo_patients.csv'
+
+#EXAMPLE_TRIALS = os.path.join(CD, 'data/nci_trials.csv')
+EXAMPLE_TRIALS = os.path.join(DATA_DIR, 'trial_nct.june10.csv')
+EXAMPLE_TRIALS_CLOUD = f'nci_trials.csv'
+
+#EXAMPLE_SIM = os.path.join(CD, 'data/trial_similarity.csv')
+EXAMPLE_SIM = os.path.join(DATA_DIR, 'trialpatient_sim_nct.june10.csv')
+EXAMPLE_SIM_CLOUD = f'trial_similarity.csv'
+
+# blobs kept in sync with the bucket, see artifacts.py
+ARTIFACTS = {EXAMPLE_PATIENTS_CLOUD: EXAMPLE_PATIENTS, EXAMPLE_TRIALS_CLOUD: EXAMPLE_TRIALS, \
+    EXAMPLE_SIM_CLOUD: EXAMPLE_SIM}
+
+# seconds between checks for a new catalog, 0 to only sync at startup
+ARTIFACT_REFRESH_SECONDS = float(os.getenv('ARTIFACT_REFRESH_SECONDS') or 0)
+
+# columnar copy of the above, see build_catalog.py
+CATALOG_DIR = os.path.join(DATA_DIR, 'catalog')
+CATALOG_VERSION = 2
+CATALOG_MANIFEST = 'manifest.json'
+CATALOG_TRIALS = 'trials.npz'
+CATALOG_SIM = 'similarity.npy'
+CATALOG_PATIENT_IDS = 'similarity_patients.npy'
+
+# a catalog is current while the files it was built from are unchanged;
+# precompute_similarity.py builds from the patients instead of EXAMPLE_SIM,
+# but a newer EXAMPLE_SIM still replaces its similarities
+CSV_SOURCES = [EXAMPLE_TRIALS, EXAMPLE_SIM]
+PRECOMPUTED_SOURCES = [EXAMPLE_TRIALS, EXAMPLE_PATIENTS, EXAMPLE_SIM]
+
+logger = logging.getLogger(__name__)
+
+# process wide state
+_catalog = None
+_catalog_lock = threading.Lock()
+_refresher = None
+_refresh_callbacks = []
+
+
+class TrialCatalog:
+    ''' read-only trials, demo patients and precomputed similarities. One
+    instance is shared by every session served by this process, so nothing
+    in here may be mutated after construction. '''
+
+    def __init__(self, patients_df, trials_df, similarity, patient_ids, similarity_origin='csv'):
+
+        # core data
+        self.patients_df = patients_df
+        self.trials_df = trials_df
+
+        # patients x trials, one contiguous float32 row per patient
+        self.similarity = similarity
+        self.similarity.flags.writeable = False
+        self._patient_pos = {x: i for i, x in enumerate(patient_ids)}
+        self.similarity_origin = similarity_origin
+
+        # versions of the artifacts it was loaded from, see refresh
+        self.artifact_stamps = None
+
+    @classmethod
+    def load(cls, sync=True):
+        ''' builds the catalog from the data folder, preferring the columnar
+        copy and (re)building it from the csv files when missing or stale '''
+
+        # initialize data
+        if sync:
+            prep_data_folder()
+
+        # stamped before reading, so a file replaced meanwhile is seen as new
+        stamps = _source_stamps(ARTIFACTS.values())
+        catalog = cls._load_data_folder()
+        catalog.artifact_stamps = stamps
+        return catalog
+
+    @classmethod
+    def _load_data_folder(cls):
+
+        # load patients
+        patients_df = load_patients(EXAMPLE_PATIENTS)
+
+        # memory map the columnar copy when it is current
+        with metrics.span('catalog_load', source='columnar') as s:
+            try:
+                return cls.from_columnar(CATALOG_DIR, patients_df)
+            except (OSError, ValueError, KeyError) as e:
+                logger.info(f"columnar catalog unavailable, loading csv: {e}")
+
+            # fall back to csv and persist the columnar copy for the next worker
+            s.set(source='csv')
+            catalog = cls.from_csv(patients_df)
+            try:
+                catalog.save(CATALOG_DIR)
+                return cls.from_columnar(CATALOG_DIR, patients_df)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"unable to write columnar catalog: {e}")
+            return catalog
+
+    @classmethod
+    def from_csv(cls, patients_df):
+        ''' parses the raw csv artifacts '''
+
+        # load trials
+        trials_df = load_trials(EXAMPLE_TRIALS)
+
+        # load similarity, aligned to the trials; trials the csv predates
+        # get NaN and never rank
+        similar_df = pd.read_csv(EXAMPLE_SIM).set_index('nct_id')
+        missing = ~trials_df.index.isin(similar_df.index)
+        if missing.any():
+            logger.warning(f"{missing.sum()} trials have no similarity in {EXAMPLE_SIM}, run precompute_similarity.py")
+        similar_df = similar_df.reindex(trials_df.index)
+        similarity = np.ascontiguousarray(similar_df.to_numpy(dtype=np.float32).T)
+
+        return cls(patients_df, trials_df, similarity, similar_df.columns)
+
+    @classmethod
+    def from_columnar(cls, path, patients_df):
+        ''' opens a catalog written by save, memory mapping the similarity
+        matrix so workers on one node share its pages '''
+
+        # sanity
+        with open(os.path.join(path, CATALOG_MANIFEST)) as fin:
+            manifest = json.load(fin)
+        if manifest.get('version') != CATALOG_VERSION:
+            raise ValueError(f"catalog version {manifest.get('version')} != {CATALOG_VERSION}")
+        sources = manifest.get('sources', {})
+        origin = manifest.get('similarity', 'csv')
+        if os.path.basename(EXAMPLE_TRIALS) not in sources:
+            raise ValueError("catalog does not record its trials")
+        current = _source_stamps([_SOURCE_PATHS[x] for x in sources])
+        changed = [x for x in sources if sources[x] != current[x]]
+        if changed:
+            if origin != 'csv':
+                logger.warning(f"{', '.join(changed)} changed since the {origin} similarities were computed, " \
+                    f"replacing them with {os.path.basename(EXAMPLE_SIM)}; rerun precompute_similarity.py")
+            raise ValueError(f"{origin} catalog is older than {', '.join(changed)}")
+
+        # load
+        trials_df = _load_frame(os.path.join(path, CATALOG_TRIALS))
+        similarity = np.load(os.path.join(path, CATALOG_SIM), mmap_mode='r', allow_pickle=False)
+        patient_ids = np.load(os.path.join(path, CATALOG_PATIENT_IDS), allow_pickle=False)
+        if similarity.shape != (len(patient_ids), trials_df.shape[0]):
+            raise ValueError(f"similarity shape {similarity.shape} does not match catalog")
+
+        return cls(patients_df, trials_df, similarity, patient_ids.tolist(), origin)
+
+    def save(self, path, sources=CSV_SOURCES):
+        ''' writes the columnar copy; every file is renamed into place and the
+        manifest goes last so readers never see a partial catalog '''
+        os.makedirs(path, exist_ok=True)
+
+        patient_ids = np.array(list(self._patient_pos), dtype=str)
+        _atomic_write(os.path.join(path, CATALOG_TRIALS), lambda x: _save_frame(x, self.trials_df))
+        _atomic_write(os.path.join(path, CATALOG_SIM), lambda x: _save_npy(x, np.asarray(self.similarity)))
+        _atomic_write(os.path.join(path, CATALOG_PATIENT_IDS), lambda x: _save_npy(x, patient_ids))
+
+        manifest = {'version': CATALOG_VERSION, 'sources': _source_stamps(sources), 'similarity': self.similarity_origin}
+        _atomic_write(os.path.join(path, CATALOG_MANIFEST), lambda x: _save_json(x, manifest))
+
+    def patient_similarity(self, patient_id):
+        ''' a private copy of one patient's similarity to every trial '''
+        pos = self._patient_pos.get(patient_id)
+        if pos is None:
+            values = np.full(self.trials_df.shape[0], np.nan, dtype=np.float32)
+        else:
+            values = self.similarity[pos].copy()
+        return pd.Series(values, index=self.trials_df.index, name='Similarity')
+
+
+def get_catalog():
+    ''' returns the process wide catalog, loading it on first use '''
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                logger.info("loading trial catalog")
+                metrics.inc('catalog_requests', cache='miss')
+                _catalog = TrialCatalog.load()
+                return _catalog
+    metrics.inc('catalog_requests', cache='hit')
+    return _catalog
+
+
+def refresh():
+    ''' syncs the artifacts and, when any changed, loads a new catalog and
+    swaps it in for the sessions that start from now on. Running sessions
+    keep the catalog they started with. Returns whether it was swapped. '''
+    global _catalog
+    changed = prep_data_folder()
+
+    # another worker sharing the data folder may have downloaded them
+    current = _catalog
+    if current is not None and current.artifact_stamps == _source_stamps(ARTIFACTS.values()):
+        return False
+
+    # load outside the lock, so new sessions keep starting meanwhile
+    logger.info(f"loading trial catalog, {len(changed)} artifacts downloaded by this worker")
+    catalog = TrialCatalog.load(sync=False)
+    logger.info(f"swapping in a catalog of {catalog.trials_df.shape[0]} trials with {catalog.similarity_origin} " \
+        "similarities")
+    with _catalog_lock:
+        _catalog = catalog
+    metrics.inc('catalog_swaps')
+    for callback in _refresh_callbacks:
+        try:
+            callback(catalog)
+        except Exception:
+            logger.exception("catalog refresh callback failed")
+    return True
+
+
+def on_refresh(callback):
+    ''' calls callback(catalog) whenever refresh swaps in a new catalog '''
+    _refresh_callbacks.append(callback)
+
+
+def _refresh_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            refresh()
+        except Exception:
+            logger.exception("catalog refresh failed, keeping the current catalog")
+
+
+def start_refresh(interval=ARTIFACT_REFRESH_SECONDS):
+    ''' checks for new artifacts every `interval` seconds from a daemon
+    thread, once per process; a no-op when the interval is 0 '''
+    global _refresher
+    if not interval or _refresher is not None:
+        return _refresher
+    with _catalog_lock:
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresh_forever, args=(interval,), name='catalog-refresh', \
+                daemon=True)
+            _refresher.start()
+            logger.info(f"checking for new artifacts every {interval:g}s")
+    return _refresher
+
+
+def prep_data_folder():
+    ''' ensures the data folder has the current artifacts, returns the ones
+    that were downloaded '''
+    return artifacts.sync(ARTIFACTS, DATA_DIR)
+
+
+_SOURCE_PATHS = {os.path.basename(x): x for x in [EXAMPLE_PATIENTS, EXAMPLE_TRIALS, EXAMPLE_SIM]}
+
+
+def _source_stamps(paths=CSV_SOURCES):
+    ''' size and mtime of the csv artifacts the catalog is built from '''
+    stamps = dict()
+    for x in paths:
+        st = os.stat(x)
+        stamps[os.path.basename(x)] = [st.st_size, st.st_mtime_ns]
+    return stamps
+
+
+def _atomic_write(path, writer):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        writer(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _save_npy(path, arr):
+    with open(path, 'wb') as fout:
+        np.save(fout, arr)
+
+
+def _encode_text(values):
+    ''' utf-8 bytes, end offsets and null mask of a text column; entries
+    are NUL separated so a column decodes in one go '''
+    isnull = np.asarray(pd.isna(values), dtype=bool)
+    encoded = [b'' if n else str(x).encode('utf-8') for x, n in zip(values, isnull)]
+    offsets = np.cumsum([len(x) + 1 for x in encoded], dtype=np.int64) - 1
+    return np.frombuffer(b'\0'.join(encoded), dtype=np.uint8), offsets, isnull
+
+
+def _decode_text(data, offsets, isnull):
+    text = data.tobytes()
+    values = text.decode('utf-8').split('\0') if len(offsets) else []
+    if len(values) != len(offsets):
+        # some entry contains a NUL, go by the offsets
+        starts = np.concatenate([[0], offsets[:-1] + 1]).astype(np.int64)
+        values = [text[x:y].decode('utf-8') for x, y in zip(starts, offsets)]
+    values = np.array(values, dtype=object)
+    values[isnull] = None
+    return values
+
+
+def _frame_arrays(prefix, values):
+    ''' typed arrays of one column: dates and numbers as they are, anything
+    else as text '''
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_dtype(values.dtype):
+        return 'datetime', {f'{prefix}.values': values.to_numpy(dtype='datetime64[ns]')}
+    if values.dtype.kind in 'biuf':
+        return 'number', {f'{prefix}.values': values.to_numpy()}
+    data, offsets, isnull = _encode_text(values)
+    return 'text', {f'{prefix}.data': data, f'{prefix}.offsets': offsets, f'{prefix}.isnull': isnull}
+
+
+def _save_frame(path, df):
+    ''' writes a frame as typed arrays in one .npz, text as utf-8 bytes with
+    offsets, so that loading it never unpickles anything '''
+    arrays = dict()
+    kinds = []
+    for i, (name, values) in enumerate([(df.index.name or '', df.index)] + list(df.items())):
+        kind, column = _frame_arrays(f'c{i}', values)
+        kinds.append(kind)
+        arrays.update(column)
+    arrays['names'] = np.array([df.index.name or ''] + [str(x) for x in df.columns], dtype=str)
+    arrays['kinds'] = np.array(kinds, dtype=str)
+    with open(path, 'wb') as fout:
+        np.savez(fout, **arrays)
+
+
+def _load_frame(path):
+    ''' reads a frame written by _save_frame '''
+    with np.load(path, allow_pickle=False) as npz:
+        columns = []
+        for i, kind in enumerate(npz['kinds'].tolist()):
+            if kind == 'text':
+                columns.append(_decode_text(npz[f'c{i}.data'], npz[f'c{i}.offsets'], npz[f'c{i}.isnull']))
+            else:
+                columns.append(npz[f'c{i}.values'])
+        names = npz['names'].tolist()
+    index = pd.Index(columns[0], name=names[0] or None)
+    return pd.DataFrame(dict(zip(names[1:], columns[1:])), index=index)
+
+
+def _save_json(path, obj):
+    with open(path, 'w') as fout:
+        json.dump(obj, fout)
+
+
+def load_patients(path):
+    return pd.read_csv(path).set_index('patient_id')
+
+
+def load_trials(path):
+
+    #trials_df = pd.read_csv(path).set_index('nct_id').drop(columns='Unnamed: 0')
+    trials_df = pd.read_csv(path).set_index('nct_id')
+
+    #for x in ['start_date',
+    #    'primary_completion_date',
+    #    'completion_date',
+    #    'first_posted',
+    #    'results_first_posted',
+    #    'last_update_posted',
+    #    'trial_start_dt']:
+    for x in ['statusModule.startDateStruct.date']:
+        try:
+            trials_df[x] = pd.to_datetime(trials_df[x])
+        except ValueError:
+            trials_df[x] = None
+
+    # take this susbet
+    new_cols = ['identificationModule.briefTitle', 'statusModule.overallStatus', 'statusModule.startDateStruct.date',
+        'identificationModule.officialTitle', 'descriptionModule.detailedDescription', 'trial_summary']
+    trials_df = trials_df[new_cols].copy()
+
+    # rename the columns
+    xx = dict()
+    for x, y in zip(['short_title', 'study_status', 'trial_start_dt', 'long_title', \
+        'eligibility_criteria'], new_cols):
+        xx[y] = x
+    trials_df = trials_df.rename(columns=xx)
+    trials_df['study_url'] = trials_df.index.map(lambda x: f'https://clinicaltrials.gov/study/{x}')
+
+    return trials_df
@@ -0,0 +1,185 @@
+# system
+import os
+import time
+import random
+import asyncio
+import logging
+
+# app
+import metrics
+import bert_checker
+
+# parameters
+CHECKER_CONCURRENCY = int(os.getenv('CHECKER_CONCURRENCY', 10))
+CHECKER_RATE = float(os.getenv('CHECKER_RATE', 3.0))
+CHECKER_BURST = int(os.getenv('CHECKER_BURST', 10))
+CHECKER_RETRIES = int(os.getenv('CHECKER_RETRIES', 3))
+CHECKER_BACKOFF = float(os.getenv('CHECKER_BACKOFF', 0.5))
+
+logger = logging.getLogger(__name__)
+
+# process wide state, the rate limit applies to the api key not the session
+_rate_limiter = None
+
+
+class TokenBucket:
+    ''' asyncio token bucket: `rate` requests per second on average with
+    bursts of up to `capacity` requests '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        ''' waits until a token is available and takes it '''
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+def get_rate_limiter():
+    ''' returns the process wide rate limiter for checker requests '''
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = TokenBucket(CHECKER_RATE, CHECKER_BURST)
+    return _rate_limiter
+
+
+def is_retryable(e):
+    ''' rate limits, server errors and dropped connections are worth a retry '''
+    if isinstance(e, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    status = getattr(e, 'status_code', None) or getattr(e, 'status', None)
+    if status is None:
+        return type(e).__name__ in ('APIConnectionError', 'APITimeoutError', 'ServerDisconnectedError')
+    return status == 429 or 500 <= status < 600
+
+
+async def call_with_retries(fn, *args, retries=CHECKER_RETRIES, backoff=CHECKER_BACKOFF, limiter=None):
+    ''' awaits fn(*args) behind the rate limiter, retrying retryable errors
+    with jittered exponential backoff '''
+    limiter = limiter or get_rate_limiter()
+    for attempt in range(retries + 1):
+        await limiter.acquire()
+        try:
+            return await fn(*args)
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            logger.info(f"checker call failed ({e!r}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+
+def cached_verdicts(backend, patient_summary, trial_summaries, cache, stream=False, count=True):
+    ''' {nct_id: (verdict, reasoning)} for the trials already in the cache;
+    reasoning is only looked up for streamed checks. With count=False the
+    lookups are not counted as cache hits or misses. '''
+    stream = stream and backend.supports_stream
+    found = dict()
+    for nct_id, trial_summary in trial_summaries.items():
+        key = cache.key(backend, patient_summary, trial_summary)
+        verdict = cache.lookup(key, count=count)
+        if verdict is not None:
+            if count:
+                metrics.inc('checker_verdicts', cache='hit')
+            found[nct_id] = (verdict, cache.reasoning(key) if stream else None)
+    return found
+
+
+async def check_trials(backend, patient_summary, trial_summaries, cache=None, concurrency=CHECKER_CONCURRENCY, \
+    stream=False, prefilter=None):
+    ''' checks the patient against every trial, yielding (nct_id, verdict,
+    reasoning) as each one finishes. Cached verdicts come back first;
+    batching backends get a single request for the rest, others at most
+    `concurrency` requests in flight. With `stream` the response is streamed
+    and each trial is yielded as soon as its verdict token appears, along
+    with the reasoning so far. A `prefilter` (bert_checker) settles confident
+    pairs before any LLM call. Failed checks yield None and are not cached. '''
+
+    # answer what we can from the cache
+    stream = stream and backend.supports_stream
+    cached = dict()
+    if cache is not None:
+        cached = cached_verdicts(backend, patient_summary, trial_summaries, cache, stream)
+    for nct_id, (verdict, reasoning) in cached.items():
+        yield nct_id, verdict, reasoning
+    pending = {x: y for x, y in trial_summaries.items() if x not in cached}
+
+    # settle confident pairs with the local classifier, off the event loop
+    if prefilter is not None and pending:
+        try:
+            with metrics.span('checker_prefilter'):
+                probs = await asyncio.to_thread(prefilter.predict_proba, patient_summary, list(pending.values()))
+            for nct_id, prob, verdict in zip(list(pending), probs, bert_checker.triage(probs)):
+                if verdict is not None:
+                    del pending[nct_id]
+                    metrics.inc('checker_verdicts', cache='prefilter')
+                    yield nct_id, verdict, f"Decided by the trial checker classifier (p={prob:.2f})."
+        except Exception as e:
+            logger.error(f"pre-filter failed, checking everything with the LLM: {e!r}")
+
+    async for nct_id, verdict, reasoning in _check_uncached(backend, patient_summary, pending, concurrency, stream):
+        metrics.inc('checker_verdicts', cache='miss' if verdict is not None else 'failed')
+        if cache is not None and verdict is not None:
+            key = cache.key(backend, patient_summary, trial_summaries[nct_id])
+            cache.set(key, verdict)
+            if reasoning:
+                cache.set(cache.reasoning_key(key), reasoning)
+        yield nct_id, verdict, reasoning
+
+
+async def _check_uncached(backend, patient_summary, trial_summaries, concurrency, stream=False):
+
+    # one request for the whole page
+    if backend.supports_batch and len(trial_summaries) > 1 and not stream:
+        nct_ids = list(trial_summaries)
+        try:
+            with metrics.span('checker_call', backend=backend.name, mode='batch', cache='miss'):
+                verdicts = await call_with_retries(backend.check_batch, patient_summary, \
+                    list(trial_summaries.values()))
+        except Exception as e:
+            logger.error(f"unable to check batch of {len(nct_ids)}: {e!r}")
+            verdicts = [None] * len(nct_ids)
+
+        # every trial gets a result, also when the backend answered fewer
+        if len(verdicts) != len(nct_ids):
+            logger.error(f"batch of {len(nct_ids)} returned {len(verdicts)} verdicts")
+            verdicts = (list(verdicts) + [None] * len(nct_ids))[:len(nct_ids)]
+        for nct_id, verdict in zip(nct_ids, verdicts):
+            yield nct_id, verdict, None
+        return
+
+    # one request per trial
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _check(nct_id, trial_summary):
+        async with semaphore:
+            try:
+                with metrics.span('checker_call', backend=backend.name, mode='stream' if stream else 'single', \
+                    cache='miss'):
+                    if stream:
+                        return nct_id, *await call_with_retries(backend.check_stream, patient_summary, trial_summary)
+                    return nct_id, await call_with_retries(backend.check, patient_summary, trial_summary), None
+            except Exception as e:
+                logger.error(f"unable to check {nct_id}: {e!r}")
+                return nct_id, None, None
+
+    tasks = [asyncio.ensure_future(_check(x, y)) for x, y in trial_summaries.items()]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
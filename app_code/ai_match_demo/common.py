@@ -1,12 +1,9 @@
 # system
-from google.oauth2 import service_account
 import os
 import pathlib
-import google.auth
-from google.cloud import storage
 import json
 import logging
-from groq import Groq
+import threading
 
 # parameters
 from dotenv import load_dotenv
@@ -21,26 +18,47 @@ CD = pathlib.Path(__file__).parent.resolve()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# process wide state, the google SDKs are imported on first use as they
+# take a good part of a second to load
+_credentials = None
+_storage_client = None
+_key_path = None
+_lock = threading.Lock()
 
-def transfer_file_from_gcs(remote_path, local_path, force=False):
-    ''' this is logic that loads a pickle file from cloud
-    to local server '''
 
-    # first try local
-    if force or not os.path.isfile(local_path) or os.path.getsize(local_path) < 50:
-
-        # then remote
+def google_credentials():
+    ''' (credentials, project_id), resolved once per process '''
+    global _credentials
+    if _credentials is None:
+        with _lock:
+            if _credentials is None:
+                _credentials = _load_google_credentials()
+    return _credentials
+
+
+def get_storage_client():
+    ''' the process wide GCS client '''
+    global _storage_client
+    if _storage_client is None:
+        from google.cloud import storage
         credentials, project_id = google_credentials()
-        storage_client = storage.Client(project=project_id, credentials=credentials)
+        with _lock:
+            if _storage_client is None:
+                _storage_client = storage.Client(project=project_id, credentials=credentials)
+    return _storage_client
 
-        bucket = storage_client.bucket(GCP_CLOUD_FOLDER)
-        blob = bucket.blob(remote_path)
-        blob.download_to_filename(local_path)
 
+def service_account_key_path():
+    ''' the service account key file, looked up once per process '''
+    global _key_path
+    if _key_path is None:
+        _key_path = (GCP_KEY_NAME and find_file_recursively(GCP_KEY_NAME)) or ''
+    return _key_path
 
-    return True
 
-def google_credentials():
+def _load_google_credentials():
+    import google.auth
+    from google.oauth2 import service_account
 
     # test for interactive
     def is_interactive():
@@ -53,7 +71,7 @@ def google_credentials():
     #if pdir is not None:
     #    json_file_path = os.path.join(pdir, GCP_KEY_NAME)
     pdir = "d"
-    json_file_path = find_file_recursively(GCP_KEY_NAME)
+    json_file_path = service_account_key_path()
 
     # sanity
     credentialed = False
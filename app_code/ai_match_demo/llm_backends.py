@@ -0,0 +1,367 @@
+# system
+import os
+import re
+import ssl
+import json
+import asyncio
+import hashlib
+import logging
+import aiohttp
+from dotenv import load_dotenv
+
+# app
+import common
+
+# parameters
+load_dotenv()
+CHECKER_BACKEND = os.getenv('CHECKER_BACKEND') or None
+GROQ_MODEL = os.getenv('GROQ_MODEL', 'llama3-70b-8192')
+LOCAL_LLM_URL = os.getenv('LOCAL_LLM_URL')
+LOCAL_LLM_MODEL = os.getenv('LOCAL_LLM_MODEL', 'llama3-70b')
+LOCAL_LLM_KEY = os.getenv('LOCAL_LLM_KEY')
+LOCAL_LLM_BATCH = os.getenv('LOCAL_LLM_BATCH', '0') == '1'
+LOCAL_LLM_TEMPLATE = os.getenv('LOCAL_LLM_TEMPLATE', 'llama3')
+LOCAL_LLM_TIMEOUT = float(os.getenv('LOCAL_LLM_TIMEOUT', 120))
+STUB_LATENCY = float(os.getenv('STUB_LATENCY', 0.0))
+CERT_PEM = os.getenv('CERT_KEYNAME')
+CHECKER_STREAM = os.getenv('CHECKER_STREAM', '0') == '1'
+CHECKER_EARLY_EXIT = os.getenv('CHECKER_EARLY_EXIT', '1') == '1'
+
+logger = logging.getLogger(__name__)
+
+# process wide state
+_backends = dict()
+
+SYSTEM_PROMPT = """\
+You are a brilliant oncologist with encyclopedic knowledge about cancer and its treatment. 
+Your job is to evaluate whether a given clinical trial is a reasonable consideration for a 
+patient, given a clinical trial summary and a patient summary."""
+
+USER_PROMPT = """
+        Base your judgment on whether the patient generally fits the cancer type(s), prior treatment(s), and biomarker criteria specified for the trial.
+        You do not have to determine if the patient is actually eligible; instead please just evaluate whether it is reasonable for the trial to be considered further by the patient's oncologist.
+        Some trials have biomarker requirements that are not assessed until formal eligibility screening begins; please ignore these requirements.
+        Reason step by step, then answer the question "Is this trial a reasonable consideration for this patient?" with a one-word Yes! or No! answer."""
+
+# changes whenever the prompt does, so cached verdicts are not reused across prompts
+PROMPT_VERSION = hashlib.sha256((SYSTEM_PROMPT + USER_PROMPT).encode('utf-8')).hexdigest()[:12]
+
+
+def build_messages(patient_summary, trial_summary):
+    ''' chat messages asking whether a trial is worth considering '''
+    return [
+        {'role': 'system', 'content': SYSTEM_PROMPT},
+        {'role': 'user', 'content': f"Here is a summary of the clinical trial:\n {trial_summary}.\nHere is a summary of the patient:\n" + patient_summary + USER_PROMPT}
+    ]
+
+
+# chat templates for completion endpoints: (start, message, assistant turn)
+CHAT_TEMPLATES = {
+    'llama3': ('<|begin_of_text|>', '<|start_header_id|>{role}<|end_header_id|>\n\n{content}<|eot_id|>', \
+        '<|start_header_id|>assistant<|end_header_id|>\n\n'),
+    'chatml': ('', '<|im_start|>{role}\n{content}<|im_end|>\n', '<|im_start|>assistant\n'),
+    'mistral': ('<s>', '[INST] {content} [/INST]', ''),
+}
+
+
+def build_prompt(patient_summary, trial_summary, template=LOCAL_LLM_TEMPLATE):
+    ''' the same messages rendered with a chat template, for completion
+    endpoints that take a batch of raw prompts. Use the model's own
+    template, see LOCAL_LLM_TEMPLATE. '''
+    start, message, assistant = CHAT_TEMPLATES[template]
+    messages = build_messages(patient_summary, trial_summary)
+    if template == 'mistral':
+        # no system role, it goes in front of the first user turn
+        messages = [{'role': 'user', 'content': '\n\n'.join(x['content'] for x in messages)}]
+    return start + ''.join(message.format(**x) for x in messages) + assistant
+
+
+_VERDICT_RE = re.compile(r'\b(Yes|No)!')
+
+# the prompt's own "Yes! or No!", when a model repeats it, is not a verdict;
+# compared with whitespace, quotes and emphasis removed
+_ECHO_IGNORED_RE = re.compile(r'[\s"\'*_`\u2018\u2019\u201c\u201d]+')
+_ECHO_TAILS = ('oryes!', 'orno!', '/yes!', '/no!')
+_ECHO_HEADS = ('yes!or', 'no!or', 'yes!/', 'no!/')
+
+
+def _echo_key(text):
+    return _ECHO_IGNORED_RE.sub('', text).lower()
+
+
+def _verdicts(msg, final):
+    ''' (verdict, decided) for each Yes!/No! in msg that is not part of an
+    echoed "Yes! or No!". While streaming (final=False) one at the very end
+    is undecided, as the next tokens may still turn it into an echo. '''
+    for match in _VERDICT_RE.finditer(msg):
+        if _echo_key(msg[max(0, match.start() - 16):match.start()]).endswith(_ECHO_HEADS):
+            continue
+        rest = _echo_key(msg[match.end():match.end() + 16])
+        if rest.startswith(_ECHO_TAILS):
+            continue
+        decided = final or not any(x.startswith(rest) for x in _ECHO_TAILS)
+        yield match.group(1) == 'Yes', decided
+
+
+def parse_verdict(msg):
+    ''' the verdict of a complete response, by the same rule as streamed
+    checks: the first Yes!/No! that is not an echo of the prompt's "Yes! or
+    No!"; No when there is none '''
+    return find_verdict(msg, final=True) is True
+
+
+def find_verdict(msg, final=False):
+    ''' the first Yes!/No! verdict in a partial response, or None if none
+    has been generated yet, or the text so far could still be an echo '''
+    for verdict, decided in _verdicts(msg, final):
+        return verdict if decided else None
+    return None
+
+
+def stub_verdict(patient_summary, trial_summary):
+    ''' deterministic pseudo verdict used by the offline stubs '''
+    digest = hashlib.sha256(f'{patient_summary}\n{trial_summary}'.encode('utf-8')).digest()
+    return digest[0] % 2 == 0
+
+
+def stub_response(patient_summary, trial_summary):
+    verdict = "Yes!" if stub_verdict(patient_summary, trial_summary) else "No!"
+    return f"The patient and trial were compared by the offline stub checker.\n{verdict}"
+
+
+class CheckerBackend:
+    ''' asks an LLM whether a trial is a reasonable consideration for a
+    patient. Backends that set supports_batch answer a whole list of trials
+    for one patient in a single request. '''
+
+    name = 'base'
+    model = None
+    supports_batch = False
+    supports_stream = False
+
+    async def check(self, patient_summary, trial_summary):
+        raise NotImplementedError
+
+    async def check_batch(self, patient_summary, trial_summaries):
+        return list(await asyncio.gather(*[self.check(patient_summary, x) for x in trial_summaries]))
+
+    async def stream(self, patient_summary, trial_summary):
+        ''' yields the response text as it is generated; closing the
+        generator cancels the rest of the generation '''
+        raise NotImplementedError
+        yield
+
+    async def check_stream(self, patient_summary, trial_summary, early_exit=CHECKER_EARLY_EXIT):
+        ''' (verdict, reasoning) from a streamed response, returning as soon
+        as the verdict token appears when early_exit is set '''
+        text = ''
+        verdict = None
+        deltas = self.stream(patient_summary, trial_summary)
+        try:
+            async for delta in deltas:
+                text += delta
+                if verdict is None:
+                    verdict = find_verdict(text)
+                    if verdict is not None and early_exit:
+                        break
+        finally:
+            await deltas.aclose()
+        if verdict is None:
+            verdict = parse_verdict(text)
+        return verdict, text
+
+    async def close(self):
+        pass
+
+
+class GroqBackend(CheckerBackend):
+
+    name = 'groq'
+    supports_stream = True
+
+    def __init__(self, model=GROQ_MODEL):
+        self.model = model
+
+        # the SDK is slow to import and only needed with this backend
+        from groq import AsyncGroq
+
+        # retries are handled by the checker
+        self.client = AsyncGroq(api_key=common.GROQ_API_KEY, max_retries=0)
+
+    async def check(self, patient_summary, trial_summary):
+        chat_completion = await self.client.chat.completions.create(
+            messages=build_messages(patient_summary, trial_summary),
+            model=self.model,
+            temperature=0.01,
+            max_tokens=1024,
+            top_p=1,
+            stop=None,
+            stream=False,
+        )
+        return parse_verdict(chat_completion.choices[0].message.content)
+
+    async def stream(self, patient_summary, trial_summary):
+        response = await self.client.chat.completions.create(
+            messages=build_messages(patient_summary, trial_summary),
+            model=self.model,
+            temperature=0.01,
+            max_tokens=1024,
+            top_p=1,
+            stop=None,
+            stream=True,
+        )
+        try:
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await response.close()
+
+
+class OpenAICompatibleBackend(CheckerBackend):
+    ''' any server speaking the OpenAI chat/completions api, e.g. llama.cpp,
+    vLLM or the DFCI hosted model. With batching on (LOCAL_LLM_BATCH=1)
+    a page goes to /v1/completions as a list of prompts rendered with
+    LOCAL_LLM_TEMPLATE, and all of its verdicts arrive together. '''
+
+    name = 'openai'
+    supports_stream = True
+
+    def __init__(self, url=LOCAL_LLM_URL, model=LOCAL_LLM_MODEL, api_key=LOCAL_LLM_KEY, batch=LOCAL_LLM_BATCH, \
+        timeout=LOCAL_LLM_TIMEOUT, template=LOCAL_LLM_TEMPLATE):
+        self.url = url.rstrip('/')
+        self.model = model
+        self.supports_batch = batch
+        if batch and template not in CHAT_TEMPLATES:
+            raise ValueError(f"unknown chat template {template}, expected one of {', '.join(CHAT_TEMPLATES)}")
+        self.template = template
+        self.headers = {"Content-Type": "application/json"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.ssl = None
+        if self.url.startswith('https') and CERT_PEM:
+            self.ssl = ssl.create_default_context(cafile=CERT_PEM)
+        self._session = None
+
+    def _get_session(self):
+        # created lazily so it binds to the server's event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(headers=self.headers, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def _post(self, path, payload):
+        async with self._get_session().post(f'{self.url}{path}', json=payload, ssl=self.ssl) as response:
+            if response.status != 200:
+                text = await response.text()
+                raise aiohttp.ClientResponseError(response.request_info, response.history, \
+                    status=response.status, message=text[:200])
+            return await response.json()
+
+    async def check(self, patient_summary, trial_summary):
+        data = await self._post('/v1/chat/completions', {
+            'model': self.model,
+            'messages': build_messages(patient_summary, trial_summary),
+            'temperature': 0.01,
+            'max_tokens': 1024,
+        })
+        return parse_verdict(data['choices'][0]['message']['content'])
+
+    async def stream(self, patient_summary, trial_summary):
+        payload = {
+            'model': self.model,
+            'messages': build_messages(patient_summary, trial_summary),
+            'temperature': 0.01,
+            'max_tokens': 1024,
+            'stream': True,
+        }
+        async with self._get_session().post(f'{self.url}/v1/chat/completions', json=payload, ssl=self.ssl) as response:
+            if response.status != 200:
+                text = await response.text()
+                raise aiohttp.ClientResponseError(response.request_info, response.history, \
+                    status=response.status, message=text[:200])
+
+            # server sent events, one json chunk per data line
+            finished = False
+            try:
+                async for line in response.content:
+                    line = line.decode('utf-8').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    data = line[len('data:'):].strip()
+                    if data == '[DONE]':
+                        break
+                    choices = json.loads(data).get('choices') or [{}]
+                    delta = choices[0].get('delta', {}).get('content')
+                    if delta:
+                        yield delta
+                finished = True
+            finally:
+                # drop the connection so the server stops generating
+                if not finished:
+                    response.close()
+
+    async def check_batch(self, patient_summary, trial_summaries):
+        if not self.supports_batch:
+            return await super().check_batch(patient_summary, trial_summaries)
+        data = await self._post('/v1/completions', {
+            'model': self.model,
+            'prompt': [build_prompt(patient_summary, x, self.template) for x in trial_summaries],
+            'temperature': 0.01,
+            'max_tokens': 1024,
+        })
+
+        # one verdict per trial, None for any prompt the server did not answer
+        texts = {x['index']: x['text'] for x in data['choices']}
+        if len(texts) != len(trial_summaries):
+            logger.error(f"batch of {len(trial_summaries)} prompts returned {len(texts)} choices")
+        return [parse_verdict(texts[i]) if i in texts else None for i in range(len(trial_summaries))]
+
+
+class StubBackend(CheckerBackend):
+    ''' offline deterministic checker for tests and benchmarks '''
+
+    name = 'stub'
+    model = 'stub'
+    supports_batch = True
+    supports_stream = True
+
+    def __init__(self, latency=STUB_LATENCY):
+        self.latency = latency
+
+    async def check(self, patient_summary, trial_summary):
+        await asyncio.sleep(self.latency)
+        return stub_verdict(patient_summary, trial_summary)
+
+    async def check_batch(self, patient_summary, trial_summaries):
+        await asyncio.sleep(self.latency)
+        return [stub_verdict(patient_summary, x) for x in trial_summaries]
+
+    async def stream(self, patient_summary, trial_summary):
+        words = stub_response(patient_summary, trial_summary).split(' ')
+        for word in words:
+            await asyncio.sleep(self.latency / len(words))
+            yield word + ' '
+
+
+def get_backend(local_llm=False):
+    ''' returns the process wide backend, CHECKER_BACKEND (when set and not
+    empty) overrides the session's local LLM switch '''
+    name = CHECKER_BACKEND
+    if name is None:
+        name = 'openai' if local_llm and LOCAL_LLM_URL else 'groq'
+
+    if name not in _backends:
+        if name == 'groq':
+            _backends[name] = GroqBackend()
+        elif name == 'openai':
+            _backends[name] = OpenAICompatibleBackend()
+        elif name == 'stub':
+            _backends[name] = StubBackend()
+        else:
+            raise ValueError(f"unknown checker backend: {name}")
+    return _backends[name]
@@ -0,0 +1,218 @@
+''' in-process alternative to the AI similarity service. Trial cohort
+embeddings from the fine-tuned SentenceTransformer (notebook 4) are held in
+one contiguous float32 matrix; a patient summary is embedded on CPU and
+scored against every cohort with a single matrix-vector product, then
+reduced to one score per trial by max.
+
+    python local_similarity.py --cohorts trial_cohort_lineitems.csv --model pt_trial_summary.model
+'''
+# system
+import os
+import re
+import asyncio
+import hashlib
+import logging
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+# app
+import caching
+import catalog
+import metrics
+
+# parameters
+load_dotenv()
+COHORT_EMBEDDINGS = os.getenv('COHORT_EMBEDDINGS', os.path.join(catalog.DATA_DIR, 'trial_cohort_embeddings.npy'))
+COHORT_NCT_IDS = os.getenv('COHORT_NCT_IDS', os.path.join(catalog.DATA_DIR, 'trial_cohort_nct_ids.npy'))
+ENCODER_MODEL = os.getenv('ENCODER_MODEL')
+STUB_ENCODER_DIM = int(os.getenv('STUB_ENCODER_DIM', 256))
+
+logger = logging.getLogger(__name__)
+
+# process wide state
+_engine = None
+_engine_lock = threading.Lock()
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+class StubEncoder:
+    ''' offline stand-in for the SentenceTransformer: hashed bag of words,
+    so texts sharing vocabulary still score as similar '''
+
+    def __init__(self, dim=STUB_ENCODER_DIM):
+        self.dim = dim
+
+    def encode(self, texts):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for token in _TOKEN_RE.findall(str(text).lower()):
+                h = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+                out[i, h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        return out
+
+
+class SentenceTransformerEncoder:
+    ''' the fine-tuned patient/trial embedding model, on CPU '''
+
+    def __init__(self, model_path=ENCODER_MODEL, device='cpu'):
+        # heavy and optional, only needed when this encoder is used
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_path, trust_remote_code=True, device=device)
+
+    def encode(self, texts):
+        return self.model.encode(list(texts), convert_to_numpy=True).astype(np.float32)
+
+
+def get_encoder(name=ENCODER_MODEL):
+    if not name:
+        raise ValueError("ENCODER_MODEL is required with SIMILARITY_MODE=local, the model the cohort embeddings "
+            "were built with (or 'stub')")
+    if name == 'stub':
+        return StubEncoder()
+    return SentenceTransformerEncoder(name)
+
+
+def normalize(embeddings):
+    ''' float32 copy with unit length rows '''
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+class LocalSimilarityEngine:
+    ''' scores summaries against every trial cohort in process, or against
+    the candidates of an ANN index for large catalogues '''
+
+    def __init__(self, embeddings, cohort_nct_ids, trial_ids, encoder, cache_items=256, ann=None, \
+        ann_candidates=200):
+        self.encoder = encoder
+        self.trial_ids = pd.Index(trial_ids)
+        self.cache = caching.TTLCache(max_items=cache_items)
+        self.ann = ann
+        self.ann_candidates = ann_candidates
+
+        # keep cohorts of catalog trials, grouped by trial position
+        trial_pos = self.trial_ids.get_indexer(np.asarray(cohort_nct_ids))
+        keep = np.flatnonzero(trial_pos >= 0)
+        order = keep[np.argsort(trial_pos[keep], kind='stable')]
+        self.embeddings = np.ascontiguousarray(normalize(np.asarray(embeddings)[order]))
+        cohort_trial = trial_pos[order]
+
+        # start row of each trial's cohorts, for reduceat
+        self.trial_pos, self.group_starts = np.unique(cohort_trial, return_index=True)
+
+    @classmethod
+    def load(cls, trial_ids, embeddings_path=COHORT_EMBEDDINGS, nct_ids_path=COHORT_NCT_IDS, encoder=None, \
+        model=ENCODER_MODEL):
+        import ann_index  # imports this module
+        check_model(model, embeddings_path)
+        encoder = encoder or get_encoder(model)
+
+        # an ANN index, when built, replaces the dense scan
+        if os.path.exists(ann_index.ANN_INDEX):
+            logger.info(f"scoring the top {ann_index.ANN_CANDIDATES} trials from {ann_index.ANN_INDEX}")
+            return cls(np.zeros((0, 1), dtype=np.float32), np.zeros(0, dtype=str), trial_ids, encoder, \
+                ann=ann_index.get_index(), ann_candidates=ann_index.ANN_CANDIDATES)
+
+        embeddings = np.load(embeddings_path, mmap_mode='r')
+        cohort_nct_ids = np.load(nct_ids_path)
+        return cls(embeddings, cohort_nct_ids, trial_ids, encoder)
+
+    def score(self, summary):
+        ''' max cosine similarity of the summary to each trial's cohorts,
+        NaN for trials with no cohort embeddings. With an ANN index only the
+        best `ann_candidates` trials are scored, the rest are NaN. '''
+        query = normalize(self.encoder.encode([summary]))[0]
+        if self.ann is not None:
+            found = self.ann.search(query, self.ann_candidates, trial_ids=self.trial_ids)
+            return found.reindex(self.trial_ids).astype('float32')
+        cohort_scores = self.embeddings @ query
+        values = np.full(self.trial_ids.shape[0], np.nan, dtype=np.float32)
+        if cohort_scores.shape[0] > 0:
+            values[self.trial_pos] = np.maximum.reduceat(cohort_scores, self.group_starts)
+        return pd.Series(values, index=self.trial_ids, dtype='float32')
+
+    async def similarities(self, summary):
+        ''' same contract as SimilarityClient.similarities; encoding runs in a
+        thread so the event loop keeps serving other sessions '''
+        with metrics.span('similarity', source='local', cache='hit') as s:
+            key = caching.content_key(summary)
+            sr = self.cache.get(key)
+            if sr is None:
+                s.set(cache='miss')
+                sr = await asyncio.to_thread(self.score, summary)
+                self.cache.set(key, sr)
+            return sr
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def model_stamp_path(embeddings_path=COHORT_EMBEDDINGS):
+    ''' where the name of the model that built the embeddings is kept '''
+    return f'{embeddings_path}.model'
+
+
+def check_model(model, embeddings_path=COHORT_EMBEDDINGS):
+    ''' the encoder has to be the one the cohort embeddings were built with,
+    else patient and cohort vectors are not comparable '''
+    if not model:
+        raise ValueError("ENCODER_MODEL is required with SIMILARITY_MODE=local")
+    try:
+        with open(model_stamp_path(embeddings_path)) as fin:
+            stamp = fin.read().strip()
+    except FileNotFoundError:
+        logger.warning(f"no model stamp next to {embeddings_path}, assuming it was built with {model}")
+        return
+    if stamp != model:
+        raise ValueError(f"{embeddings_path} was built with {stamp}, not ENCODER_MODEL={model}")
+
+
+def current_engine(trial_ids):
+    ''' the process wide engine if it covers the given trials, else None '''
+    engine = _engine
+    if engine is not None and engine.trial_ids.equals(pd.Index(trial_ids)):
+        return engine
+    return None
+
+
+def get_engine(trial_ids):
+    ''' returns the process wide engine over the given catalog trials. A
+    new catalog rebuilds the engine but keeps its encoder; the build is
+    slow, call it off the event loop. '''
+    global _engine
+    with _engine_lock:
+        if current_engine(trial_ids) is None:
+            encoder = _engine.encoder if _engine is not None else None
+            _engine = LocalSimilarityEngine.load(trial_ids, encoder=encoder)
+        return _engine
+
+
+def save_embeddings(embeddings, cohort_nct_ids, model, embeddings_path=COHORT_EMBEDDINGS, nct_ids_path=COHORT_NCT_IDS):
+    np.save(embeddings_path, normalize(embeddings))
+    np.save(nct_ids_path, np.asarray(cohort_nct_ids, dtype=str))
+    with open(model_stamp_path(embeddings_path), 'w') as fout:
+        fout.write(model)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cohorts', required=True, help='csv with nct_id and this_cohort columns')
+    parser.add_argument('--model', default=ENCODER_MODEL, required=not ENCODER_MODEL, \
+        help="SentenceTransformer path or 'stub'")
+    args = parser.parse_args()
+
+    # embed every cohort line item
+    cohorts = pd.read_csv(args.cohorts)
+    cohorts = cohorts[~cohorts.this_cohort.isnull()]
+    embeddings = get_encoder(args.model).encode(cohorts.this_cohort.astype(str).tolist())
+    save_embeddings(embeddings, cohorts.nct_id.values, args.model)
+    print(f"wrote {embeddings.shape[0]} cohort embeddings of {cohorts.nct_id.nunique()} trials")
+
+
+if __name__ == '__main__':
+    main()
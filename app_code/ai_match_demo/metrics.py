@@ -0,0 +1,216 @@
+''' timing spans, counters and histograms for the app's hot paths, served in
+the Prometheus text format from a small HTTP server next to Panel.
+
+    with metrics.span('similarity', source='remote') as s:
+        ...
+        s.set(cache='hit')
+
+Every span is observed into the `ai_match_span_seconds` histogram under its
+name and labels, with status="error" when it raised. With
+METRICS_TRACE_DIR set the spans of each browser session are also kept and
+written there as JSON when the session ends.
+'''
+# system
+import os
+import json
+import time
+import logging
+import threading
+import http.server
+from collections import defaultdict
+from dotenv import load_dotenv
+
+# parameters
+load_dotenv()
+METRICS_PORT = int(os.getenv('METRICS_PORT') or 0)
+METRICS_TRACE_DIR = os.getenv('METRICS_TRACE_DIR')
+PREFIX = 'ai_match'
+
+# seconds, from a cached dict lookup to a slow LLM call
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+logger = logging.getLogger(__name__)
+
+# process wide state
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_histograms = dict()
+_traces = dict()
+_server = None
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def inc(name, value=1, **labels):
+    ''' adds to the counter `{PREFIX}_{name}_total` '''
+    with _lock:
+        _counters[(name, _label_key(labels))] += value
+
+
+def observe(name, seconds, **labels):
+    ''' records a duration in the histogram `{PREFIX}_{name}_seconds` '''
+    key = (name, _label_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+class Span:
+    ''' times a stage of the request path; labels can be added before it
+    ends, e.g. the cache outcome once it is known '''
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.seconds = None
+        self._session_id = _session_id() if METRICS_TRACE_DIR else None
+
+    def set(self, **labels):
+        self.labels.update(labels)
+        return self
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._start
+        if exc_type is not None:
+            self.labels.setdefault('status', 'error')
+        observe('span', self.seconds, span=self.name, **self.labels)
+        logger.debug(f"{self.name} {self.seconds * 1000:.1f}ms {self.labels}")
+
+        if self._session_id is not None:
+            record = {'span': self.name, 'start': self._wall, 'seconds': self.seconds, 'labels': self.labels}
+            with _lock:
+                _traces.setdefault(self._session_id, []).append(record)
+        return False
+
+
+def span(name, **labels):
+    return Span(name, labels)
+
+
+def _session_id():
+    ''' the Panel session the current callback belongs to, if any '''
+    try:
+        import panel as pn
+        doc = pn.state.curdoc
+        return doc.session_context.id if doc is not None and doc.session_context is not None else None
+    except Exception:
+        return None
+
+
+def trace_session():
+    ''' keeps this session's spans and dumps them when it is destroyed;
+    a no-op unless METRICS_TRACE_DIR is set '''
+    if not METRICS_TRACE_DIR:
+        return
+    import panel as pn
+    session_id = _session_id()
+    if session_id is not None:
+        with _lock:
+            _traces.setdefault(session_id, [])
+        pn.state.on_session_destroyed(lambda context: dump_trace(context.id))
+
+
+def dump_trace(session_id, directory=METRICS_TRACE_DIR):
+    ''' writes a session's spans to `directory` and forgets them '''
+    with _lock:
+        records = _traces.pop(session_id, None)
+    if not records or not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{time.strftime('%Y%m%dT%H%M%S')}_{session_id}.json")
+    with open(path, 'w') as fout:
+        json.dump({'session_id': session_id, 'spans': records}, fout, indent=1)
+    return path
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def render():
+    ''' every counter and histogram in the Prometheus text format '''
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((k, [list(v[0]), v[1], v[2]]) for k, v in _histograms.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+        metric = f'{PREFIX}_{name}_total'
+        if metric not in typed:
+            typed.add(metric)
+            lines.append(f'# TYPE {metric} counter')
+        lines.append(f'{metric}{_format_labels(labels)} {value:g}')
+
+    for (name, labels), (buckets, total, count) in histograms:
+        metric = f'{PREFIX}_{name}_seconds'
+        if metric not in typed:
+            typed.add(metric)
+            lines.append(f'# TYPE {metric} histogram')
+        for bound, n in zip(BUCKETS, buckets):
+            lines.append(f'{metric}_bucket{_format_labels(labels, [("le", f"{bound:g}")])} {n}')
+        lines.append(f'{metric}_bucket{_format_labels(labels, [("le", "+Inf")])} {count}')
+        lines.append(f'{metric}_sum{_format_labels(labels)} {total:.6f}')
+        lines.append(f'{metric}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def worker_port(port):
+    ''' the metrics port of this process: `panel serve --num-procs N` forks
+    workers numbered 0..N-1 and each serves on port + its number '''
+    from tornado.process import task_id
+    return port + (task_id() or 0)
+
+
+def start_server(port=METRICS_PORT):
+    ''' serves /metrics from a daemon thread, once per process, on this
+    worker's port; a no-op when no port is configured '''
+    global _server
+    if not port or _server is not None:
+        return _server or None
+    with _lock:
+        if _server is None:
+            port = worker_port(port)
+            try:
+                _server = http.server.ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+            except OSError as e:
+                logger.error(f"metrics endpoint not started, port {port} is unavailable: {e}")
+                _server = False
+                return None
+            threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+            logger.info(f"serving metrics on :{port}/metrics (pid {os.getpid()})")
+    return _server or None
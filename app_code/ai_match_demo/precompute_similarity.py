@@ -0,0 +1,189 @@
+''' precomputes the demo patient x trial similarity matrix that replaces the
+hand made trialpatient_sim_nct csv. Trial cohort lines (from trial_summary)
+and demo patient summaries are embedded with the configured encoder in
+length sorted batches spread over a CPU process pool; each trial scores
+the max cosine similarity over its cohorts, as local_similarity.py does.
+The matrix is written as the columnar catalog that DataStore memory maps.
+
+    python precompute_similarity.py --model pt_trial_summary.model [--workers 4] [--check]
+'''
+# system
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+# app
+import catalog
+import local_similarity
+
+logger = logging.getLogger(__name__)
+
+# per worker process state
+_worker_encoder = None
+
+
+def _init_worker(model, threads):
+    ''' loads the encoder once per worker; each gets its own few threads so
+    the pool does not oversubscribe the cores '''
+    global _worker_encoder
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    _worker_encoder = local_similarity.get_encoder(model)
+
+
+def _encode_batch(texts):
+    return local_similarity.normalize(_worker_encoder.encode(texts))
+
+
+def length_batches(texts, batch_size):
+    ''' positions of texts in batches of similar length, longest first, so
+    little of each batch is padding and the slow batches start early '''
+    order = np.argsort([-len(x) for x in texts], kind='stable')
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def embed(texts, model, workers=1, batch_size=64):
+    ''' unit length float32 embeddings of texts, in order '''
+    batches = length_batches(texts, batch_size)
+    parts = [None] * len(batches)
+    if workers <= 1:
+        _init_worker(model, os.cpu_count() or 1)
+        for i, batch in enumerate(batches):
+            parts[i] = _encode_batch([texts[x] for x in batch])
+    else:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, \
+            initargs=(model, threads)) as pool:
+            futures = {pool.submit(_encode_batch, [texts[x] for x in batch]): i for i, batch in enumerate(batches)}
+            for future in concurrent.futures.as_completed(futures):
+                parts[futures[future]] = future.result()
+
+    if not parts:
+        return np.zeros((0, 0), dtype=np.float32)
+    out = np.empty((len(texts), parts[0].shape[1]), dtype=np.float32)
+    for batch, part in zip(batches, parts):
+        out[batch] = part
+    return out
+
+
+def trial_cohorts(trials_df):
+    ''' (trial position, cohort text) of every non-empty trial_summary line '''
+    lines = trials_df['trial_summary'].fillna('').astype(str).str.split('\n').explode().str.strip()
+    lines = lines[lines != '']
+    return trials_df.index.get_indexer(lines.index), lines.tolist()
+
+
+def similarity_matrix(patient_embeddings, cohort_embeddings, cohort_trial, n_trials):
+    ''' patients x trials max cosine similarity over each trial's cohorts,
+    NaN for trials without cohorts '''
+    out = np.full((patient_embeddings.shape[0], n_trials), np.nan, dtype=np.float32)
+    if cohort_embeddings.shape[0] == 0:
+        return out
+    order = np.argsort(cohort_trial, kind='stable')
+    trial_pos, group_starts = np.unique(cohort_trial[order], return_index=True)
+    scores = patient_embeddings @ cohort_embeddings[order].T
+    out[:, trial_pos] = np.maximum.reduceat(scores, group_starts, axis=1)
+    return out
+
+
+def compare_csv(similarity, patient_ids, trial_ids, path=catalog.EXAMPLE_SIM):
+    ''' differences to the hand made csv over the trials and patients both
+    have, plus the top 10 trial overlap per patient '''
+    csv_df = pd.read_csv(path).set_index('nct_id')
+    ours = pd.DataFrame(similarity.T, index=trial_ids, columns=patient_ids)
+    trials = ours.index.intersection(csv_df.index)
+    patients = ours.columns.intersection(csv_df.columns)
+    ours, theirs = ours.loc[trials, patients], csv_df.loc[trials, patients].astype(np.float32)
+    diff = (ours - theirs).abs().to_numpy()
+
+    overlap = []
+    for x in patients:
+        top_ours = set(ours[x].nlargest(10).index)
+        top_theirs = set(theirs[x].nlargest(10).index)
+        overlap.append(len(top_ours & top_theirs) / max(1, len(top_theirs)))
+    return {'trials': len(trials), 'patients': len(patients), 'missing_trials': len(trial_ids) - len(trials), \
+        'max_abs_diff': float(np.nanmax(diff)) if diff.size else 0.0, \
+        'mean_abs_diff': float(np.nanmean(diff)) if diff.size else 0.0, \
+        'top10_overlap': float(np.mean(overlap)) if overlap else 0.0}
+
+
+def install(src, dst):
+    ''' moves a saved catalog into dst, the manifest last as save does, so
+    readers see either catalog but never a mix they would accept '''
+    os.makedirs(dst, exist_ok=True)
+    names = [catalog.CATALOG_TRIALS, catalog.CATALOG_SIM, catalog.CATALOG_PATIENT_IDS, catalog.CATALOG_MANIFEST]
+    for name in names:
+        os.replace(os.path.join(src, name), os.path.join(dst, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help="SentenceTransformer path, or 'stub' with a separate --out")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='encoder processes')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--out', default=catalog.CATALOG_DIR, help='catalog folder')
+    parser.add_argument('--check', action='store_true', help=f'compare with {os.path.basename(catalog.EXAMPLE_SIM)}')
+    parser.add_argument('--tolerance', type=float, default=1e-3, help='largest difference --check accepts')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # stub similarities are for trying the pipeline out, never for the app
+    if args.model == 'stub' and os.path.abspath(args.out) == os.path.abspath(catalog.CATALOG_DIR):
+        parser.error("--model stub would replace the app's catalog, pass a separate --out")
+
+    # inputs, as the app loads them
+    tick = time.perf_counter()
+    catalog.prep_data_folder()
+    patients_df = catalog.load_patients(catalog.EXAMPLE_PATIENTS)
+    trials_df = catalog.load_trials(catalog.EXAMPLE_TRIALS)
+    cohort_trial, cohorts = trial_cohorts(trials_df)
+    print(f"loaded {trials_df.shape[0]} trials ({len(cohorts)} cohorts), {patients_df.shape[0]} patients " \
+        f"in {time.perf_counter() - tick:.2f}s")
+
+    # embed each distinct text once
+    tick = time.perf_counter()
+    texts = pd.unique(pd.Series(cohorts + patients_df['patient_summary'].fillna('').astype(str).tolist()))
+    embeddings = embed(texts.tolist(), args.model, args.workers, args.batch_size)
+    position = pd.Index(texts)
+    cohort_embeddings = embeddings[position.get_indexer(cohorts)]
+    patient_embeddings = embeddings[position.get_indexer(patients_df['patient_summary'].fillna('').astype(str))]
+    secs = time.perf_counter() - tick
+    print(f"embedded {len(texts)} distinct texts with {args.model} on {args.workers} workers in {secs:.2f}s " \
+        f"({len(texts) / max(secs, 1e-9):.1f} texts/s)")
+
+    # score into a scratch folder beside the destination
+    tick = time.perf_counter()
+    similarity = similarity_matrix(patient_embeddings, cohort_embeddings, cohort_trial, trials_df.shape[0])
+    trial_catalog = catalog.TrialCatalog(patients_df, trials_df, similarity, patients_df.index.tolist(), \
+        similarity_origin=f'precomputed:{args.model}')
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.precompute.', dir=os.path.dirname(os.path.abspath(args.out)))
+    try:
+        trial_catalog.save(tmp_dir, sources=catalog.PRECOMPUTED_SOURCES)
+        print(f"computed {similarity.shape[0]} patients x {similarity.shape[1]} trials " \
+            f"in {time.perf_counter() - tick:.2f}s")
+
+        if args.check:
+            result = compare_csv(similarity, patients_df.index, trials_df.index)
+            print(f"vs csv: {result['trials']} trials x {result['patients']} patients compared, " \
+                f"{result['missing_trials']} trials missing from the csv, max |diff| {result['max_abs_diff']:.4f}, " \
+                f"mean |diff| {result['mean_abs_diff']:.4f}, top 10 overlap {result['top10_overlap']:.2f}")
+            if result['max_abs_diff'] > args.tolerance:
+                print(f"similarity differs from the csv by more than {args.tolerance}, {args.out} left as is")
+                sys.exit(1)
+
+        # passed, swap it in
+        install(tmp_dir, args.out)
+        print(f"wrote {args.out}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# system
+import numpy as np
+
+
+def top_k(values, k, threshold=-np.inf):
+    ''' positions of the k largest values >= threshold, best first, using
+    argpartition so only the k winners get sorted '''
+    values = np.asarray(values)
+
+    # compare at the values' precision, so a float32 0.41 is >= 0.41
+    threshold = values.dtype.type(threshold) if values.dtype.kind == 'f' else threshold
+    candidates = np.flatnonzero(values >= threshold)
+    if candidates.shape[0] > k:
+        # ties at the k-th value go to the earliest trials, like a full sort
+        scores = values[candidates]
+        kth = np.partition(-scores, k - 1)[k - 1]
+        above = -scores < kth
+        ties = np.flatnonzero(-scores == kth)[:k - int(above.sum())]
+        above[ties] = True
+        candidates = candidates[above]
+    return candidates[np.argsort(-values[candidates], kind='stable')]
+
+
+class SimilarityRanker:
+    ''' ranks trials by one patient's similarity vector. The vector is sorted
+    once, after which any threshold is a binary search and the top k is a
+    slice, so slider moves do not touch the trial frame at all. '''
+
+    def __init__(self, similarity):
+        self.values = np.asarray(similarity, dtype=np.float32)
+
+        # descending order, missing similarities never rank
+        valid = np.flatnonzero(~np.isnan(self.values))
+        self.order = valid[np.argsort(-self.values[valid], kind='stable')]
+        self._ascending = -self.values[self.order]
+
+    def count_above(self, threshold):
+        ''' number of trials with similarity >= threshold, compared in
+        float32 like the similarities so boundary values are kept '''
+        return int(np.searchsorted(self._ascending, -np.float32(threshold), side='right'))
+
+    def top_k(self, k, threshold=-np.inf):
+        ''' positions of the k most similar trials >= threshold, best first '''
+        return self.order[:min(k, self.count_above(threshold))]
@@ -0,0 +1,136 @@
+# system
+import os
+import ssl
+import asyncio
+import logging
+import aiohttp
+import pandas as pd
+from dotenv import load_dotenv
+
+# app
+import caching
+import catalog
+import metrics
+import local_similarity
+
+# parameters
+load_dotenv()
+AUTH_TOKEN = os.getenv('TOKEN')
+CERT_PEM = os.getenv('CERT_KEYNAME')
+AI_SIMILAR_URL = os.getenv('AI_SIMILAR')
+SIMILARITY_MODE = os.getenv('SIMILARITY_MODE', 'remote')
+SIMILARITY_TIMEOUT = float(os.getenv('SIMILARITY_TIMEOUT', 30))
+SIMILARITY_CONNECT_TIMEOUT = float(os.getenv('SIMILARITY_CONNECT_TIMEOUT', 5))
+SIMILARITY_POOL_SIZE = int(os.getenv('SIMILARITY_POOL_SIZE', 8))
+SIMILARITY_KEEPALIVE = float(os.getenv('SIMILARITY_KEEPALIVE', 60))
+SIMILARITY_CACHE_ITEMS = int(os.getenv('SIMILARITY_CACHE_ITEMS', 256))
+SIMILARITY_CACHE_TTL = float(os.getenv('SIMILARITY_CACHE_TTL', 24 * 3600))
+
+logger = logging.getLogger(__name__)
+
+# process wide state
+_client = None
+
+
+class SimilarityClient:
+    ''' long lived client for the AI similarity service. Keeps a pooled
+    keep-alive connection, coalesces concurrent requests for the same
+    summary into one upstream call and caches summary -> similarity. '''
+
+    def __init__(self, url=AI_SIMILAR_URL, token=AUTH_TOKEN, cafile=CERT_PEM, pool_size=SIMILARITY_POOL_SIZE, \
+        timeout=SIMILARITY_TIMEOUT, connect_timeout=SIMILARITY_CONNECT_TIMEOUT, keepalive=SIMILARITY_KEEPALIVE, \
+        cache_items=SIMILARITY_CACHE_ITEMS, cache_ttl=SIMILARITY_CACHE_TTL):
+        self.url = url
+        self.headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        }
+        self.ssl = ssl.create_default_context(cafile=cafile)
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.cache = caching.TTLCache(max_items=cache_items, ttl=cache_ttl)
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self._inflight = dict()
+        self._session = None
+
+    def _get_session(self):
+        # created lazily so it binds to the server's event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive, ssl=self.ssl)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def similarities(self, summary):
+        ''' similarity of the summary to every trial as a float32 series
+        indexed by nct_id; treat it as read-only, it is shared '''
+        with metrics.span('similarity', source='remote', cache='hit') as s:
+            key = caching.content_key(summary)
+            sr = self.cache.get(key)
+            if sr is not None:
+                return sr
+
+            # join a request already in flight
+            task = self._inflight.get(key)
+            if task is None:
+                s.set(cache='miss')
+                task = asyncio.ensure_future(self._fetch(key, summary))
+                self._inflight[key] = task
+            else:
+                s.set(cache='coalesced')
+                self.coalesced += 1
+
+            # shield so one impatient caller does not cancel the others
+            return await asyncio.shield(task)
+
+    async def _fetch(self, key, summary):
+        try:
+            self.upstream_calls += 1
+            async with self._get_session().post(self.url, json={"summary": summary}) as response:
+                if response.status != 200:
+                    raise aiohttp.ClientError(f"Request failed with status {response.status}")
+                if 'application/json' in response.headers.get('Content-Type', ''):
+                    data = await response.json()
+                else:
+                    text = await response.text()
+                    raise aiohttp.ClientError(f"Unexpected content type: {response.headers.get('Content-Type')}\n{text}")
+
+            sr = pd.Series(data, dtype='float32')
+            self.cache.set(key, sr)
+            return sr
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats.update({'upstream_calls': self.upstream_calls, 'coalesced': self.coalesced})
+        return stats
+
+
+def get_similarity_client():
+    ''' returns the process wide similarity client, or the in-process
+    engine when SIMILARITY_MODE=local, built inline if need be; on the
+    event loop use similarities() '''
+    global _client
+    if SIMILARITY_MODE == 'local':
+        return local_similarity.get_engine(catalog.get_catalog().trials_df.index)
+    if _client is None:
+        _client = SimilarityClient()
+    return _client
+
+
+async def similarities(summary):
+    ''' the summary's similarities from the process wide client. The local
+    engine is built in a thread, at first use and after a catalog swap, so
+    sessions keep being served meanwhile. '''
+    if SIMILARITY_MODE == 'local':
+        trial_ids = catalog.get_catalog().trials_df.index
+        engine = local_similarity.current_engine(trial_ids) \
+            or await asyncio.to_thread(local_similarity.get_engine, trial_ids)
+        return await engine.similarities(summary)
+    return await get_similarity_client().similarities(summary)
@@ -0,0 +1,96 @@
+''' offline stand-in for the checker LLM. Speaks enough of the OpenAI api
+(and Groq's /openai prefix) for llm_backends to run load tests without
+network access; verdicts are deterministic per patient/trial pair.
+
+    python stub_llm_server.py --port 8000 --latency 0.5
+    LOCAL_LLM_URL=http://localhost:8000 CHECKER_BACKEND=openai panel serve app.py
+'''
+# system
+import re
+import json
+import time
+import asyncio
+import argparse
+from aiohttp import web
+
+# app
+import llm_backends
+
+# pull the two summaries back out of the checker prompt
+_PROMPT_RE = re.compile(r"Here is a summary of the clinical trial:\n (.*)\.\nHere is a summary of the patient:\n(.*)" \
+    + re.escape(llm_backends.USER_PROMPT), re.S)
+
+
+def _answer(user_content):
+    match = _PROMPT_RE.search(user_content)
+    if match is None:
+        return "No!"
+    trial_summary, patient_summary = match.groups()
+    return llm_backends.stub_response(patient_summary, trial_summary)
+
+
+def _usage(prompt, text):
+    return {'prompt_tokens': len(prompt.split()), 'completion_tokens': len(text.split()), \
+        'total_tokens': len(prompt.split()) + len(text.split())}
+
+
+async def _stream_chat(request, payload, text):
+    ''' sends the answer word by word as server sent events '''
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+    for word in text.split(' '):
+        chunk = {'id': 'stub', 'object': 'chat.completion.chunk', 'created': int(time.time()), \
+            'model': payload.get('model'), 'choices': [{'index': 0, 'delta': {'content': word + ' '}}]}
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+def create_app(latency=0.0):
+    ''' aiohttp application answering chat and (batched) completion calls
+    after `latency` seconds '''
+
+    async def chat_completions(request):
+        payload = await request.json()
+        await asyncio.sleep(latency)
+        user_content = payload['messages'][-1]['content']
+        text = _answer(user_content)
+        if payload.get('stream'):
+            return await _stream_chat(request, payload, text)
+        return web.json_response({
+            'id': 'stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': payload.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': _usage(user_content, text),
+        })
+
+    async def completions(request):
+        payload = await request.json()
+        await asyncio.sleep(latency)
+        prompts = payload['prompt']
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        texts = [_answer(x) for x in prompts]
+        return web.json_response({
+            'id': 'stub', 'object': 'text_completion', 'created': int(time.time()), 'model': payload.get('model'),
+            'choices': [{'index': i, 'text': x, 'finish_reason': 'stop'} for i, x in enumerate(texts)],
+            'usage': _usage(' '.join(prompts), ' '.join(texts)),
+        })
+
+    app = web.Application()
+    for prefix in ['', '/openai']:
+        app.router.add_post(f'{prefix}/v1/chat/completions', chat_completions)
+        app.router.add_post(f'{prefix}/v1/completions', completions)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before answering')
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency), port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# system
+import os
+import logging
+import threading
+import diskcache
+from dotenv import load_dotenv
+
+# app
+import caching
+import catalog
+import llm_backends
+
+# parameters
+load_dotenv()
+VERDICT_CACHE_DIR = os.getenv('VERDICT_CACHE_DIR', os.path.join(catalog.DATA_DIR, 'verdict_cache'))
+VERDICT_CACHE_ITEMS = int(os.getenv('VERDICT_CACHE_ITEMS', 10000))
+VERDICT_CACHE_BYTES = int(os.getenv('VERDICT_CACHE_BYTES', 256 * 2**20))
+VERDICT_CACHE_TTL = float(os.getenv('VERDICT_CACHE_TTL', 30 * 24 * 3600))
+
+logger = logging.getLogger(__name__)
+
+# process wide state
+_verdict_store = None
+_verdict_store_lock = threading.Lock()
+
+
+class VerdictStore:
+    ''' checker verdicts keyed on a content hash of (patient summary, trial
+    summary, prompt version, model). A bounded in-memory LRU sits in front
+    of an optional diskcache (SQLite) directory, which replicas mounting the
+    same volume share. '''
+
+    def __init__(self, directory=VERDICT_CACHE_DIR, max_items=VERDICT_CACHE_ITEMS, \
+        size_limit=VERDICT_CACHE_BYTES, ttl=VERDICT_CACHE_TTL):
+        self.ttl = ttl
+        self.memory = caching.TTLCache(max_items=max_items, ttl=ttl)
+        self.shared = None
+        if directory:
+            self.shared = diskcache.Cache(directory, size_limit=size_limit, \
+                eviction_policy='least-recently-used')
+
+        # metrics
+        self.shared_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(backend, patient_summary, trial_summary):
+        return caching.content_key(llm_backends.PROMPT_VERSION, f'{backend.name}:{backend.model}', \
+            patient_summary, trial_summary)
+
+    @staticmethod
+    def reasoning_key(key):
+        ''' where the checker's reasoning text for a verdict is kept '''
+        return f'{key}:reasoning'
+
+    def get(self, key):
+        ''' cached verdict or None '''
+        return self.lookup(key)
+
+    def lookup(self, key, count=True):
+        ''' cached verdict or None; with count=False the lookup is left out
+        of the hit rate, e.g. for redrawing a table '''
+        verdict = self.memory.get(key) if count else self.memory.peek(key)
+        if verdict is not None:
+            return verdict
+
+        if self.shared is not None:
+            verdict = self.shared.get(key)
+            if verdict is not None:
+                self.shared_hits += count
+                self.memory.set(key, verdict)
+                return verdict
+
+        self.misses += count
+        return None
+
+    def reasoning(self, key):
+        ''' the reasoning text kept for a verdict's key, or None; not counted
+        in the hit rate, which is about verdicts '''
+        key = self.reasoning_key(key)
+        reasoning = self.memory.peek(key)
+        if reasoning is None and self.shared is not None:
+            reasoning = self.shared.get(key)
+            if reasoning is not None:
+                self.memory.set(key, reasoning)
+        return reasoning
+
+    def set(self, key, verdict):
+        self.memory.set(key, verdict)
+        if self.shared is not None:
+            self.shared.set(key, verdict, expire=self.ttl)
+
+    def stats(self):
+        memory_hits = self.memory.hits
+        total = memory_hits + self.shared_hits + self.misses
+        return {'memory_hits': memory_hits, 'shared_hits': self.shared_hits, 'misses': self.misses, \
+            'hit_rate': (memory_hits + self.shared_hits) / total if total else 0.0, \
+            'memory_items': len(self.memory), 'shared_items': len(self.shared) if self.shared is not None else 0}
+
+
+def get_verdict_store():
+    ''' returns the process wide verdict store '''
+    global _verdict_store
+    if _verdict_store is None:
+        with _verdict_store_lock:
+            if _verdict_store is None:
+                _verdict_store = VerdictStore()
+    return _verdict_store
@@ -1,6 +1,7 @@
 # system
 from datetime import datetime
 import asyncio
+import logging
 import numpy as np
 import pandas as pd
 
@@ -12,8 +13,15 @@ pn.extension('tabulator')
 
 # app
 from data_store import DataStore
+import checker
+import bert_checker
+import llm_backends
+import verdict_cache
+import metrics
 import common
 
+logger = logging.getLogger(__name__)
+
 class View(Viewer):
     data_store = param.ClassSelector(class_=DataStore)
 
@@ -31,8 +39,9 @@ class SidebarView(View):
         self.local_llm_switch = pn.widgets.Switch(name='Local LLM', \
             value=self.data_store.local_llm)
 
-        # link to datastore
-        self.minsim_slider.link(self.data_store, value='minimum_similarity')
+        # link to datastore, only once the slider is released
+        self.minsim_slider.link(self.data_store, value_throttled='minimum_similarity')
+        self.local_llm_switch.link(self.data_store, value='local_llm')
 
 
     def __panel__(self):
@@ -42,7 +51,7 @@ class SidebarView(View):
 Use DFCI hosted LLM (default), or use GROQ.
 """, sizing_mode='stretch_width')
 
-        return pn.Column(
+        column = pn.Column(
             pn.pane.Markdown("""\
 ## Key Parameters
 
@@ -53,6 +62,11 @@ Matches between patients and trials which fall below this threshold are excluded
             #self.local_llm_switch
         )
 
+        # only offer the switch when a local LLM is configured
+        if llm_backends.LOCAL_LLM_URL:
+            column.extend([option2, self.local_llm_switch])
+        return column
+
 class PatientSummaryView(View):
 
     # track when edit button is clicked.
@@ -151,7 +165,7 @@ class HomeView(ContentView):
 
         # update summary
         self.data_store.patient_summary = self.text_area.value
-        print(f"Setting patient summary: {self.data_store.patient_summary}")
+        logger.debug(f"setting patient summary: {self.data_store.patient_summary}")
 
         # swap the view
         self.data_store.patient_view = not self.data_store.patient_view
@@ -223,6 +237,12 @@ class TrialSimilarityView(ContentView):
     # columns to display
     to_display = ['short_title', 'study_status', 'trial_start_dt', 'long_title', 'trial_summary', \
         'study_url']
+
+    # rows in the results table
+    top_k = 10
+
+    # set once the first table is shown
+    _laid_out = False
     
     @staticmethod
     def trial_fn(row):
@@ -244,68 +264,129 @@ class TrialSimilarityView(ContentView):
 ## Study Url
 {row['study_url']}""", sizing_mode='scale_width', css_classes=['wrap-content'])
         col = pn.Column(md)
+
+        # checker reasoning, when it was streamed
+        if isinstance(row.get('reasoning'), str) and row['reasoning']:
+            col.append(pn.pane.Markdown(f"""\
+## Checker reasoning
+{row['reasoning']}""", sizing_mode='scale_width', css_classes=['wrap-content']))
         return col
 
-    @param.depends('data_store.minimum_similarity', watch=True)
+    def _ranked_trials(self):
+        ''' the most similar trials above the threshold '''
+
+        # rank on the similarity vector, then pull text for the shown rows only
+        ranker = self.data_store.ranker
+        pos = ranker.top_k(self.top_k, self.data_store.minimum_similarity)
+        tdf = self.data_store.trials_df.iloc[pos][self.to_display].copy()
+        tdf['Similarity'] = ranker.values[pos]
+
+        # add boolean indicator.
+        tdf['checked'] = pd.Series([None] * len(tdf), dtype=pd.BooleanDtype(), index=tdf.index)
+        tdf['reasoning'] = pd.Series([None] * len(tdf), dtype=object, index=tdf.index)
+
+        # verdicts already cached, e.g. by the warm-up, are shown with the
+        # table; redraws are not counted, checks are
+        try:
+            cached = checker.cached_verdicts(self.data_store.checker_backend, self.data_store.patient_summary, \
+                tdf['trial_summary'].to_dict(), verdict_cache.get_verdict_store(), stream=llm_backends.CHECKER_STREAM, \
+                count=False)
+        except Exception as e:
+            logger.warning(f"unable to read cached verdicts: {e!r}")
+            cached = dict()
+        for nct_id, (verdict, reasoning) in cached.items():
+            tdf.loc[nct_id, 'checked'] = verdict
+            tdf.loc[nct_id, 'reasoning'] = reasoning
+        return tdf
+
+    def _make_table(self, tdf):
+
+        # sanity check.
+        if tdf.shape[0] == 0:
+
+            # no matches
+            return pn.pane.Alert("No trials matched this description.", alert_type="warning")
+
+        # setup tabulator
+        tabulator_formatters = {
+            'Similarity': {'type': 'progress', 'max': 1.0, },
+            'short_title': {'type': 'plaintext', 'title': 'Title'},
+            'checked': {'type': 'tickCross', 'title': 'Checked', 'allowEmpty': True}
+        }
+        titles = {
+            'Similarity': 'Score',
+            'short_title': 'Trial',
+            'checked': 'Checked'
+        }
+        twidths = {
+            'index': '10%',
+            'short_title': '60%',
+            'Similarity': '15%',
+            'checked': '15%'
+        }
+        return pn.widgets.Tabulator(tdf, \
+            formatters=tabulator_formatters, hidden_columns=['nct_id', 'study_status', 'trial_start_dt', 'purpose', \
+                'eligibility_criteria', 'study_url', 'long_title', 'trial_summary', 'reasoning'],\
+                row_content=TrialSimilarityView.trial_fn, widths=twidths, sizing_mode='stretch_width',\
+                titles=titles, page_size=10, pagination='remote', theme="materialize"
+            )
+
     def relayout(self):
 
-        # patient summary
-        self.ps_view = PatientSummaryView(data_store=self.data_store)
+        with metrics.span('relayout'):
 
-        # create simplified view
-        self.tdf = self.data_store.trialsim_df[self.to_display + [self.data_store.active_id]].copy()
-        self.tdf = self.tdf.rename(columns={self.data_store.active_id: 'Similarity'})
+            # patient summary
+            self.ps_view = PatientSummaryView(data_store=self.data_store)
 
-        # apply filters
-        self.tdf = self.tdf[self.tdf.Similarity >= self.data_store.minimum_similarity]
+            # create simplified view
+            self.tdf = self._ranked_trials()
+            self.trial_table = self._make_table(self.tdf)
 
-        # sort it and limit
-        self.tdf = self.tdf.sort_values("Similarity", ascending=False)
-        self.tdf = self.tdf.iloc[0:10]
+    @param.depends('data_store.minimum_similarity', watch=True)
+    def update_threshold(self):
+        ''' applies a new threshold to the existing table, keeping verdicts
+        for rows that stay visible '''
 
-        # add boolean indicator.
-        self.tdf['checked'] = pd.Series([None] * len(self.tdf), dtype=pd.BooleanDtype())
+        # nothing shown yet
+        if not self._laid_out:
+            return
 
-        # sanity check.
-        if self.tdf.shape[0] == 0:
-            
-            # no matches
-            self.trial_table = pn.pane.Alert("No trials matched this description.", alert_type="warning")
+        tdf = self._ranked_trials()
+        if tdf.shape[0] == 0 or not isinstance(self.trial_table, pn.widgets.Tabulator):
+
+            # switching between the table and the no match alert
+            self.trial_table = self._make_table(tdf)
+            self.stack[2] = self.trial_table
 
         else:
 
-            # setup tabulator
-            tabulator_formatters = {
-                'Similarity': {'type': 'progress', 'max': 1.0, },
-                'short_title': {'type': 'plaintext', 'title': 'Title'},
-                'checked': {'type': 'tickCross', 'title': 'Checked', 'allowEmpty': True}
-            }
-            titles = {
-                'Similarity': 'Score',
-                'short_title': 'Trial',
-                'checked': 'Checked'
-            }
-            twidths = {
-                'index': '10%',
-                'short_title': '60%',
-                'Similarity': '15%',
-                'checked': '15%'
-            }
-            self.trial_table = pn.widgets.Tabulator(self.tdf, \
-                formatters=tabulator_formatters, hidden_columns=['nct_id', 'study_status', 'trial_start_dt', 'purpose', \
-                    'eligibility_criteria', 'study_url', 'long_title', 'trial_summary'],\
-                    row_content=TrialSimilarityView.trial_fn, widths=twidths, sizing_mode='stretch_width',\
-                    titles=titles, page_size=10, pagination='remote', theme="materialize"
-                )
-
-    @param.depends('data_store.updated', 'data_store.minimum_similarity', watch=True)
+            # carry over verdicts into the rows the cache left unchecked,
+            # with their reasoning
+            old = self.trial_table.value
+            previous = old.reindex(tdf.index)
+            gap = tdf['checked'].isna()
+            tdf['checked'] = tdf['checked'].astype(pd.BooleanDtype()) \
+                .fillna(previous['checked'].astype(pd.BooleanDtype()))
+            tdf['reasoning'] = tdf['reasoning'].where(~gap, previous['reasoning'])
+
+            # same rows, nothing to send. Tabulator.stream needs a numeric
+            # index so otherwise swap the data on the existing widget
+            if list(tdf.index) == list(old.index):
+                tdf = old
+            else:
+                self.trial_table.value = tdf
+
+        # check anything new
+        self.tdf = tdf
+        if tdf['checked'].isna().any():
+            self.data_store.checking_trials = True
+
+    @param.depends('data_store.updated', watch=True)
     def updated_watcher(self):
-        print("Update watcher called")
         if self.data_store.updated == False:
-            print("no relayout")
             return
 
-        print("yes relayout")
+        logger.debug("relayout")
 
         # recompute everything
         self.relayout()
@@ -313,44 +394,61 @@ class TrialSimilarityView(ContentView):
         # populate view
         self.patient[0] = self.ps_view
         self.stack[2] = self.trial_table
+        self._laid_out = True
         self.data_store.updated = False
 
         # note that we can begin checking these trials
-        print("NEED TO CHECK THESE")
         self.data_store.checking_trials = True
 
     @param.depends('data_store.checking_trials', watch=True)
-    def check_trials(self):
+    async def check_trials(self):
 
-        print("check trials")
         if not self.data_store.checking_trials:
-            print("debounce")
             return
 
-        # bring up the indicator
-        self.stack[1] = pn.indicators.Progress(\
-            name='Indeterminate Progress', active=True, sizing_mode='stretch_width',
-            max = self.trial_table.value.shape[0] - 1, value=0
-        )
-
-        idx = 0
-        for nct_id, row in self.trial_table.value.iterrows():
-
-            # assess quality
-            print("checking", nct_id)
-            trial_summary = row['trial_summary']
-            keep_match = self.data_store.ask_groq_about_trial_loosely(\
-                self.data_store.patient_summary, trial_summary)
-            #keep_match = self.data_store.fake_something()
-
-            # assign it
-            self.trial_table.value.at[nct_id, 'checked'] = keep_match
-            self.trial_table.param.trigger('value')
-
-            # track progress
-            self.stack[1].value = idx
-            self.stack[1].param.trigger('value')
-            idx += 1
+        # keep going while the table has unchecked rows; it can be swapped or
+        # extended while we wait on the checker
+        table = None
+        while isinstance(self.trial_table, pn.widgets.Tabulator):
+            if self.trial_table is not table:
+                table = self.trial_table
+                attempted = set()
+            pending = table.value[table.value['checked'].isna() & ~table.value.index.isin(attempted)]
+            if pending.shape[0] == 0:
+                break
+            attempted.update(pending.index)
+
+            # bring up the indicator
+            self.stack[1] = pn.indicators.Progress(\
+                name='Indeterminate Progress', active=True, sizing_mode='stretch_width',
+                max = pending.shape[0], value=0
+            )
+
+            # check concurrently, filling rows in as they finish; the
+            # classifier loads in a thread the first time
+            trial_summaries = pending['trial_summary'].to_dict()
+            prefilter = await asyncio.to_thread(bert_checker.get_bert_checker)
+            idx = 0
+            with metrics.span('check_trials'):
+                async for nct_id, keep_match, reasoning in checker.check_trials(\
+                    self.data_store.checker_backend, self.data_store.patient_summary, trial_summaries, \
+                    cache=verdict_cache.get_verdict_store(), stream=llm_backends.CHECKER_STREAM, \
+                    prefilter=prefilter):
+                    #keep_match = self.data_store.fake_something()
+
+                    # assign it, unless the row has since gone
+                    logger.debug(f"checked {nct_id}: {keep_match}")
+                    idx += 1
+                    if self.trial_table is table and nct_id in table.value.index:
+                        table.patch({'checked': [(nct_id, keep_match)], 'reasoning': [(nct_id, reasoning)]})
+
+                    # track progress
+                    self.stack[1].value = idx
+
+            # patches only reach a table already on the page; one that is
+            # rendered later is built from the data the widget had when it
+            # was created, so bring that up to date
+            table.param.trigger('value')
 
         # reset this
         self.data_store.checking_trials = False
@@ -369,6 +467,7 @@ sources.
         self.trial_table = pn.pane.Markdown("waiting...")
 
         # update content
+        self._laid_out = False
         self.stack = pn.Column(header, pn.Spacer(), self.trial_table)
         self.gspec[:, 0:2] = self.patient
         self.gspec[:, 2:8] = self.stack
@@ -0,0 +1,144 @@
+''' background warm-up of the demo patients. Most visitors match the demo
+patient they land on, so for every one of them the similarities and the
+checker verdicts of the trials their results table shows are computed
+ahead of time into the app's caches: the similarity client's cache and the
+verdict store. It runs on the server's event loop when a worker starts
+serving and again after a catalog refresh, a few patients at a time.
+
+    python warmup.py    # fills the shared verdict cache, e.g. before a deploy
+'''
+# system
+import os
+import time
+import asyncio
+import logging
+import argparse
+from dotenv import load_dotenv
+
+# app
+import catalog
+import checker
+import metrics
+import ranking
+import bert_checker
+import llm_backends
+import verdict_cache
+import similarity_client
+from data_store import DataStore
+from views import TrialSimilarityView
+
+# parameters
+load_dotenv()
+WARMUP = os.getenv('WARMUP', '0') == '1'
+WARMUP_CONCURRENCY = int(os.getenv('WARMUP_CONCURRENCY', 2))
+
+logger = logging.getLogger(__name__)
+
+# process wide state
+_loop = None
+_task = None
+
+
+async def warm_patient(trial_catalog, patient_id, backend, top_k, threshold, cache, prefilter):
+    ''' caches one demo patient's similarities and the verdicts for the
+    trials its results table would show; returns the number of verdicts '''
+    summary = trial_catalog.patients_df.loc[patient_id, 'patient_summary']
+    with metrics.span('warmup_patient'):
+
+        # the same similarities and ranking a session ends up with
+        sr = await similarity_client.similarities(summary)
+        similarity = trial_catalog.patient_similarity(patient_id)
+        similarity.update(sr)
+        pos = ranking.SimilarityRanker(similarity.values).top_k(top_k, threshold)
+        trial_summaries = trial_catalog.trials_df['trial_summary'].iloc[pos].to_dict()
+
+        checked = 0
+        async for _, verdict, _ in checker.check_trials(backend, summary, trial_summaries, cache=cache, \
+            stream=llm_backends.CHECKER_STREAM, prefilter=prefilter):
+            checked += verdict is not None
+        return checked
+
+
+async def warm_up(trial_catalog=None, concurrency=WARMUP_CONCURRENCY, top_k=TrialSimilarityView.top_k, \
+    threshold=DataStore.param['minimum_similarity'].default):
+    ''' warms every demo patient, `concurrency` at a time. Checks go through
+    the shared rate limiter, so sessions are served alongside. '''
+    trial_catalog = trial_catalog or await asyncio.to_thread(catalog.get_catalog)
+    backend = llm_backends.get_backend(DataStore.param['local_llm'].default)
+    cache = verdict_cache.get_verdict_store()
+    prefilter = await asyncio.to_thread(bert_checker.get_bert_checker)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _warm(patient_id):
+        async with semaphore:
+            try:
+                return await warm_patient(trial_catalog, patient_id, backend, top_k, threshold, cache, prefilter)
+            except Exception as e:
+                logger.warning(f"warm-up of {patient_id} failed: {e!r}")
+                return 0
+
+    tick = time.perf_counter()
+    patient_ids = trial_catalog.patients_df.index
+    checked = await asyncio.gather(*[_warm(x) for x in patient_ids])
+    logger.info(f"warmed {len(patient_ids)} demo patients, {sum(checked)} verdicts, " \
+        f"in {time.perf_counter() - tick:.1f}s")
+    return sum(checked)
+
+
+async def _restart(trial_catalog=None):
+    ''' replaces a warm-up still running for an older catalog '''
+    global _task
+    if _task is not None:
+        _task.cancel()
+    _task = asyncio.ensure_future(warm_up(trial_catalog))
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        logger.exception("warm-up failed")
+
+
+def schedule(trial_catalog=None):
+    ''' (re)starts the warm-up on the server's loop, from any thread '''
+    if _loop is not None:
+        asyncio.run_coroutine_threadsafe(_restart(trial_catalog), _loop)
+
+
+def start():
+    ''' warms up this worker once, from the server's event loop, and again
+    whenever catalog.refresh swaps in a new catalog; a no-op unless WARMUP=1 '''
+    global _loop
+    if not WARMUP or _loop is not None:
+        return
+    try:
+        _loop = asyncio.get_running_loop()
+    except RuntimeError:
+        logger.info("no server loop, skipping warm-up")
+        return
+    catalog.on_refresh(schedule)
+    schedule()
+
+
+async def _warm_up_once(concurrency):
+    try:
+        await warm_up(concurrency=concurrency)
+    finally:
+        for client in [similarity_client.get_similarity_client(), \
+            llm_backends.get_backend(DataStore.param['local_llm'].default)]:
+            if hasattr(client, 'close'):
+                await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=WARMUP_CONCURRENCY, help='patients warmed at once')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # only the verdicts outlive this process, in VERDICT_CACHE_DIR
+    asyncio.run(_warm_up_once(args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
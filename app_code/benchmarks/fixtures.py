@@ -0,0 +1,172 @@
+''' offline fixtures for the benchmarks: synthetic trial catalogues in the
+layout catalog.py reads, and local stand-ins for the AI similarity service
+and the checker LLM, served from a background thread with configurable
+latency. The app is pointed at them through its usual environment
+variables, see app_env. '''
+# system
+import os
+import sys
+import json
+import socket
+import asyncio
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+# the app uses flat imports from its own folder
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ai_match_demo')
+APP_DIR = os.path.normpath(APP_DIR)
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+CANCERS = ['non-small cell lung cancer', 'small cell lung cancer', 'breast cancer', 'colorectal cancer', \
+    'pancreatic adenocarcinoma', 'melanoma', 'prostate cancer', 'ovarian cancer', 'glioblastoma', \
+    'head and neck squamous cell carcinoma', 'renal cell carcinoma', 'urothelial carcinoma']
+BIOMARKERS = ['EGFR L858R mutant', 'ALK rearranged', 'KRAS G12C mutant', 'HER2 positive', 'BRCA1/2 mutant', \
+    'MSI-high', 'BRAF V600E mutant', 'PD-L1 >= 50%', 'NTRK fusion', 'PIK3CA mutant', 'IDH1 mutant']
+TREATMENTS = ['previously treated with osimertinib (third-generation EGFR TKI)', 'no prior systemic therapy', \
+    'progressed on platinum-based chemotherapy', 'prior immunotherapy (PD-1 inhibitor) required', \
+    'previously treated with trastuzumab (HER2-directed antibody)', 'no prior immunotherapy', \
+    'after one or two prior lines of therapy']
+STAGES = ['Metastatic', 'Locally advanced or metastatic', 'Stage III unresectable', 'Newly diagnosed']
+
+PATIENT_IDS_PREFIX = 'bench'
+
+
+def _cohort(rng):
+    return f"{rng.choice(STAGES)} {rng.choice(CANCERS)}, {rng.choice(BIOMARKERS)}, {rng.choice(TREATMENTS)}."
+
+
+def make_catalog(directory, n_trials, n_patients=20, seed=0):
+    ''' writes demo_patients.csv, trial_nct.june10.csv and the similarity
+    csv for a synthetic catalogue of n_trials trials; returns the folder.
+    An existing catalogue of the same size is reused. '''
+    os.makedirs(directory, exist_ok=True)
+    stamp_path = os.path.join(directory, 'fixture.json')
+    stamp = {'n_trials': n_trials, 'n_patients': n_patients, 'seed': seed}
+    if os.path.exists(stamp_path):
+        with open(stamp_path) as f:
+            if json.load(f) == stamp:
+                return directory
+
+    rng = np.random.default_rng(seed)
+    ids = [f'NCT{10000000 + i:08d}' for i in range(n_trials)]
+    summaries = ['\n'.join(f'{j + 1}. {_cohort(rng)}' for j in range(rng.integers(1, 5))) for _ in range(n_trials)]
+    starts = pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 3650, n_trials), unit='D')
+    pd.DataFrame({
+        'nct_id': ids,
+        'identificationModule.briefTitle': [f'Study {i} in {rng.choice(CANCERS)}' for i in range(n_trials)],
+        'statusModule.overallStatus': rng.choice(['RECRUITING', 'NOT_YET_RECRUITING', 'ACTIVE_NOT_RECRUITING'], n_trials),
+        'statusModule.startDateStruct.date': starts.strftime('%Y-%m-%d'),
+        'identificationModule.officialTitle': [f'A Phase {rng.integers(1, 4)} Study, trial {i}' for i in range(n_trials)],
+        'descriptionModule.detailedDescription': [f'Detailed description of trial {i}. ' * 10 for i in range(n_trials)],
+        'trial_summary': summaries,
+    }).to_csv(os.path.join(directory, 'trial_nct.june10.csv'), index=False)
+
+    patient_ids = [f'{PATIENT_IDS_PREFIX}{i:03d}' for i in range(n_patients)]
+    pd.DataFrame({'patient_id': patient_ids, 'patient_summary': [f'Patient with {_cohort(rng)}' for _ in patient_ids]}) \
+        .to_csv(os.path.join(directory, 'demo_patients.csv'), index=False)
+
+    similarity = pd.DataFrame(rng.random((n_trials, n_patients), dtype=np.float32).round(4), columns=patient_ids)
+    similarity.insert(0, 'nct_id', ids)
+    similarity.to_csv(os.path.join(directory, 'trialpatient_sim_nct.june10.csv'), index=False)
+
+    with open(stamp_path, 'w') as f:
+        json.dump(stamp, f)
+    return directory
+
+
+def patient_summaries(directory):
+    return pd.read_csv(os.path.join(directory, 'demo_patients.csv'))['patient_summary'].tolist()
+
+
+def similarity_app(trial_ids, latency=0.0):
+    ''' stand-in for the AI similarity service: POST {"summary": ...}
+    answers {nct_id: similarity} for every trial, the same for the same
+    summary, after `latency` seconds '''
+    trial_ids = list(trial_ids)
+
+    async def similar(request):
+        payload = await request.json()
+        await asyncio.sleep(latency)
+        seed = int.from_bytes(hashlib.blake2b(payload['summary'].encode('utf-8'), digest_size=8).digest(), 'little')
+        values = np.random.default_rng(seed).random(len(trial_ids)).round(4)
+        return web.json_response(dict(zip(trial_ids, values.tolist())))
+
+    app = web.Application(client_max_size=2**24)
+    app.router.add_post('/{tail:.*}', similar)
+    return app
+
+
+def llm_app(latency=0.0):
+    ''' OpenAI/Groq compatible checker stand-in, see stub_llm_server.py.
+    Importing it imports llm_backends, so set the app environment first. '''
+    import stub_llm_server
+    return stub_llm_server.create_app(latency)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class BackgroundServer:
+    ''' serves an aiohttp app on localhost from its own thread and event
+    loop, so it keeps answering while the caller blocks '''
+
+    def __init__(self, app, port=None):
+        self.app = app
+        self.port = port or free_port()
+        self.url = local_url(self.port)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._runner = None
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    async def _start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', self.port).start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def local_url(port):
+    return f'http://127.0.0.1:{port}'
+
+
+def app_env(data_dir, similarity_url, llm_url, cache_dir, **overrides):
+    ''' environment pointing the app at the synthetic catalogue and stubs.
+    The rate limit is lifted unless set explicitly, so it is the app that
+    gets measured; CHECKER_RATE=3 reproduces the Groq limit. '''
+    env = dict(os.environ)
+    env.update({
+        'DATA_DIR': data_dir,
+        'ARTIFACT_SOURCE': 'none',
+        'AI_SIMILAR': f'{similarity_url}/similar',
+        'SIMILARITY_MODE': 'remote',
+        'LOCAL_LLM_URL': llm_url,
+        'CHECKER_BACKEND': 'openai',
+        'VERDICT_CACHE_DIR': cache_dir,
+        'BERT_CHECKER_MODEL': '',
+    })
+    env.setdefault('CHECKER_RATE', '1000')
+    env.setdefault('CHECKER_BURST', '1000')
+    env.update({k: str(v) for k, v in overrides.items()})
+    return env
@@ -0,0 +1,267 @@
+''' multi-session load test of `panel serve app.py`. Serves a synthetic
+catalogue against the stub similarity and LLM services, then opens N
+concurrent bokeh client sessions that land straight on the results page
+(?summary=...&force_go_to_results=1) and reports p50/p99 of time to the
+first results table and time until every shown trial is checked.
+
+    python load_driver.py --trials 10000 --sessions 1 8 32 --llm-latency 0.5
+    python load_driver.py --url http://localhost:5006/app --sessions 8
+'''
+# system
+import os
+import sys
+import json
+import time
+import math
+import random
+import asyncio
+import argparse
+import tempfile
+import importlib
+import pkgutil
+import subprocess
+import urllib.request
+import numpy as np
+import pandas as pd
+
+# benchmarks
+import fixtures
+import microbench
+
+MAX_MESSAGE_SIZE = 20 * 2**20
+
+
+def _load_panel_models():
+    ''' the client deserializes panel's bokeh models, which are only known
+    once their modules are imported '''
+    import panel.models
+    for module in pkgutil.iter_modules(panel.models.__path__):
+        importlib.import_module(f'panel.models.{module.name}')
+
+
+def _is_checked(value):
+    return value is not None and not (isinstance(value, float) and math.isnan(value))
+
+
+class BokehSession:
+    ''' a bokeh client session driven from asyncio with bokeh's public
+    protocol classes: pulls the document, then applies the server's patches
+    as they arrive '''
+
+    def __init__(self, url, arguments):
+        from bokeh.client.util import websocket_url_for_server_url
+        from bokeh.util.strings import format_url_query_arguments
+        self.url = format_url_query_arguments(websocket_url_for_server_url(url), arguments)
+        self.document = None
+        self._socket = None
+
+    async def __aenter__(self):
+        from tornado.httpclient import HTTPRequest
+        from tornado.websocket import websocket_connect
+        from bokeh.document import Document
+        from bokeh.protocol import Protocol
+        from bokeh.protocol.receiver import Receiver
+        from bokeh.client.websocket import WebSocketClientConnectionWrapper
+        from bokeh.util.token import generate_jwt_token, generate_session_id
+
+        token = generate_jwt_token(generate_session_id())
+        socket = await websocket_connect(HTTPRequest(self.url), subprotocols=['bokeh', token], \
+            max_message_size=MAX_MESSAGE_SIZE)
+        self._socket = WebSocketClientConnectionWrapper(socket)
+        self._protocol = Protocol()
+        self._receiver = Receiver(self._protocol)
+        await self._expect('ACK')
+
+        request = self._protocol.create('PULL-DOC-REQ')
+        await request.send(self._socket)
+        reply = await self._expect('PULL-DOC-REPLY')
+        self.document = Document()
+        reply.push_to_document(self.document)
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._socket is not None:
+            self._socket.close(1000, 'done')
+
+    async def receive(self):
+        ''' the next message from the server, None once it has closed '''
+        while True:
+            fragment = await self._socket.read_message()
+            if fragment is None:
+                return None
+            message = await self._receiver.consume(fragment)
+            if message is not None:
+                return message
+
+    async def _expect(self, msgtype):
+        ''' the next message of msgtype; patches sent before the document is
+        pulled are already part of it and are skipped, like bokeh's client does '''
+        while True:
+            message = await self.receive()
+            if message is None:
+                raise RuntimeError(f"server closed the session before {msgtype}")
+            if message.msgtype == msgtype:
+                return message
+            if message.msgtype != 'PATCH-DOC':
+                raise RuntimeError(f"expected {msgtype} from the server, got {message.msgtype}")
+
+    async def updates(self):
+        ''' applies each patch of the document, yielding after each '''
+        while True:
+            message = await self.receive()
+            if message is None:
+                return
+            if message.msgtype == 'PATCH-DOC':
+                message.apply_to_document(self.document)
+                yield
+
+
+async def run_session(url, summary, timeout):
+    ''' one client session; returns seconds to the first results table and
+    to all of its rows checked (None when not reached before timeout) '''
+    result = {'first_result': None, 'all_checked': None, 'error': None}
+    tick = time.perf_counter()
+
+    async def _watch():
+        async with BokehSession(url, {'summary': summary, 'force_go_to_results': '1'}) as session:
+            async for _ in session.updates():
+                tables = [x for x in session.document.models if type(x).__name__ == 'DataTabulator' \
+                    and len(x.source.data.get('checked', [])) > 0]
+                if not tables:
+                    continue
+                now = time.perf_counter() - tick
+                if result['first_result'] is None:
+                    result['first_result'] = now
+                if all(_is_checked(x) for table in tables for x in table.source.data['checked']):
+                    result['all_checked'] = now
+                    return
+
+    try:
+        await asyncio.wait_for(_watch(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    except Exception as e:
+        result['error'] = repr(e)
+    return result
+
+
+async def _run_sessions(url, summaries, n_sessions, timeout, ramp):
+    async def _start(i):
+        await asyncio.sleep(ramp * i / max(1, n_sessions))
+        return await run_session(url, summaries[i % len(summaries)], timeout)
+    return await asyncio.gather(*[_start(i) for i in range(n_sessions)])
+
+
+def run_load(url, summaries, n_sessions, timeout, ramp=0.0):
+    ''' n_sessions concurrent sessions, started over `ramp` seconds '''
+    tick = time.perf_counter()
+    results = asyncio.run(_run_sessions(url, summaries, n_sessions, timeout, ramp))
+    wall = time.perf_counter() - tick
+
+    report = {'sessions': n_sessions, 'wall_s': wall, 'errors': sum(x['error'] is not None for x in results)}
+    for metric in ['first_result', 'all_checked']:
+        values = np.array([x[metric] for x in results if x[metric] is not None])
+        report[f'{metric}_done'] = int(values.shape[0])
+        report[f'{metric}_p50_s'] = float(np.percentile(values, 50)) if values.shape[0] else None
+        report[f'{metric}_p99_s'] = float(np.percentile(values, 99)) if values.shape[0] else None
+    errors = [x['error'] for x in results if x['error'] is not None]
+    if errors:
+        print(f"{len(errors)} sessions failed, first: {errors[0]}", file=sys.stderr)
+    return report
+
+
+def wait_until_live(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"panel serve exited with {process.returncode}")
+        try:
+            with urllib.request.urlopen(f'{base_url}/liveness', timeout=1) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.25)
+    raise RuntimeError(f"panel serve did not come up within {timeout}s")
+
+
+def serve_app(data_dir, similarity_url, llm_url, cache_dir, log_path, num_procs=1, **env_overrides):
+    ''' starts `panel serve app.py` against the stubs, returns (process, url) '''
+    port = fixtures.free_port()
+    command = ['panel', 'serve', 'app.py', '--port', str(port), '--address', '127.0.0.1', \
+        '--allow-websocket-origin', f'127.0.0.1:{port}', '--liveness', '--num-procs', str(num_procs)]
+    env = fixtures.app_env(data_dir, similarity_url, llm_url, cache_dir, **env_overrides)
+    process = subprocess.Popen(command, cwd=fixtures.APP_DIR, env=env, stdout=open(log_path, 'w'), \
+        stderr=subprocess.STDOUT)
+    base_url = fixtures.local_url(port)
+    try:
+        wait_until_live(base_url, process)
+    except Exception:
+        process.terminate()
+        raise
+    return process, f'{base_url}/app'
+
+
+def print_reports(reports):
+    print(f"{'sessions':>8} {'errors':>6} {'first p50':>10} {'first p99':>10} {'checked p50':>12} " \
+        f"{'checked p99':>12} {'complete':>8} {'wall s':>8}")
+    fmt = lambda x: '-' if x is None else f"{x:.2f}"
+    for x in reports:
+        print(f"{x['sessions']:>8} {x['errors']:>6} {fmt(x['first_result_p50_s']):>10} " \
+            f"{fmt(x['first_result_p99_s']):>10} {fmt(x['all_checked_p50_s']):>12} " \
+            f"{fmt(x['all_checked_p99_s']):>12} {x['all_checked_done']:>8} {x['wall_s']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='drive an already running app instead of starting one')
+    parser.add_argument('--trials', type=int, default=1000, help='synthetic catalogue size')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 8, 32], help='concurrent sessions per run')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='seconds the LLM stub takes per call')
+    parser.add_argument('--similarity-latency', type=float, default=0.2, help='seconds the similarity stub takes')
+    parser.add_argument('--num-procs', type=int, default=1, help='panel serve worker processes')
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds over which sessions are started')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds a session may take')
+    parser.add_argument('--warm', action='store_true', help='reuse the demo patient summaries across runs, ' \
+        'so caches are warm; by default every session gets a new summary')
+    parser.add_argument('--data', default=microbench.DEFAULT_DATA, help='where synthetic catalogues are kept')
+    parser.add_argument('--save', help='write the results here as json')
+    args = parser.parse_args()
+
+    _load_panel_models()
+    data_dir = fixtures.make_catalog(os.path.join(args.data, f'trials_{args.trials}'), args.trials)
+    base_summaries = fixtures.patient_summaries(data_dir)
+
+    def _summaries(run, n):
+        if args.warm:
+            return base_summaries
+        return [f'{base_summaries[i % len(base_summaries)]} (run {run}, session {i}, {random.random():.6f})' \
+            for i in range(n)]
+
+    reports = []
+    if args.url:
+        for run, n in enumerate(args.sessions):
+            reports.append(run_load(args.url, _summaries(run, n), n, args.timeout, args.ramp))
+    else:
+        trial_ids = pd.read_csv(os.path.join(data_dir, 'trial_nct.june10.csv'), usecols=['nct_id'])['nct_id']
+        log_path = os.path.join(args.data, 'panel_serve.log')
+        with fixtures.BackgroundServer(fixtures.similarity_app(trial_ids, args.similarity_latency)) as similarity, \
+            fixtures.BackgroundServer(fixtures.llm_app(args.llm_latency)) as llm, \
+            tempfile.TemporaryDirectory() as cache_dir:
+            process, url = serve_app(data_dir, similarity.url, llm.url, cache_dir, log_path, args.num_procs)
+            print(f"serving {args.trials} trials at {url}, log in {log_path}", file=sys.stderr)
+            try:
+                for run, n in enumerate(args.sessions):
+                    reports.append(run_load(url, _summaries(run, n), n, args.timeout, args.ramp))
+            finally:
+                process.terminate()
+                process.wait()
+
+    print_reports(reports)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), 'runs': reports}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
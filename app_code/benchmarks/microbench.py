@@ -0,0 +1,197 @@
+''' microbenchmarks of the app's hot paths against synthetic catalogues and
+the stub services: catalog loading, DataStore.__init__, similarity fetch,
+TrialSimilarityView.relayout and checker.check_trials. Each catalogue size
+runs in a fresh process, since the app reads its settings at import.
+
+    python microbench.py --trials 100 1000 10000 50000 --save before.json
+    python microbench.py --trials 100 1000 10000 50000 --baseline before.json
+'''
+# system
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+# benchmarks
+import fixtures
+
+DEFAULT_DATA = os.path.join(tempfile.gettempdir(), 'ai_match_bench')
+
+
+def summarize(seconds):
+    ''' milliseconds summary of repeated timings '''
+    ms = np.asarray(seconds) * 1000
+    return {'n': int(ms.shape[0]), 'min_ms': float(ms.min()), 'median_ms': float(np.median(ms)), \
+        'p90_ms': float(np.percentile(ms, 90))}
+
+
+def timed(fn, repeat):
+    seconds = []
+    for _ in range(repeat):
+        tick = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - tick)
+    return summarize(seconds)
+
+
+async def atimed(fn, repeat):
+    seconds = []
+    for i in range(repeat):
+        tick = time.perf_counter()
+        await fn(i)
+        seconds.append(time.perf_counter() - tick)
+    return summarize(seconds)
+
+
+async def _bench(data_dir, repeat, stream):
+    ''' runs in the child, with the environment already pointing at the stubs '''
+    # app
+    import catalog
+    import checker
+    import views
+    import verdict_cache
+    import similarity_client
+    from data_store import DataStore
+
+    results = dict()
+    patients_df = catalog.load_patients(catalog.EXAMPLE_PATIENTS)
+
+    # catalog, from the csv files and from the columnar copy
+    results['load_trials'] = timed(lambda: catalog.load_trials(catalog.EXAMPLE_TRIALS), repeat)
+    results['catalog_from_csv'] = timed(lambda: catalog.TrialCatalog.from_csv(patients_df), repeat)
+    shutil.rmtree(catalog.CATALOG_DIR, ignore_errors=True)
+    catalog.TrialCatalog.load()
+    results['catalog_from_columnar'] = timed(lambda: catalog.TrialCatalog.from_columnar(catalog.CATALOG_DIR, \
+        patients_df), repeat)
+
+    # a session's data store, the first in a worker loads the catalog
+    def _cold_init():
+        catalog._catalog = None
+        DataStore()
+    results['datastore_init_cold'] = timed(_cold_init, repeat)
+    results['datastore_init'] = timed(DataStore, repeat)
+
+    # similarity service round trip, uncached and cached
+    client = similarity_client.get_similarity_client()
+    summaries = fixtures.patient_summaries(data_dir)
+    results['similarity_uncached'] = await atimed(lambda i: client.similarities(f'{summaries[0]} {i}'), repeat)
+    results['similarity_cached'] = await atimed(lambda i: client.similarities(summaries[0]), repeat)
+
+    # the results table for one patient
+    data_store = DataStore()
+    await data_store._update_trial_similarity()
+    view = views.TrialSimilarityView(data_store=data_store)
+    view.__panel__()
+    results['relayout'] = timed(view.relayout, repeat)
+
+    # checking the shown trials, against the LLM stub and from the cache
+    trial_summaries = view.tdf['trial_summary'].to_dict()
+    backend = data_store.checker_backend
+
+    async def _check(cache, patient_summary, stream=False):
+        async for _ in checker.check_trials(backend, patient_summary, trial_summaries, cache=cache, stream=stream):
+            pass
+
+    results['check_trials_uncached'] = await atimed(lambda i: _check(None, f'{summaries[0]} {i}'), repeat)
+    if stream:
+        results['check_trials_stream'] = await atimed(lambda i: _check(None, f'{summaries[0]} {i}', True), repeat)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        store = verdict_cache.VerdictStore(directory=cache_dir)
+        await _check(store, summaries[0])
+        results['check_trials_cached'] = await atimed(lambda i: _check(store, summaries[0]), repeat)
+        store.shared.close()
+
+    await client.close()
+    return results
+
+
+def run_child(args):
+    ''' one catalogue size, stubs served from this process '''
+    data_dir = fixtures.make_catalog(os.path.join(args.data, f'trials_{args.child}'), args.child)
+    trial_ids = pd.read_csv(os.path.join(data_dir, 'trial_nct.june10.csv'), usecols=['nct_id'])['nct_id']
+
+    # the app reads its environment at import, so set it before anything is imported
+    similarity_port, llm_port = fixtures.free_port(), fixtures.free_port()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ.update(fixtures.app_env(data_dir, fixtures.local_url(similarity_port), \
+            fixtures.local_url(llm_port), cache_dir))
+        with fixtures.BackgroundServer(fixtures.similarity_app(trial_ids, args.similarity_latency), similarity_port), \
+            fixtures.BackgroundServer(fixtures.llm_app(args.llm_latency), llm_port):
+            results = asyncio.run(_bench(data_dir, args.repeat, args.stream))
+    with open(args.result, 'w') as f:
+        json.dump(results, f)
+
+
+def run_size(n_trials, args):
+    with tempfile.NamedTemporaryFile(suffix='.json') as result:
+        command = [sys.executable, os.path.abspath(__file__), '--child', str(n_trials), '--result', result.name, \
+            '--data', args.data, '--repeat', str(args.repeat), '--llm-latency', str(args.llm_latency), \
+            '--similarity-latency', str(args.similarity_latency)] + (['--stream'] if args.stream else [])
+        process = subprocess.run(command, capture_output=True, text=True)
+        if process.returncode != 0:
+            raise RuntimeError(f"benchmark of {n_trials} trials failed:\n{process.stderr[-4000:]}")
+        with open(result.name) as f:
+            return json.load(f)
+
+
+def report(results, baseline=None):
+    ''' median ms per benchmark and catalogue size, with the ratio to the
+    baseline run when given '''
+    sizes = list(results)
+    names = list(dict.fromkeys(name for x in results.values() for name in x))
+    print(f"{'median ms':<24}" + ''.join(f"{x + ' trials':>22}" for x in sizes))
+    for name in names:
+        row = f"{name:<24}"
+        for size in sizes:
+            value = results[size].get(name, {}).get('median_ms')
+            cell = '-' if value is None else f"{value:.2f}"
+            before = (baseline or {}).get(size, {}).get(name, {}).get('median_ms')
+            if value is not None and before:
+                cell += f" ({value / before:.2f}x)"
+            row += f"{cell:>22}"
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, nargs='+', default=[100, 1000, 10000, 50000], help='catalogue sizes')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='seconds the LLM stub takes per call')
+    parser.add_argument('--similarity-latency', type=float, default=0.05, help='seconds the similarity stub takes')
+    parser.add_argument('--stream', action='store_true', help='also time streamed checks')
+    parser.add_argument('--data', default=DEFAULT_DATA, help='where synthetic catalogues are kept')
+    parser.add_argument('--save', help='write the results here as json')
+    parser.add_argument('--baseline', help='results of an earlier --save to compare with')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(args)
+        return
+
+    results = dict()
+    for n_trials in args.trials:
+        tick = time.perf_counter()
+        results[str(n_trials)] = run_size(n_trials, args)
+        print(f"{n_trials} trials done in {time.perf_counter() - tick:.1f}s", file=sys.stderr)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
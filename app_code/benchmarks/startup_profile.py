@@ -0,0 +1,113 @@
+''' cold start profile of an app worker: time to import the app's modules,
+load the catalog and build the first session, each in a fresh interpreter
+as on a pod start or a `panel serve --autoreload` cycle, plus the import
+time per top-level package from `python -X importtime`.
+
+    python startup_profile.py --save before.json
+    python startup_profile.py --baseline before.json
+'''
+# system
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+from collections import defaultdict
+import pandas as pd
+
+# benchmarks
+import fixtures
+import microbench
+
+# runs in the child, before anything else is imported
+CHILD = '''
+import sys, json, time
+tick = time.perf_counter()
+sys.path.insert(0, {app_dir!r})
+phases = dict()
+import views
+phases['import_modules'] = time.perf_counter() - tick
+import catalog
+catalog.get_catalog()
+phases['catalog_load'] = time.perf_counter() - tick - sum(phases.values())
+import app
+phases['first_session'] = time.perf_counter() - tick - sum(phases.values())
+json.dump(phases, sys.stdout)
+'''
+
+
+def parse_importtime(stderr):
+    ''' microseconds of import time per top-level package '''
+    packages = defaultdict(int)
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = [x.strip() for x in line[len('import time:'):].split('|')]
+        packages[name.split('.')[0]] += int(self_us)
+    return packages
+
+
+def run_once(env):
+    ''' one cold start; returns (phase seconds, import us per package) '''
+    command = [sys.executable, '-X', 'importtime', '-c', CHILD.format(app_dir=fixtures.APP_DIR)]
+    tick = time.perf_counter()
+    process = subprocess.run(command, cwd=fixtures.APP_DIR, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - tick
+    if process.returncode != 0:
+        raise RuntimeError(f"startup failed:\n{process.stderr[-4000:]}")
+    phases = json.loads(process.stdout.strip().splitlines()[-1])
+    phases['process'] = wall
+    return phases, parse_importtime(process.stderr)
+
+
+def profile(env, repeat):
+    ''' timing summaries per phase and the median import ms per package '''
+    runs = [run_once(env) for _ in range(repeat)]
+    results = {name: microbench.summarize([x[0][name] for x in runs]) for name in runs[0][0]}
+    packages = defaultdict(list)
+    for _, x in runs:
+        for name, us in x.items():
+            packages[name].append(us / 1000)
+    imports = {name: sorted(ms)[len(ms) // 2] for name, ms in packages.items()}
+    return results, dict(sorted(imports.items(), key=lambda x: -x[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=1000, help='synthetic catalogue size')
+    parser.add_argument('--data-dir', help='profile against this data folder instead of a synthetic catalogue')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='packages to list by import time')
+    parser.add_argument('--data', default=microbench.DEFAULT_DATA, help='where synthetic catalogues are kept')
+    parser.add_argument('--save', help='write the results here as json')
+    parser.add_argument('--baseline', help='results of an earlier --save to compare with')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or fixtures.make_catalog(os.path.join(args.data, f'trials_{args.trials}'), args.trials)
+
+    # the first session asks for its similarities, nothing is checked yet
+    trial_ids = pd.read_csv(os.path.join(data_dir, 'trial_nct.june10.csv'), usecols=['nct_id'])['nct_id']
+    with fixtures.BackgroundServer(fixtures.similarity_app(trial_ids)) as similarity, \
+        tempfile.TemporaryDirectory() as cache_dir:
+        env = fixtures.app_env(data_dir, similarity.url, similarity.url, cache_dir, METRICS_PORT=0, \
+            ARTIFACT_REFRESH_SECONDS=0)
+        results, imports = profile(env, args.repeat)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    microbench.report({str(args.trials): results}, baseline and {str(args.trials): baseline['phases']})
+    print(f"\n{'import ms':<24}{'median':>10}")
+    for name, ms in list(imports.items())[:args.top]:
+        print(f"{name:<24}{ms:>10.1f}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'phases': results, 'imports': imports}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
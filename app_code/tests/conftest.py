@@ -0,0 +1,13 @@
+''' puts the app's flat modules on the path and keeps them offline '''
+# system
+import os
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ai_match_demo')
+sys.path.insert(0, APP_DIR)
+
+# read at import by the app modules; set before any test imports them
+os.environ['ARTIFACT_SOURCE'] = 'none'
+os.environ['ARTIFACT_REFRESH_SECONDS'] = '0'
+os.environ['METRICS_PORT'] = ''
+os.environ['WARMUP'] = '0'
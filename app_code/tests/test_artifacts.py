@@ -0,0 +1,99 @@
+# system
+import os
+import json
+import pytest
+
+# app
+import artifacts
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    source = tmp_path / 'bucket'
+    source.mkdir()
+    (source / 'trials.csv').write_text('nct_id\nNCT1\n')
+    (source / 'patients.csv').write_text('patient_id\nP1\n')
+    return artifacts.LocalBucket(str(source))
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    return tmp_path / 'data'
+
+
+def local_paths(data_dir):
+    return {x: str(data_dir / x) for x in ('trials.csv', 'patients.csv')}
+
+
+def test_sync_downloads_and_records_versions(bucket, data_dir):
+    paths = local_paths(data_dir)
+    assert sorted(artifacts.sync(paths, str(data_dir), bucket=bucket)) == ['patients.csv', 'trials.csv']
+    assert (data_dir / 'trials.csv').read_text() == 'nct_id\nNCT1\n'
+
+    manifest = json.loads((data_dir / artifacts.MANIFEST_NAME).read_text())
+    for name in paths:
+        assert manifest[name] == bucket.stat(name)
+        assert manifest[name]['md5'] == artifacts.md5_base64(paths[name])
+
+    # nothing changed, nothing fetched
+    assert artifacts.sync(paths, str(data_dir), bucket=bucket) == []
+
+
+def test_sync_fetches_only_changed_blobs(bucket, data_dir):
+    paths = local_paths(data_dir)
+    artifacts.sync(paths, str(data_dir), bucket=bucket)
+
+    trials = os.path.join(bucket.directory, 'trials.csv')
+    with open(trials, 'w') as fout:
+        fout.write('nct_id\nNCT1\nNCT2\n')
+    os.utime(trials, ns=(os.stat(trials).st_atime_ns, os.stat(trials).st_mtime_ns + 10**9))
+    assert artifacts.sync(paths, str(data_dir), bucket=bucket) == ['trials.csv']
+    assert (data_dir / 'trials.csv').read_text() == 'nct_id\nNCT1\nNCT2\n'
+
+
+def test_sync_refetches_a_deleted_local_copy(bucket, data_dir):
+    paths = local_paths(data_dir)
+    artifacts.sync(paths, str(data_dir), bucket=bucket)
+    os.remove(paths['patients.csv'])
+    assert artifacts.sync(paths, str(data_dir), bucket=bucket) == ['patients.csv']
+
+
+class CorruptBucket(artifacts.LocalBucket):
+    ''' serves different bytes than its md5 promises '''
+
+    def download(self, name, path, generation):
+        with open(path, 'w') as fout:
+            fout.write('truncated')
+
+
+def test_md5_mismatch_keeps_the_local_copy(bucket, data_dir):
+    paths = local_paths(data_dir)
+    artifacts.sync(paths, str(data_dir), bucket=bucket)
+    manifest = (data_dir / artifacts.MANIFEST_NAME).read_text()
+
+    trials = os.path.join(bucket.directory, 'trials.csv')
+    with open(trials, 'w') as fout:
+        fout.write('nct_id\nNCT1\nNCT2\n')
+    os.utime(trials, ns=(os.stat(trials).st_atime_ns, os.stat(trials).st_mtime_ns + 10**9))
+
+    with pytest.raises(IOError, match='md5'):
+        artifacts.sync(paths, str(data_dir), bucket=CorruptBucket(bucket.directory))
+    assert (data_dir / 'trials.csv').read_text() == 'nct_id\nNCT1\n'
+    assert (data_dir / artifacts.MANIFEST_NAME).read_text() == manifest
+    assert not [x for x in os.listdir(data_dir) if x.endswith('.tmp')]
+
+
+def test_missing_blob_raises(bucket, data_dir):
+    paths = dict(local_paths(data_dir), **{'similarity.csv': str(data_dir / 'similarity.csv')})
+    with pytest.raises(FileNotFoundError, match='similarity.csv'):
+        artifacts.sync(paths, str(data_dir), bucket=bucket)
+
+
+def test_unreachable_source_keeps_local_copies(bucket, data_dir, tmp_path):
+    paths = local_paths(data_dir)
+    artifacts.sync(paths, str(data_dir), bucket=bucket)
+    assert artifacts.sync(paths, str(data_dir), source=str(tmp_path / 'gone')) == []
+
+    os.remove(paths['trials.csv'])
+    with pytest.raises(FileNotFoundError):
+        artifacts.sync(paths, str(data_dir), source=str(tmp_path / 'gone'))
@@ -0,0 +1,74 @@
+# system
+import time
+import asyncio
+import pytest
+
+# app
+import checker
+
+
+def test_token_bucket_bursts_then_limits():
+    async def acquire(bucket, n):
+        tick = time.perf_counter()
+        for _ in range(n):
+            await bucket.acquire()
+        return time.perf_counter() - tick
+
+    # the burst is free, each token after it takes 1 / rate
+    assert asyncio.run(acquire(checker.TokenBucket(rate=20, capacity=5), 5)) < 0.05
+    assert asyncio.run(acquire(checker.TokenBucket(rate=20, capacity=2), 6)) >= 0.18
+
+
+class Flaky:
+    ''' fails with the given errors, then answers '''
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def __call__(self, x):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return x
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    ''' delays asked for by the retry loop, without waiting for them '''
+    delays = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay, *args):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(asyncio, 'sleep', fake_sleep)
+    monkeypatch.setattr(checker.random, 'random', lambda: 0.0)
+    return delays
+
+
+def test_call_with_retries_backs_off_exponentially(sleeps):
+    fn = Flaky(ConnectionError(), asyncio.TimeoutError(), ConnectionError())
+    limiter = checker.TokenBucket(rate=1000, capacity=1000)
+    result = asyncio.run(checker.call_with_retries(fn, 'ok', retries=3, backoff=0.5, limiter=limiter))
+    assert result == 'ok'
+    assert fn.calls == 4
+    assert sleeps == [0.5, 1.0, 2.0]
+
+
+def test_call_with_retries_gives_up(sleeps):
+    fn = Flaky(ConnectionError(), ConnectionError(), ConnectionError())
+    limiter = checker.TokenBucket(rate=1000, capacity=1000)
+    with pytest.raises(ConnectionError):
+        asyncio.run(checker.call_with_retries(fn, 'ok', retries=2, backoff=0.5, limiter=limiter))
+    assert fn.calls == 3
+
+
+def test_call_with_retries_does_not_retry_client_errors(sleeps):
+    fn = Flaky(ValueError('bad request'))
+    limiter = checker.TokenBucket(rate=1000, capacity=1000)
+    with pytest.raises(ValueError):
+        asyncio.run(checker.call_with_retries(fn, 'ok', retries=3, limiter=limiter))
+    assert fn.calls == 1
+    assert sleeps == []
@@ -0,0 +1,63 @@
+# system
+import asyncio
+import pytest
+
+# app
+import llm_backends
+
+RESPONSES = [
+    ('The patient fits the cohort.\nYes!', True),
+    ('No! The trial is for a different cancer type.', False),
+    ('I must answer Yes! or No! The biomarker matches.\nYes!', True),
+    ('Answering with a one-word "Yes!" or "No!" answer: No!', False),
+    ('Verdict (Yes!/No!): **Yes!**', True),
+    ('Should I say No! / Yes! here? Yes!', True),
+    ('Yes! or No!', False),
+    ('No verdict given.', False),
+]
+
+
+class ScriptedBackend(llm_backends.CheckerBackend):
+    ''' streams a fixed response a few characters at a time '''
+
+    supports_stream = True
+
+    def __init__(self, response, step=3):
+        self.response = response
+        self.step = step
+        self.sent = 0
+
+    async def stream(self, patient_summary, trial_summary):
+        for i in range(0, len(self.response), self.step):
+            self.sent = i + self.step
+            yield self.response[i:i + self.step]
+
+
+@pytest.mark.parametrize('response, verdict', RESPONSES)
+def test_echoed_instruction_is_not_a_verdict(response, verdict):
+    assert llm_backends.parse_verdict(response) is verdict
+
+
+@pytest.mark.parametrize('response, verdict', RESPONSES)
+@pytest.mark.parametrize('step', [1, 3, 7])
+def test_streamed_verdict_matches_the_complete_one(response, verdict, step):
+    backend = ScriptedBackend(response, step)
+    streamed, _ = asyncio.run(backend.check_stream('patient', 'trial', early_exit=True))
+    assert streamed is verdict
+
+
+def test_early_exit_stops_after_the_verdict():
+    backend = ScriptedBackend('Yes! or No!, I will answer Yes!\n' + 'more reasoning ' * 20, step=1)
+    verdict, text = asyncio.run(backend.check_stream('patient', 'trial', early_exit=True))
+    # decided by the first character that cannot continue an echo
+    assert verdict is True
+    assert text == 'Yes! or No!, I will answer Yes!\nm'
+
+
+def test_partial_verdict_waits_for_what_follows():
+    assert llm_backends.find_verdict('Answer Yes!') is None
+    assert llm_backends.find_verdict('Answer Yes! o') is None
+    assert llm_backends.find_verdict('Answer Yes! or No!') is None
+    assert llm_backends.find_verdict('Answer Yes!\n') is None
+    assert llm_backends.find_verdict('Answer Yes!\nThe') is True
+    assert llm_backends.find_verdict('Answer Yes!', final=True) is True
@@ -0,0 +1,37 @@
+# system
+import socket
+import urllib.request
+import tornado.process
+
+# app
+import metrics
+
+
+def test_workers_serve_consecutive_ports(monkeypatch):
+    assert metrics.worker_port(9464) == 9464
+    monkeypatch.setattr(tornado.process, 'task_id', lambda: 3)
+    assert metrics.worker_port(9464) == 9467
+
+
+def test_serves_metrics_and_survives_a_taken_port(monkeypatch, caplog):
+    taken = socket.socket()
+    taken.bind(('0.0.0.0', 0))
+    taken.listen()
+    port = taken.getsockname()[1]
+    try:
+        monkeypatch.setattr(metrics, '_server', None)
+        assert metrics.start_server(port) is None
+        assert 'metrics endpoint not started' in caplog.text
+        assert metrics.start_server(port) is None
+    finally:
+        taken.close()
+
+    monkeypatch.setattr(metrics, '_server', None)
+    server = metrics.start_server(port)
+    try:
+        metrics.inc('test_requests', route='x')
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+            assert 'ai_match_test_requests_total{route="x"} 1' in response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,41 @@
+# system
+import numpy as np
+
+# app
+import ranking
+
+
+def test_top_k_best_first_above_threshold():
+    values = np.array([0.1, 0.9, 0.5, 0.7, 0.3], dtype=np.float32)
+    assert ranking.top_k(values, 3).tolist() == [1, 3, 2]
+    assert ranking.top_k(values, 10, 0.5).tolist() == [1, 3, 2]
+    assert ranking.top_k(values, 10, 0.95).tolist() == []
+
+
+def test_top_k_threshold_is_inclusive_at_float32():
+    ''' a float32 0.41 ranks against the slider's float64 0.41 '''
+    values = np.array([0.41, 0.2], dtype=np.float32)
+    assert ranking.top_k(values, 5, 0.41).tolist() == [0]
+    assert ranking.SimilarityRanker(values).count_above(0.41) == 1
+
+
+def test_top_k_ties_keep_catalog_order():
+    values = np.array([0.5, 0.8, 0.5, 0.8, 0.5], dtype=np.float32)
+    assert ranking.top_k(values, 5).tolist() == [1, 3, 0, 2, 4]
+    assert ranking.SimilarityRanker(values).top_k(5).tolist() == [1, 3, 0, 2, 4]
+
+
+def test_missing_similarities_never_rank():
+    values = np.array([np.nan, 0.2, np.nan, 0.6], dtype=np.float32)
+    assert ranking.top_k(values, 5).tolist() == [3, 1]
+    ranker = ranking.SimilarityRanker(values)
+    assert ranker.top_k(5).tolist() == [3, 1]
+    assert ranker.count_above(0.0) == 2
+
+
+def test_ranker_matches_top_k():
+    rng = np.random.default_rng(0)
+    values = np.round(rng.random(500), 2).astype(np.float32)
+    ranker = ranking.SimilarityRanker(values)
+    for k, threshold in [(10, 0.0), (10, 0.5), (50, 0.9), (1000, 0.33)]:
+        assert ranker.top_k(k, threshold).tolist() == ranking.top_k(values, k, threshold).tolist()
@@ -0,0 +1,62 @@
+# system
+import time
+
+# app
+import llm_backends
+import verdict_cache
+
+
+def test_key_ignores_whitespace_but_not_model():
+    stub = llm_backends.StubBackend()
+    key = verdict_cache.VerdictStore.key(stub, 'a  patient\nsummary', 'trial')
+    assert key == verdict_cache.VerdictStore.key(stub, 'a patient summary ', 'trial')
+    assert key != verdict_cache.VerdictStore.key(stub, 'a patient summary', 'other trial')
+
+    other = llm_backends.StubBackend()
+    other.model = 'stub-2'
+    assert key != verdict_cache.VerdictStore.key(other, 'a patient summary', 'trial')
+
+
+def test_memory_entries_expire():
+    store = verdict_cache.VerdictStore(directory=None, ttl=0.05)
+    store.set('k', True)
+    assert store.get('k') is True
+    time.sleep(0.1)
+    assert store.get('k') is None
+
+
+def test_shared_between_stores(tmp_path):
+    first = verdict_cache.VerdictStore(directory=str(tmp_path))
+    first.set('k', False)
+    first.set(first.reasoning_key('k'), 'why not')
+
+    second = verdict_cache.VerdictStore(directory=str(tmp_path))
+    assert second.get('k') is False
+    assert second.reasoning('k') == 'why not'
+    assert second.stats()['shared_hits'] == 1
+
+    # now in its memory
+    assert second.get('k') is False
+    assert second.stats()['memory_hits'] == 1
+
+
+def test_shared_entries_expire(tmp_path):
+    first = verdict_cache.VerdictStore(directory=str(tmp_path), ttl=0.05)
+    first.set('k', True)
+    time.sleep(0.1)
+    assert verdict_cache.VerdictStore(directory=str(tmp_path)).get('k') is None
+
+
+def test_uncounted_lookups_leave_the_hit_rate_alone():
+    store = verdict_cache.VerdictStore(directory=None)
+    store.set('k', True)
+    store.set(store.reasoning_key('k'), 'because')
+    assert store.lookup('k', count=False) is True
+    assert store.lookup('missing', count=False) is None
+    assert store.reasoning('k') == 'because'
+    stats = store.stats()
+    assert (stats['memory_hits'], stats['shared_hits'], stats['misses']) == (0, 0, 0)
+
+    store.get('k')
+    store.get('missing')
+    assert store.stats()['hit_rate'] == 0.5
@@ -0,0 +1,2 @@
+''' reusable stages of the offline trial matching pipeline, shared by the
+numbered notebooks in the parent directory '''
@@ -0,0 +1,181 @@
+''' overlapping chunks of long EHR documents for RAG (notebook 1). Chunks
+are (start, end) character spans into the original string, produced lazily
+from word boundaries found with numpy a block at a time, so a multi-megabyte
+note history is never split into a word list and each chunk is one slice.
+
+    python -m trial_pipeline.chunking --mb 8
+'''
+# system
+import re
+import time
+import logging
+import argparse
+import tracemalloc
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_SPACE_RE = re.compile(r'\s')
+
+# str.isspace() as a lookup table; every whitespace code point is below
+# 0x3001, and higher code points are clipped onto the last (non space) entry
+_SPACE_TABLE = np.array([chr(x).isspace() for x in range(0x3002)], dtype=bool)
+
+
+def _words(text, block=2**20):
+    ''' (starts, ends) arrays of the whitespace separated words of text,
+    a block of about `block` characters at a time '''
+    pos = 0
+    while pos < len(text):
+        end = pos + block
+        if end < len(text):
+            # do not cut a word in half
+            match = _SPACE_RE.search(text, end)
+            end = match.start() if match else len(text)
+        else:
+            end = len(text)
+
+        # one code point per element, a byte each for plain ascii notes
+        part = text[pos:end]
+        if part.isascii():
+            codes = np.frombuffer(part.encode('ascii'), dtype=np.uint8)
+        else:
+            codes = np.minimum(np.frombuffer(part.encode('utf-32-le'), dtype=np.uint32), 0x3001)
+
+        # words start after a space and end before one
+        space = np.concatenate([[True], _SPACE_TABLE[codes], [True]])
+        word = ~space
+        yield np.flatnonzero(space[:-1] & word[1:]) + pos, np.flatnonzero(word[:-1] & space[1:]) + pos
+        pos = end
+
+
+def word_spans(text, chunk_size=100, overlap=10):
+    ''' yields (start, end) spans of chunk_size words, each starting
+    chunk_size - overlap words after the last. Like the old split_text the
+    final chunk is the last chunk_size words, but it is never repeated. '''
+    if overlap >= chunk_size:
+        raise ValueError("overlap must be smaller than chunk_size")
+    step = chunk_size - overlap
+
+    # word spans not yet consumed, starting at word number `offset`
+    starts = ends = np.zeros(0, dtype=np.int64)
+    offset = 0
+    next_start = 0
+    emitted_to = 0
+    for block_starts, block_ends in _words(text):
+        starts = np.concatenate([starts, block_starts])
+        ends = np.concatenate([ends, block_ends])
+        total = offset + starts.shape[0]
+
+        # every chunk whose words have all been seen
+        first = np.arange(next_start, total - chunk_size + 1, step)
+        if first.shape[0] > 0:
+            yield from zip(starts[first - offset].tolist(), ends[first - offset + chunk_size - 1].tolist())
+            next_start = int(first[-1]) + step
+            emitted_to = int(first[-1]) + chunk_size
+
+        # keep what the next chunk or the tail can still need
+        keep = max(offset, min(next_start, total - chunk_size))
+        starts, ends = starts[keep - offset:], ends[keep - offset:]
+        offset = keep
+
+    # the last chunk_size words, if they run past the last full chunk
+    total = offset + starts.shape[0]
+    if total > emitted_to:
+        yield int(starts[max(0, total - chunk_size) - offset]), int(ends[-1])
+
+
+def token_spans(text, tokenizer, chunk_size=256, overlap=32):
+    ''' the same windows counted in tokenizer tokens rather than words;
+    needs a fast tokenizer for the character offsets '''
+    if overlap >= chunk_size:
+        raise ValueError("overlap must be smaller than chunk_size")
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)['offset_mapping']
+    step = chunk_size - overlap
+    start = 0
+    while start < len(offsets):
+        end = min(start + chunk_size, len(offsets))
+        if end == len(offsets) and start > 0:
+            start = max(0, end - chunk_size)
+        yield offsets[start][0], offsets[end - 1][1]
+        if end == len(offsets):
+            return
+        start += step
+
+
+def chunks(text, chunk_size=100, overlap=10, tokenizer=None):
+    ''' yields the chunk strings; by tokens when a tokenizer is given '''
+    if tokenizer is None:
+        spans = word_spans(text, chunk_size, overlap)
+    else:
+        spans = token_spans(text, tokenizer, chunk_size, overlap)
+    for start, end in spans:
+        yield text[start:end]
+
+
+def split_text(text, chunk_size=100, overlap=10):
+    ''' list form of chunks(), a drop-in for the notebook function '''
+    return list(chunks(text, chunk_size, overlap))
+
+
+def _split_text_words(text, chunk_size=100, overlap=10):
+    ''' the original notebook 1 implementation, kept for the benchmark '''
+    words = text.split()
+    out = []
+    current_index = 0
+    while current_index < len(words):
+        end_index = current_index + chunk_size
+        out.append(' '.join(words[current_index:end_index]))
+        current_index = end_index - overlap
+        if len(words) - current_index < chunk_size:
+            out.append(' '.join(words[-chunk_size:]))
+            break
+    return out
+
+
+def benchmark(mb=8, chunk_size=100, overlap=10, seed=0):
+    ''' throughput and peak memory of the word list chunker against span
+    chunking (spans only, and lazily sliced chunks) on a synthetic note
+    history of `mb` megabytes '''
+    import random
+    rng = random.Random(seed)
+    vocabulary = ['patient', 'tumor', 'EGFR', 'carboplatin', 'pemetrexed', 'CT', 'chest', 'nodule', 'stage', \
+        'IV', 'adenocarcinoma', 'mg/m2', 'cycle', 'progression', 'biopsy', 'PD-L1', '50%', 'history', 'of']
+    words = []
+    size = 0
+    while size < mb * 2**20:
+        word = rng.choice(vocabulary)
+        words.append(word + ('\n' if rng.random() < 0.05 else ' '))
+        size += len(word) + 1
+    text = ''.join(words)
+
+    results = dict()
+    for name, fn in [('split_text', _split_text_words), ('word_spans', lambda *x: list(word_spans(*x))), \
+        ('chunks', lambda *x: sum(1 for _ in chunks(*x)))]:
+        tick = time.perf_counter()
+        n = fn(text, chunk_size, overlap)
+        secs = time.perf_counter() - tick
+
+        # peak allocation, in a separate run since tracing is slow
+        tracemalloc.start()
+        fn(text, chunk_size, overlap)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {'chunks': n if isinstance(n, int) else len(n), 'seconds': secs, 'mb_per_s': mb / secs, \
+            'peak_mb': peak / 2**20}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mb', type=float, default=8, help='size of the synthetic note history')
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--overlap', type=int, default=10)
+    args = parser.parse_args()
+    for name, result in benchmark(args.mb, args.chunk_size, args.overlap).items():
+        print(f"{name}: {result['chunks']} chunks in {result['seconds']:.3f}s ({result['mb_per_s']:.1f} MB/s), " \
+            f"peak {result['peak_mb']:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+''' asks llama whether each trial cohort is a reasonable consideration for
+each patient (notebook 3). Duplicate (patient summary, cohort) pairs are
+checked once, requests fan out over every model server given, and results
+go to an append-only JSON lines checkpoint so an interrupted run resumes
+where it stopped.
+
+    python -m trial_pipeline.cohort_checks --candidates candidates.csv \
+        --endpoints http://gpu0:8000 http://gpu1:8000 --out cohort_specific_eligibility_checks.jsonl
+'''
+# system
+import time
+import asyncio
+import logging
+import argparse
+import pandas as pd
+
+# pipeline
+from . import store
+from . import llm_workers
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = """You are a brilliant oncologist with encyclopedic knowledge about cancer and its treatment. 
+    Your job is to evaluate whether a given clinical trial is a reasonable consideration for a patient, given a clinical trial summary and a patient summary.\n"""
+
+USER_PROMPT = """
+Base your judgment on whether the patient generally fits the cancer type(s), prior treatment(s), and biomarker criteria specified for the trial.
+You do not have to determine if the patient is actually eligible; instead please just evaluate whether it is reasonable for the trial to be considered further by the patient's oncologist.
+Some trials have biomarker requirements that are not assessed until formal eligibility screening begins; please ignore these requirements.
+Reason step by step, then answer the question "Is this trial a reasonable consideration for this patient?" with a one-word Yes! or No! answer."""
+
+# results of a different prompt are not reused
+PROMPT_VERSION = store.content_key(SYSTEM_PROMPT, USER_PROMPT)[:12]
+
+
+def build_messages(patient_summary, trial_summary):
+    return [{'role': 'system', 'content': SYSTEM_PROMPT}, \
+        {'role': 'user', 'content': "Here is a summary of the clinical trial:\n" + trial_summary + \
+            "\nHere is a summary of the patient:\n" + patient_summary + USER_PROMPT}]
+
+
+def parse_result(response):
+    if "Yes!" in response:
+        return 1.0
+    return 0.0
+
+
+def ask_about_trial_loosely(patient_summary, trial_summary, llama_model):
+    ''' checks one pair with an in-process llama_cpp model '''
+    outputs = llama_model.create_chat_completion(messages=build_messages(patient_summary, trial_summary))
+    response = outputs['choices'][0]['message']['content']
+    return outputs, response, parse_result(response)
+
+
+def pair_key(patient_summary, trial_summary):
+    return store.content_key(PROMPT_VERSION, patient_summary, trial_summary)
+
+
+def unique_pairs(candidates, trial_column='this_cohort'):
+    ''' one row per distinct (patient_summary, trial text) pair, keyed '''
+    pairs = candidates[['patient_summary', trial_column]].astype(str).drop_duplicates()
+    pairs['key'] = [pair_key(x, y) for x, y in zip(pairs['patient_summary'], pairs[trial_column])]
+    return pairs.drop_duplicates('key')
+
+
+async def check_pairs(candidates, endpoints, out_path, trial_column='this_cohort', per_endpoint=2, model=None, \
+    progress_every=100):
+    ''' checks every candidate pair not already in `out_path` and returns
+    the candidates with llama_response and eligibility_result columns '''
+    checkpoint = store.JsonlStore(out_path)
+    pairs = unique_pairs(candidates, trial_column)
+    done = checkpoint.keys()
+    pending = pairs[~pairs['key'].isin(done)]
+    print(f"{pairs.shape[0]} unique pairs of {candidates.shape[0]}, {len(done)} already checked, " \
+        f"{pending.shape[0]} to go on {len(endpoints)} endpoints")
+
+    finished = 0
+    tick = time.perf_counter()
+
+    async def _check(session, endpoint, job):
+        nonlocal finished
+        key, patient_summary, trial_summary = job
+        response = await llm_workers.chat(session, endpoint, build_messages(patient_summary, trial_summary), model=model)
+        checkpoint.append({'key': key, 'llama_response': response, 'eligibility_result': parse_result(response), \
+            'endpoint': endpoint})
+        finished += 1
+        if finished % progress_every == 0:
+            print(f"{finished}/{pending.shape[0]} checked, {finished / (time.perf_counter() - tick):.2f} pairs/s")
+
+    jobs = list(zip(pending['key'], pending['patient_summary'], pending[trial_column]))
+    with checkpoint:
+        failures = await llm_workers.run_pool(jobs, endpoints, _check, per_endpoint=per_endpoint)
+    if failures:
+        print(f"{failures} pairs failed, run again to retry them")
+    return merge_results(candidates, checkpoint, trial_column)
+
+
+def merge_results(candidates, checkpoint, trial_column='this_cohort'):
+    ''' candidates joined to the checked results, unchecked rows dropped '''
+    results = checkpoint.to_frame()
+    if results.shape[0] == 0:
+        return candidates.iloc[:0].assign(llama_response=None, eligibility_result=None)
+    keys = [pair_key(str(x), str(y)) for x, y in zip(candidates['patient_summary'], candidates[trial_column])]
+    merged = candidates.assign(key=keys).join(results[['llama_response', 'eligibility_result']], on='key')
+    return merged[~merged['eligibility_result'].isnull()].drop(columns='key')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--candidates', required=True, help='csv of patient_cohort_candidates')
+    parser.add_argument('--endpoints', nargs='+', required=True, help='OpenAI-compatible model servers')
+    parser.add_argument('--out', required=True, help='append-only JSON lines checkpoint')
+    parser.add_argument('--csv', help='also write the merged results here')
+    parser.add_argument('--trial-column', default='this_cohort')
+    parser.add_argument('--per-endpoint', type=int, default=2, help='requests in flight per server')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    candidates = pd.read_csv(args.candidates)
+    checks = asyncio.run(check_pairs(candidates, args.endpoints, args.out, args.trial_column, args.per_endpoint))
+    if args.csv:
+        checks.to_csv(args.csv)
+
+
+if __name__ == '__main__':
+    main()
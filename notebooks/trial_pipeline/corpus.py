@@ -0,0 +1,125 @@
+''' the EHR note corpus (imaging, clinical and pathology reports) indexed by
+patient (notebook 1). Notes are sorted by (dfci_mrn, date) and dates parsed
+once; each MRN maps to a contiguous row range, so "this patient's notes
+before the trial started" is a dict lookup plus a binary search instead of
+a scan of the whole corpus. '''
+# system
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+REPORT_FILES = ['all_imaging_reports.parquet', 'all_clinical_notes.parquet', 'all_path_reports.parquet']
+
+
+class NoteCorpus:
+
+    def __init__(self, reports):
+        reports = reports.copy()
+        reports['date'] = pd.to_datetime(reports['date'])
+        reports = reports.sort_values(by=['dfci_mrn', 'date'], kind='stable').reset_index(drop=True)
+        self._init(reports['dfci_mrn'].values, reports['date'].values.astype('datetime64[ns]'), \
+            reports['split'].values if 'split' in reports.columns else None, reports['text'].values)
+        self.reports = reports
+
+    def _init(self, mrns, dates, splits, texts):
+        self.mrns = mrns
+        self.dates = dates
+        self.splits = splits
+        self.texts = texts
+
+        # row range of each patient
+        unique_mrns, starts = np.unique(mrns, return_index=True)
+        ends = np.append(starts[1:], len(mrns))
+        self.ranges = {x: (int(s), int(e)) for x, s, e in zip(unique_mrns.tolist(), starts, ends)}
+
+    @classmethod
+    def load(cls, prefix, files=REPORT_FILES):
+        ''' reads and indexes the report parquet files under prefix '''
+        return cls(pd.concat([pd.read_parquet(os.path.join(prefix, x)) for x in files], axis=0))
+
+    def __len__(self):
+        return len(self.mrns)
+
+    def __contains__(self, mrn):
+        return mrn in self.ranges
+
+    def patient_rows(self, mrn, before=None):
+        ''' row range of a patient's notes, optionally only those dated
+        strictly before `before`; none when `before` is NaT '''
+        start, end = self.ranges.get(mrn, (0, 0))
+        if before is not None and pd.isna(before):
+            return start, start
+        if before is not None and end > start:
+            end = start + int(np.searchsorted(self.dates[start:end], np.datetime64(pd.Timestamp(before)), side='left'))
+        return start, end
+
+    def notes_before(self, mrn, before=None):
+        ''' frame of a patient's notes (text, date, ...) in date order '''
+        start, end = self.patient_rows(mrn, before)
+        if self.reports is not None:
+            return self.reports.iloc[start:end]
+        return pd.DataFrame({'dfci_mrn': self.mrns[start:end], 'date': self.dates[start:end], \
+            'split': self.splits[start:end] if self.splits is not None else None, \
+            'text': [self.texts[x] for x in range(start, end)]})
+
+    def split_of(self, mrn, before=None):
+        ''' the first non-null split of the patient's notes (dated before
+        `before`), in date order, as groupby().first() skips nulls '''
+        start, end = self.patient_rows(mrn, before)
+        if end == start or self.splits is None:
+            return None
+        present = np.flatnonzero(pd.notna(self.splits[start:end]))
+        return self.splits[start + present[0]] if present.shape[0] else None
+
+    def save(self, directory):
+        ''' columnar copy of the corpus; texts go in one utf-8 blob with
+        offsets so open() can memory map them '''
+        os.makedirs(directory, exist_ok=True)
+        encoded = [str(x).encode('utf-8') for x in self.texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        with open(os.path.join(directory, 'texts.bin'), 'wb') as f:
+            for x in encoded:
+                f.write(x)
+        np.save(os.path.join(directory, 'offsets.npy'), offsets)
+        np.save(os.path.join(directory, 'mrns.npy'), np.asarray(self.mrns))
+        np.save(os.path.join(directory, 'dates.npy'), self.dates.astype('datetime64[ns]'))
+        if self.splits is not None:
+            # nulls as empty strings, a str array needs no pickle
+            splits = pd.Series(self.splits, dtype=object)
+            np.save(os.path.join(directory, 'splits.npy'), splits.where(splits.notna(), '').to_numpy(dtype=str))
+        with open(os.path.join(directory, 'corpus.json'), 'w') as f:
+            json.dump({'notes': len(encoded), 'bytes': int(offsets[-1])}, f)
+
+    @classmethod
+    def open(cls, directory):
+        ''' a saved corpus with the texts memory mapped, decoded on access '''
+        corpus = cls.__new__(cls)
+        splits_path = os.path.join(directory, 'splits.npy')
+        splits = None
+        if os.path.exists(splits_path):
+            splits = np.load(splits_path).astype(object)
+            splits[splits == ''] = None
+        texts = MappedTexts(os.path.join(directory, 'texts.bin'), np.load(os.path.join(directory, 'offsets.npy')))
+        corpus._init(np.load(os.path.join(directory, 'mrns.npy'), allow_pickle=True), \
+            np.load(os.path.join(directory, 'dates.npy')), splits, texts)
+        corpus.reports = None
+        return corpus
+
+
+class MappedTexts:
+    ''' read-only sequence of strings over a memory mapped utf-8 blob '''
+
+    def __init__(self, path, offsets):
+        self.offsets = offsets
+        self.blob = np.memmap(path, dtype=np.uint8, mode='r') if offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
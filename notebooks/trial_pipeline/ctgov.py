@@ -0,0 +1,239 @@
+''' fetches study records from the ClinicalTrials.gov v2 api (notebook 0).
+A pooled aiohttp client asks for NCT ids in batches with bounded
+concurrency, backoff and page tokens. Raw study JSON is cached on disk
+under (nct_id, lastUpdatePostDate), so a refresh first lists the current
+update dates and then downloads only the studies that changed.
+
+    python -m trial_pipeline.ctgov --ids nct_ids.txt --cache ctgov_cache --out trials.csv
+'''
+# system
+import os
+import json
+import math
+import random
+import asyncio
+import logging
+import argparse
+import email.utils
+from datetime import datetime, timezone
+import aiohttp
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CTGOV_URL = 'https://clinicaltrials.gov/api/v2'
+MAX_RETRY_DELAY = 120.0
+
+# the app's catalog.load_trials reads these flattened protocolSection columns
+CATALOG_COLUMNS = ['identificationModule.briefTitle', 'statusModule.overallStatus', 'statusModule.startDateStruct.date', \
+    'identificationModule.officialTitle', 'descriptionModule.detailedDescription', 'descriptionModule.briefSummary', \
+    'eligibilityModule.eligibilityCriteria', 'statusModule.lastUpdatePostDateStruct.date']
+
+
+def retry_after_seconds(value, now=None):
+    ''' seconds asked for by a Retry-After header, in seconds or as an HTTP
+    date; None when missing or unreadable '''
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+        return max(seconds, 0.0) if math.isfinite(seconds) else None
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - (now or datetime.now(timezone.utc))).total_seconds(), 0.0)
+
+
+def nct_id_of(study):
+    return study['protocolSection']['identificationModule']['nctId']
+
+
+def last_update_of(study):
+    status = study.get('protocolSection', {}).get('statusModule', {})
+    return status.get('lastUpdatePostDateStruct', {}).get('date') or 'unknown'
+
+
+class StudyCache:
+    ''' raw study JSON on disk, one file per (nct_id, lastUpdatePostDate) '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, nct_id, last_update):
+        return os.path.join(self.directory, f'{nct_id}_{last_update}.json')
+
+    def get(self, nct_id, last_update):
+        path = self._path(nct_id, last_update)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def put(self, study):
+        path = self._path(nct_id_of(study), last_update_of(study))
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(study, f)
+        os.replace(tmp_path, path)
+
+    def latest(self):
+        ''' {nct_id: last update} of the newest cached version of each study '''
+        latest = dict()
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                nct_id, last_update = name[:-len('.json')].split('_', 1)
+                if last_update > latest.get(nct_id, ''):
+                    latest[nct_id] = last_update
+        return latest
+
+
+class CtgovClient:
+
+    def __init__(self, url=CTGOV_URL, concurrency=4, batch_size=50, page_size=100, retries=4, backoff=1.0, timeout=60, \
+        max_delay=MAX_RETRY_DELAY):
+        self.url = url.rstrip('/')
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency), \
+            timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    async def _get(self, params):
+        ''' one page of /studies, retrying rate limits and server errors '''
+        for attempt in range(self.retries + 1):
+            async with self._semaphore:
+                try:
+                    async with self._session.get(f'{self.url}/studies', params=params) as response:
+                        if response.status == 200:
+                            return await response.json()
+                        retry_after = response.headers.get('Retry-After')
+                        if response.status != 429 and response.status < 500:
+                            text = await response.text()
+                            raise aiohttp.ClientResponseError(response.request_info, response.history, \
+                                status=response.status, message=text[:200])
+                        error = f"status {response.status}"
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    retry_after = None
+                    error = repr(e)
+            if attempt == self.retries:
+                raise aiohttp.ClientError(f"ctgov request failed after {attempt + 1} attempts: {error}")
+            delay = retry_after_seconds(retry_after)
+            if delay is None:
+                delay = self.backoff * 2 ** attempt * (1 + random.random())
+            delay = min(delay, self.max_delay)
+            logger.info(f"ctgov {error}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _pages(self, params):
+        ''' every study of a query, following nextPageToken '''
+        params = dict(params, format='json', pageSize=self.page_size)
+        studies = []
+        while True:
+            data = await self._get(params)
+            studies.extend(data.get('studies', []))
+            token = data.get('nextPageToken')
+            if not token:
+                return studies
+            params['pageToken'] = token
+
+    async def _batched(self, nct_ids, **params):
+        batches = [nct_ids[i:i + self.batch_size] for i in range(0, len(nct_ids), self.batch_size)]
+        results = await asyncio.gather(*[self._pages(dict(params, **{'filter.ids': ','.join(x)})) for x in batches])
+        return [study for batch in results for study in batch]
+
+    async def last_updates(self, nct_ids):
+        ''' {nct_id: lastUpdatePostDate} for the ids, from a small listing '''
+        studies = await self._batched(nct_ids, fields='NCTId,LastUpdatePostDate')
+        return {nct_id_of(x): last_update_of(x) for x in studies}
+
+    async def studies(self, nct_ids):
+        ''' full study records for the ids '''
+        return await self._batched(nct_ids)
+
+
+async def fetch_studies(nct_ids, cache_dir='ctgov_cache', refresh=True, **client_args):
+    ''' current study JSON for every id ClinicalTrials.gov knows, downloading
+    only those not cached at their latest update. With refresh=False cached
+    studies are used without checking for updates. '''
+    nct_ids = sorted(set(str(x) for x in nct_ids))
+    cache = StudyCache(cache_dir)
+    cached = cache.latest()
+
+    async with CtgovClient(**client_args) as client:
+        if refresh:
+            current = await client.last_updates(nct_ids)
+        else:
+            current = {x: cached[x] for x in nct_ids if x in cached}
+            current.update(await client.last_updates([x for x in nct_ids if x not in cached]))
+
+        changed = [x for x, y in current.items() if cached.get(x) != y]
+        logger.info(f"{len(current)} of {len(nct_ids)} studies found, {len(changed)} new or updated")
+        for study in await client.studies(changed):
+            cache.put(study)
+
+    studies = [cache.get(x, y) for x, y in current.items()]
+    return [x for x in studies if x is not None]
+
+
+def catalog_frame(studies):
+    ''' protocolSection flattened into dotted module columns, indexed by
+    nct_id, as catalog.load_trials expects (trial_summary comes later from
+    notebook 2) '''
+    df = pd.json_normalize([x['protocolSection'] for x in studies])
+    df.index = pd.Index([nct_id_of(x) for x in studies], name='nct_id')
+    for column in CATALOG_COLUMNS:
+        if column not in df.columns:
+            df[column] = None
+    return df
+
+
+def notebook_frame(studies):
+    ''' the columns notebook 0 builds for each trial '''
+    df = catalog_frame(studies)
+    columns = {'identificationModule.officialTitle': 'title', 'descriptionModule.briefSummary': 'brief_summary', \
+        'oversightModule.isFdaRegulatedDrug': 'is_drug', 'descriptionModule.detailedDescription': 'detailed_summary', \
+        'eligibilityModule.eligibilityCriteria': 'eligibility_criteria'}
+    out = pd.DataFrame({'nct_id': df.index}, index=df.index)
+    for column, name in columns.items():
+        out[name] = df[column].fillna('').astype(str) if column in df.columns else ''
+    return out.reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ids', required=True, help='file of NCT ids, one per line')
+    parser.add_argument('--cache', default='ctgov_cache')
+    parser.add_argument('--out', required=True, help='csv of flattened studies')
+    parser.add_argument('--url', default=CTGOV_URL)
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.ids) as f:
+        nct_ids = [x.strip() for x in f if x.strip()]
+    studies = asyncio.run(fetch_studies(nct_ids, args.cache, url=args.url, concurrency=args.concurrency))
+    catalog_frame(studies).to_csv(args.out)
+    print(f"wrote {len(studies)} studies to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+''' persistent store of EHR chunk embeddings (notebook 1), keyed by a hash
+of (model id, chunk text). Embeddings live in one append-only float16
+matrix that is memory mapped for reads, next to an append-only file of
+16 byte keys, so re-running summarization only encodes chunks it has never
+seen. '''
+# system
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+KEY_BYTES = 16
+
+
+def _size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class EmbeddingCache:
+
+    def __init__(self, directory, model_id, dtype='float16'):
+        self.directory = directory
+        self.model_id = model_id
+        self.dtype = np.dtype(dtype)
+        os.makedirs(directory, exist_ok=True)
+        self._matrix_path = os.path.join(directory, 'embeddings.bin')
+        self._keys_path = os.path.join(directory, 'keys.bin')
+        self._meta_path = os.path.join(directory, 'meta.json')
+
+        # one model per directory, the dimension is fixed by the first write
+        self.dim = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            if meta['model_id'] != model_id or meta['dtype'] != self.dtype.name:
+                raise ValueError(f"{directory} holds {meta['model_id']} ({meta['dtype']}) embeddings")
+            self.dim = meta['dim']
+        self._load()
+
+    def _load(self):
+        ''' maps the matrix and rebuilds the key index, dropping any rows
+        half written by an interrupted run '''
+        self.index = dict()
+        self.matrix = None
+        if self.dim is None:
+            return
+
+        row_bytes = self.dim * self.dtype.itemsize
+        rows = min(_size(self._keys_path) // KEY_BYTES, _size(self._matrix_path) // row_bytes)
+        for path, size in [(self._keys_path, rows * KEY_BYTES), (self._matrix_path, rows * row_bytes)]:
+            if _size(path) != size:
+                logger.warning(f"truncating partial write in {path}")
+                os.truncate(path, size)
+
+        with open(self._keys_path, 'rb') as f:
+            keys = f.read()
+        self.index = {keys[i * KEY_BYTES:(i + 1) * KEY_BYTES]: i for i in range(rows)}
+        self._remap()
+
+    def _remap(self):
+        if len(self.index) > 0:
+            self.matrix = np.memmap(self._matrix_path, dtype=self.dtype, mode='r', shape=(len(self.index), self.dim))
+
+    def __len__(self):
+        return len(self.index)
+
+    def key(self, text):
+        return hashlib.blake2b(f'{self.model_id}\x00{text}'.encode('utf-8'), digest_size=KEY_BYTES).digest()
+
+    def _append(self, keys, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.dtype)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+            with open(self._meta_path, 'w') as f:
+                json.dump({'model_id': self.model_id, 'dim': self.dim, 'dtype': self.dtype.name}, f)
+
+        # matrix first, a key never points past the data
+        with open(self._matrix_path, 'ab') as f:
+            f.write(embeddings.tobytes())
+        with open(self._keys_path, 'ab') as f:
+            f.write(b''.join(keys))
+        for k in keys:
+            self.index[k] = len(self.index)
+
+    def encode(self, texts, embedding_model, batch_size=4096, **encode_kwargs):
+        ''' float32 embeddings of texts, encoding only unseen ones. New texts
+        are sorted by length so each encoder batch pads little, and are
+        written out every `batch_size` texts. '''
+        keys = [self.key(x) for x in texts]
+
+        # unseen texts, once each
+        missing = dict()
+        for k, text in zip(keys, texts):
+            if k not in self.index and k not in missing:
+                missing[k] = text
+
+        if missing:
+            pending = sorted(missing.items(), key=lambda x: len(x[1]))
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                embeddings = embedding_model.encode([x[1] for x in batch], **encode_kwargs)
+                self._append([x[0] for x in batch], embeddings)
+            self._remap()
+            logger.info(f"encoded {len(missing)} of {len(texts)} chunks, {len(self)} cached")
+
+        if self.matrix is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        rows = np.fromiter((self.index[k] for k in keys), dtype=np.int64, count=len(keys))
+        return np.asarray(self.matrix[rows], dtype=np.float32)
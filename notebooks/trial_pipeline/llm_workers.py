@@ -0,0 +1,61 @@
+''' fan out chat completions over several llama.cpp / OpenAI-compatible
+servers, e.g. one `python -m llama_cpp.server` per GPU. Each server gets
+its own bounded number of requests in flight, so throughput scales with
+the number of servers. '''
+# system
+import random
+import asyncio
+import logging
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+async def chat(session, endpoint, messages, model=None, max_tokens=1024, temperature=0.01, retries=3, backoff=1.0):
+    ''' text of one chat completion, retrying transient failures '''
+    payload = {'messages': messages, 'max_tokens': max_tokens, 'temperature': temperature}
+    if model:
+        payload['model'] = model
+    for attempt in range(retries + 1):
+        try:
+            async with session.post(f"{endpoint.rstrip('/')}/v1/chat/completions", json=payload) as response:
+                if response.status != 200:
+                    text = await response.text()
+                    raise aiohttp.ClientResponseError(response.request_info, response.history, \
+                        status=response.status, message=text[:200])
+                data = await response.json()
+                return data['choices'][0]['message']['content']
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status = getattr(e, 'status', None)
+            if attempt == retries or (status is not None and status < 500 and status != 429):
+                raise
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            logger.info(f"{endpoint} failed ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def run_pool(jobs, endpoints, handle, per_endpoint=2, timeout=600):
+    ''' calls `await handle(session, endpoint, job)` for every job, with
+    `per_endpoint` workers pulling from a shared queue for each endpoint.
+    Failed jobs are logged and skipped; returns the number that failed. '''
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    failures = 0
+
+    async def _worker(session, endpoint):
+        nonlocal failures
+        while True:
+            try:
+                job = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await handle(session, endpoint, job)
+            except Exception as e:
+                failures += 1
+                logger.error(f"{endpoint} gave up on a job: {e!r}")
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        await asyncio.gather(*[_worker(session, x) for x in endpoints for _ in range(per_endpoint)])
+    return failures
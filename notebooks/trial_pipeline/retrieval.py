@@ -0,0 +1,74 @@
+''' RAG retrieval over a patient's EHR chunks for summarization (notebook 1).
+The questions never change, so they are embedded once per model; a patient
+is then one matrix product of the questions against their unit length
+chunk embeddings, with argpartition picking each question's top chunks. '''
+# system
+import weakref
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+QUESTIONS = ["cancer types",
+             "cancer stage or extent",
+             "biomarkers, mutations, protein expression",
+             "cancer treatments, such as surgery, chemotherapy, targeted therapy, immunotherapy, radiation, or transplant?",
+             "major toxicities, adverse events, or side effects"]
+
+# question embeddings per model, then per questions; an entry goes with its
+# model, so a new model reusing a freed model's id() cannot see its vectors
+_question_cache = weakref.WeakKeyDictionary()
+
+
+def normalize(embeddings):
+    ''' float32 copy with unit length rows '''
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def top_k(scores, k):
+    ''' column positions of the k best scores in each row, best first '''
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1)
+
+
+def question_embeddings(embedding_model, questions=QUESTIONS):
+    ''' unit length query embeddings, encoded once per model '''
+    cached = _question_cache.setdefault(embedding_model, dict())
+    key = tuple(questions)
+    if key not in cached:
+        cached[key] = normalize(embedding_model.encode(list(questions), prompt_name="query"))
+    return cached[key]
+
+
+def retrieve(patient_sentences, patient_dates, patient_embeddings, embedding_model, k=8, questions=QUESTIONS):
+    ''' the k chunks most similar to each question, as a frame of question,
+    sentences and dates in chronological order '''
+    sentences = pd.Index(np.asarray(patient_sentences, dtype=object))
+    if sentences.shape[0] == 0:
+        return pd.DataFrame({'question': [], 'sentences': [], 'dates': pd.to_datetime([])})
+
+    # drop repeated chunks, e.g. notes copied forward
+    keep = np.flatnonzero(~sentences.duplicated())
+    chunk_embeddings = normalize(np.asarray(patient_embeddings)[keep])
+
+    # every question against every chunk at once
+    scores = question_embeddings(embedding_model, questions) @ chunk_embeddings.T
+    best = keep[top_k(scores, k)]
+
+    frame = pd.DataFrame({
+        'question': np.repeat(np.asarray(questions, dtype=object), best.shape[1]),
+        'sentences': sentences.values[best.ravel()],
+        'dates': pd.to_datetime(np.asarray(patient_dates)[best.ravel()]),
+    })
+    frame['sentences'] = frame.sentences.str.replace("search_document: ", "", regex=False)
+    return frame.sort_values(by='dates', kind='stable')
+
+
+def excerpt(frame):
+    ''' the retrieved chunks as one chronological excerpt '''
+    return "\n".join(frame.sentences)
@@ -0,0 +1,80 @@
+# system
+import os
+import json
+import hashlib
+import logging
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(*parts):
+    ''' stable hash of text parts, used to key pipeline results '''
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\x00')
+    return h.hexdigest()
+
+
+class JsonlStore:
+    ''' append-only JSON lines checkpoint. Every record carries a `key`;
+    a crash loses at most the line being written, and reopening the file
+    resumes from whatever keys are already present. '''
+
+    def __init__(self, path, fsync_every=50):
+        self.path = path
+        self.fsync_every = fsync_every
+        self._unsynced = 0
+        self._file = None
+
+    def records(self):
+        ''' every complete record written so far '''
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # torn final line from an interrupted run
+                    logger.warning(f"skipping partial record in {self.path}")
+
+    def keys(self):
+        return {x['key'] for x in self.records()}
+
+    def to_frame(self):
+        ''' latest record per key '''
+        df = pd.DataFrame(list(self.records()))
+        if df.shape[0] == 0:
+            return df
+        return df.drop_duplicates('key', keep='last').set_index('key')
+
+    def append(self, record):
+        if self._file is None:
+            self._file = open(self.path, 'a+', encoding='utf-8')
+
+            # start on a fresh line after a torn write
+            if self._file.tell() > 0:
+                self._file.seek(self._file.tell() - 1)
+                if self._file.read(1) != '\n':
+                    self._file.write('\n')
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,89 @@
+''' offline stand-in for the ClinicalTrials.gov v2 /studies endpoint, for
+exercising ctgov.py: filter.ids, fields, pageSize/pageToken, plus optional
+latency, a rate of injected 429/503 responses and scripted failures.
+
+    python -m trial_pipeline.stub_ctgov_server --port 8010 --studies 5000
+    python -m trial_pipeline.ctgov --url http://localhost:8010/api/v2 --ids ids.txt --out trials.csv
+'''
+# system
+import random
+import asyncio
+import argparse
+from aiohttp import web
+
+
+def make_study(i, last_update='2024-01-01'):
+    nct_id = f'NCT{i:08d}'
+    return {'protocolSection': {
+        'identificationModule': {'nctId': nct_id, 'orgStudyIdInfo': {'id': f'{i % 100:02d}-{i:03d}'}, \
+            'briefTitle': f'Study {i}', 'officialTitle': f'A phase {i % 3 + 1} study of drug {i}'},
+        'statusModule': {'overallStatus': 'RECRUITING', 'startDateStruct': {'date': '2023-05'}, \
+            'lastUpdatePostDateStruct': {'date': last_update}},
+        'descriptionModule': {'briefSummary': f'Brief summary {i}', 'detailedDescription': f'Details {i}'},
+        'oversightModule': {'isFdaRegulatedDrug': bool(i % 2)},
+        'eligibilityModule': {'eligibilityCriteria': f'Inclusion: cancer type {i % 7}'},
+    }}
+
+
+# fields= names mapped to their protocolSection paths
+_FIELDS = {'NCTId': ('identificationModule', 'nctId'), \
+    'LastUpdatePostDate': ('statusModule', 'lastUpdatePostDateStruct')}
+
+
+def _select(study, fields):
+    out = dict()
+    for field in fields:
+        module, key = _FIELDS[field]
+        out.setdefault(module, dict())[key] = study['protocolSection'][module][key]
+    return {'protocolSection': out}
+
+
+def create_app(studies, latency=0.0, error_rate=0.0, failures=()):
+    ''' serves `studies`, a dict of nct_id -> study json; requests are
+    counted in app['requests'] and their query strings kept in
+    app['queries']. `failures`, (status, headers) pairs, answer the first
+    requests in order. '''
+    failures = list(failures)
+
+    async def list_studies(request):
+        request.app['requests'] += 1
+        request.app['queries'].append(dict(request.query))
+        await asyncio.sleep(latency)
+        if failures:
+            status, headers = failures.pop(0)
+            return web.Response(status=status, headers=headers)
+        if random.random() < error_rate:
+            return web.Response(status=random.choice([429, 503]), headers={'Retry-After': '0'})
+
+        ids = request.query.get('filter.ids')
+        found = [studies[x] for x in ids.split(',') if x in studies] if ids else list(studies.values())
+        if request.query.get('fields'):
+            found = [_select(x, request.query['fields'].split(',')) for x in found]
+
+        size = int(request.query.get('pageSize', 10))
+        start = int(request.query.get('pageToken', 0))
+        body = {'studies': found[start:start + size]}
+        if start + size < len(found):
+            body['nextPageToken'] = str(start + size)
+        return web.json_response(body)
+
+    app = web.Application()
+    app['requests'] = 0
+    app['queries'] = []
+    app.router.add_get('/api/v2/studies', list_studies)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--studies', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    studies = {f'NCT{i:08d}': make_study(i) for i in range(args.studies)}
+    web.run_app(create_app(studies, args.latency, args.error_rate), port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# system
+import numpy as np
+import pytest
+
+# app
+from trial_pipeline import chunking
+
+
+def _dedupe(chunks):
+    ''' the old split_text could emit its tail chunk twice '''
+    return [x for i, x in enumerate(chunks) if i == 0 or x != chunks[i - 1]]
+
+
+def _text(n_words, seed=0):
+    rng = np.random.default_rng(seed)
+    words = [''.join(rng.choice(list('abcdé'), rng.integers(1, 8))) for _ in range(n_words)]
+    spaces = rng.choice([' ', '  ', '\n', '\t', ' 　'], n_words)
+    return ''.join(f'{x}{y}' for x, y in zip(words, spaces))
+
+
+@pytest.mark.parametrize('chunk_size, overlap', [(100, 10), (10, 3), (5, 4), (7, 0)])
+@pytest.mark.parametrize('n_words', [0, 1, 6, 7, 99, 100, 101, 259, 1000, 1001])
+def test_chunks_match_the_notebook_split(n_words, chunk_size, overlap):
+    text = _text(n_words, seed=n_words)
+    expected = _dedupe(chunking._split_text_words(text, chunk_size, overlap))
+    chunks = list(chunking.chunks(text, chunk_size, overlap))
+    assert [x.split() for x in chunks] == [x.split() for x in expected]
+
+
+def test_chunks_are_slices_of_the_text():
+    text = '  leading\tspace and\n\nblank lines  '
+    assert chunking.split_text(text, 2, 1) == ['leading\tspace', 'space and', 'and\n\nblank', 'blank lines']
+
+
+def test_blocks_do_not_cut_words():
+    text = _text(5000, seed=1)
+    starts, ends = map(np.concatenate, zip(*chunking._words(text, block=97)))
+    assert [text[x:y] for x, y in zip(starts, ends)] == text.split()
@@ -0,0 +1,38 @@
+# system
+import pandas as pd
+
+# app
+from trial_pipeline import corpus
+
+
+def reports():
+    return pd.DataFrame({
+        'dfci_mrn': [2, 1, 1, 1, 3],
+        'date': ['2020-01-05', '2020-03-01', '2020-01-01', '2020-02-01', '2020-01-01'],
+        'split': ['test', 'train', None, 'valid', None],
+        'text': ['e', 'c', 'a', 'b', 'f'],
+    })
+
+
+def test_split_of_skips_missing_splits(tmp_path):
+    notes = corpus.NoteCorpus(reports())
+    assert notes.split_of(1) == 'valid'
+    assert notes.split_of(1, pd.Timestamp('2020-01-15')) is None
+    assert notes.split_of(1, pd.Timestamp('2020-02-15')) == 'valid'
+    assert notes.split_of(2) == 'test'
+    assert notes.split_of(3) is None
+    assert notes.split_of(4) is None
+
+    notes.save(str(tmp_path))
+    opened = corpus.NoteCorpus.open(str(tmp_path))
+    assert [opened.split_of(x) for x in [1, 2, 3]] == ['valid', 'test', None]
+
+
+def test_notes_before(tmp_path):
+    notes = corpus.NoteCorpus(reports())
+    assert notes.notes_before(1, pd.Timestamp('2020-02-15'))['text'].tolist() == ['a', 'b']
+    assert notes.notes_before(1, pd.NaT).shape[0] == 0
+
+    notes.save(str(tmp_path))
+    opened = corpus.NoteCorpus.open(str(tmp_path))
+    assert opened.notes_before(1)['text'].tolist() == ['a', 'b', 'c']
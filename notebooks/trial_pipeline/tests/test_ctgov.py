@@ -0,0 +1,19 @@
+# system
+from datetime import datetime, timezone
+
+# app
+from trial_pipeline import ctgov
+
+
+def test_retry_after_seconds():
+    assert ctgov.retry_after_seconds('7') == 7.0
+    assert ctgov.retry_after_seconds('1.5') == 1.5
+    assert ctgov.retry_after_seconds('-3') == 0.0
+    for value in [None, '', 'soon', 'nan', 'inf']:
+        assert ctgov.retry_after_seconds(value) is None
+
+
+def test_retry_after_http_date():
+    now = datetime(2024, 3, 1, 12, 0, 0, tzinfo=timezone.utc)
+    assert ctgov.retry_after_seconds('Fri, 01 Mar 2024 12:00:30 GMT', now=now) == 30.0
+    assert ctgov.retry_after_seconds('Fri, 01 Mar 2024 11:59:00 GMT', now=now) == 0.0
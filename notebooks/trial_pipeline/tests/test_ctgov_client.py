@@ -0,0 +1,131 @@
+# system
+import asyncio
+import email.utils
+from datetime import datetime, timedelta, timezone
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestServer
+
+# app
+from trial_pipeline import ctgov
+from trial_pipeline import stub_ctgov_server
+
+
+def serve(app, fn):
+    ''' runs fn(api url) against the app on a local port '''
+    async def _run():
+        async with TestServer(app) as server:
+            return await fn(str(server.make_url('/api/v2')))
+    return asyncio.run(_run())
+
+
+def fetch(app, nct_ids, **client_args):
+    async def _fetch(url):
+        async with ctgov.CtgovClient(url, **client_args) as client:
+            return await client.studies(nct_ids)
+    return serve(app, _fetch)
+
+
+@pytest.fixture
+def studies():
+    return {x['protocolSection']['identificationModule']['nctId']: x \
+        for x in map(stub_ctgov_server.make_study, range(25))}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    ''' retry delays asked for, without waiting for them; aiohttp and the
+    stub yield with sleep(0), which is not a delay '''
+    delays = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay, *args):
+        if delay > 0:
+            delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(ctgov.asyncio, 'sleep', fake_sleep)
+    return delays
+
+
+def test_follows_next_page_token(studies):
+    app = stub_ctgov_server.create_app(studies)
+    found = fetch(app, list(studies), page_size=10)
+    assert sorted(ctgov.nct_id_of(x) for x in found) == sorted(studies)
+    assert app['requests'] == 3
+    assert [x.get('pageToken') for x in app['queries']] == [None, '10', '20']
+
+
+def test_batches_ids(studies):
+    app = stub_ctgov_server.create_app(studies)
+    found = fetch(app, list(studies), batch_size=10, page_size=100)
+    assert len(found) == 25
+    assert app['requests'] == 3
+
+
+def test_429_waits_retry_after_seconds(studies, sleeps):
+    app = stub_ctgov_server.create_app(studies, failures=[(429, {'Retry-After': '3'}), (503, {'Retry-After': '1'})])
+    assert len(fetch(app, ['NCT00000001'], backoff=100)) == 1
+    assert sleeps == [3.0, 1.0]
+    assert app['requests'] == 3
+
+
+def test_429_waits_until_retry_after_date(studies, sleeps):
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    app = stub_ctgov_server.create_app(studies, failures=[(429, {'Retry-After': email.utils.format_datetime(when, usegmt=True)})])
+    assert len(fetch(app, ['NCT00000001'])) == 1
+    assert len(sleeps) == 1 and 25 <= sleeps[0] <= 30
+
+
+def test_retry_after_is_capped(studies, sleeps):
+    app = stub_ctgov_server.create_app(studies, failures=[(429, {'Retry-After': '3600'})])
+    assert len(fetch(app, ['NCT00000001'], max_delay=5)) == 1
+    assert sleeps == [5]
+
+
+def test_backs_off_without_retry_after(studies, sleeps, monkeypatch):
+    monkeypatch.setattr(ctgov.random, 'random', lambda: 0.0)
+    app = stub_ctgov_server.create_app(studies, failures=[(503, {}), (500, {})])
+    assert len(fetch(app, ['NCT00000001'], backoff=0.5)) == 1
+    assert sleeps == [0.5, 1.0]
+
+
+def test_gives_up_after_retries(studies, sleeps):
+    app = stub_ctgov_server.create_app(studies, failures=[(503, {})] * 3)
+    with pytest.raises(aiohttp.ClientError, match='3 attempts'):
+        fetch(app, ['NCT00000001'], retries=2)
+    assert app['requests'] == 3
+
+
+def test_client_errors_are_not_retried(studies, sleeps):
+    app = stub_ctgov_server.create_app(studies, failures=[(404, {})])
+    with pytest.raises(aiohttp.ClientResponseError) as error:
+        fetch(app, ['NCT00000001'])
+    assert error.value.status == 404
+    assert app['requests'] == 1
+    assert sleeps == []
+
+
+def test_refresh_downloads_only_updated_studies(studies, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    ids = list(studies)[:5]
+
+    def _fetch(app, **args):
+        return serve(app, lambda url: ctgov.fetch_studies(ids, cache_dir, url=url, **args))
+
+    app = stub_ctgov_server.create_app(studies)
+    assert len(_fetch(app)) == 5
+
+    # one study updated upstream
+    studies[ids[2]] = stub_ctgov_server.make_study(2, last_update='2024-06-01')
+    app = stub_ctgov_server.create_app(studies)
+    found = _fetch(app)
+    assert [ctgov.last_update_of(x) for x in found if ctgov.nct_id_of(x) == ids[2]] == ['2024-06-01']
+    downloads = [x['filter.ids'] for x in app['queries'] if 'fields' not in x]
+    assert downloads == [ids[2]]
+    assert ctgov.StudyCache(cache_dir).latest()[ids[2]] == '2024-06-01'
+
+    # without refresh cached studies are used as they are
+    app = stub_ctgov_server.create_app(studies)
+    assert len(_fetch(app, refresh=False)) == 5
+    assert [x for x in app['queries'] if 'fields' not in x] == []
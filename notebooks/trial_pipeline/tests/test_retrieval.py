@@ -0,0 +1,56 @@
+# system
+import gc
+import numpy as np
+
+# app
+from trial_pipeline import retrieval
+
+
+class FakeModel:
+    ''' encodes each text as a fixed random vector, counting calls '''
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.calls = 0
+
+    def encode(self, texts, prompt_name=None):
+        self.calls += 1
+        rng = np.random.default_rng([self.seed, len(texts)])
+        return rng.normal(size=(len(texts), 8))
+
+
+def test_questions_are_encoded_once_per_model():
+    model = FakeModel(0)
+    first = retrieval.question_embeddings(model)
+    assert retrieval.question_embeddings(model) is first
+    assert model.calls == 1
+    np.testing.assert_allclose(np.linalg.norm(first, axis=1), 1, rtol=1e-6)
+
+    retrieval.question_embeddings(model, ['another question'])
+    assert model.calls == 2
+
+
+def test_a_new_model_never_sees_a_freed_models_vectors():
+    for seed in range(20):
+        model = FakeModel(seed)
+        expected = retrieval.normalize(FakeModel(seed).encode(retrieval.QUESTIONS))
+        np.testing.assert_array_equal(retrieval.question_embeddings(model), expected)
+        del model
+        gc.collect()
+    assert len(retrieval._question_cache) == 0
+
+
+def test_retrieve_top_chunks_in_date_order():
+    model = FakeModel(1)
+    questions = retrieval.question_embeddings(model)
+    sentences = ['search_document: a', 'b', 'c', 'b']
+    embeddings = np.stack([questions[0], questions[1], -questions[0], questions[1]])
+    dates = ['2020-03-01', '2020-01-01', '2020-02-01', '2020-04-01']
+    frame = retrieval.retrieve(sentences, dates, embeddings, model, k=1)
+    best = frame.set_index('question')
+    assert best.loc[retrieval.QUESTIONS[0], 'sentences'] == 'a'
+
+    # the repeated chunk is kept once, at its first date
+    assert best.loc[retrieval.QUESTIONS[1], 'sentences'] == 'b'
+    assert best.loc[retrieval.QUESTIONS[1], 'dates'] == np.datetime64('2020-01-01')
+    assert frame.dates.is_monotonic_increasing
@@ -0,0 +1,38 @@
+# system
+import json
+
+# app
+from trial_pipeline import store
+
+
+def test_content_key_is_stable_and_unambiguous():
+    assert store.content_key('a', 'b') == store.content_key('a', 'b')
+    assert store.content_key('ab', 'c') != store.content_key('a', 'bc')
+
+
+def test_resume_after_a_torn_write(tmp_path):
+    path = str(tmp_path / 'checks.jsonl')
+    with store.JsonlStore(path) as out:
+        out.append({'key': 'a', 'verdict': True})
+        out.append({'key': 'b', 'verdict': False})
+
+    # killed half way through the next record
+    with open(path, 'a', encoding='utf-8') as fout:
+        fout.write(json.dumps({'key': 'c', 'verdict': True})[:10])
+
+    resumed = store.JsonlStore(path)
+    assert resumed.keys() == {'a', 'b'}
+    with resumed:
+        resumed.append({'key': 'c', 'verdict': True})
+        resumed.append({'key': 'a', 'verdict': False})
+
+    df = store.JsonlStore(path).to_frame()
+    assert sorted(df.index) == ['a', 'b', 'c']
+    assert df.loc['a', 'verdict'] == False
+    assert store.JsonlStore(path).keys() == {'a', 'b', 'c'}
+
+
+def test_missing_file_is_empty(tmp_path):
+    checkpoint = store.JsonlStore(str(tmp_path / 'none.jsonl'))
+    assert checkpoint.keys() == set()
+    assert checkpoint.to_frame().shape[0] == 0
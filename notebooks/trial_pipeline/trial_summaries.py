@@ -0,0 +1,120 @@
+''' llama generated cohort lists for each trial (notebook 2). Summaries are
+keyed by a hash of the trial text and prompt version and kept in an
+append-only JSON lines store, so a refresh only summarizes trials whose
+text or prompt changed; those are spread over every model server given.
+
+    python -m trial_pipeline.trial_summaries --trials trials.csv \
+        --endpoints http://gpu0:8000 http://gpu1:8000 --out trial_cohorts.jsonl --cohorts trial_cohort_lineitems.csv
+'''
+# system
+import time
+import asyncio
+import logging
+import argparse
+import pandas as pd
+
+# pipeline
+from . import store
+from . import llm_workers
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = """You are an expert clinical oncologist with an encyclopedic knowledge of cancer and its treatments.
+    Your job is to review a clinical trial document and generate a concise summary of the objectives of the trial and its target cohort(s).
+    A cohort is defined as a unique combination of cancer type, tumor biomarkers (such as germline or somatic gene mutations or alterations, or protein expression on tumor), which treatments a patient has received, and presence of metastatic disease.
+    Some trials have only one cohort, while others have several. Generate a numbered list of such cohorts, where each cohort is described in one concise sentence. Cohorts should be separated by newlines.
+    When describing prior treatments, if a drug name is mentioned in the trial criteria, add the drug class in parentheses in your cohort definition.
+    Output should be formatted like this example:
+    1. Metastatic non-small cell lung cancer, EGFR L858R mutant, previously treated with osimertinib (third-generation EGFR TKI), no prior immunotherapy.
+    2. Metastatic solid tumors, no available standard therapies, prior immunotherapy required
+    """
+
+USER_PROMPT = """Now, generate your list of the trial cohort(s), formatted as above.
+        Do not provide any introductory, explanatory, concluding, or disclaimer text."""
+
+# summaries from a different prompt are regenerated
+PROMPT_VERSION = store.content_key(SYSTEM_PROMPT, USER_PROMPT)[:12]
+
+
+def build_messages(eligibility_text):
+    return [{'role': 'system', 'content': SYSTEM_PROMPT}, \
+        {'role': 'user', 'content': "Here is a clinical trial document: \n" + eligibility_text + "\n" + USER_PROMPT}]
+
+
+def summarize_trial_multi_cohort(eligibility_text, llama_model):
+    ''' summarizes one trial with an in-process llama_cpp model '''
+    response = llama_model.create_chat_completion(messages=build_messages(eligibility_text))
+    return response, response['choices'][0]['message']['content']
+
+
+def summary_key(trial_text):
+    return store.content_key(PROMPT_VERSION, trial_text)
+
+
+async def summarize_trials(trials, endpoints, out_path, text_column='trial_text', per_endpoint=2, model=None, \
+    progress_every=50):
+    ''' cohort lists for every trial, generating only those whose text (or
+    the prompt) has no summary in `out_path` yet. Returns the trials with a
+    cohorts column; trials that failed are left out until the next run. '''
+    checkpoint = store.JsonlStore(out_path)
+    texts = trials[text_column].astype(str)
+    keys = [summary_key(x) for x in texts]
+    done = checkpoint.keys()
+    pending = {k: x for k, x in zip(keys, texts) if k not in done}
+    print(f"{len(set(keys))} distinct trial texts, {len(pending)} to summarize on {len(endpoints)} endpoints")
+
+    finished = 0
+    tick = time.perf_counter()
+
+    async def _summarize(session, endpoint, job):
+        nonlocal finished
+        key, trial_text = job
+        cohorts = await llm_workers.chat(session, endpoint, build_messages(trial_text), model=model)
+        checkpoint.append({'key': key, 'cohorts': cohorts})
+        finished += 1
+        if finished % progress_every == 0:
+            print(f"{finished}/{len(pending)} summarized, {finished / (time.perf_counter() - tick):.2f} trials/s")
+
+    with checkpoint:
+        failures = await llm_workers.run_pool(list(pending.items()), endpoints, _summarize, per_endpoint=per_endpoint)
+    if failures:
+        print(f"{failures} trials failed, run again to retry them")
+
+    results = checkpoint.to_frame()
+    if results.shape[0] == 0:
+        return trials.iloc[:0].assign(cohorts=None)
+    output = trials.assign(cohorts=pd.Series(keys, index=trials.index).map(results['cohorts']))
+    return output[~output.cohorts.isnull()]
+
+
+def explode_cohorts(output):
+    ''' one row per non-empty line of each trial's cohorts, numbered from
+    zero within the trial '''
+    output = output[~output.cohorts.isnull()].reset_index(drop=True)
+    exploded = output.assign(this_cohort=output.cohorts.astype(str).str.split("\n")).explode('this_cohort')
+    exploded = exploded[~(exploded.this_cohort.isnull() | (exploded.this_cohort == ''))]
+    exploded['cohort_number'] = exploded.groupby(level=0).cumcount()
+    return exploded.reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', required=True, help='csv with a trial_text column, one row per trial')
+    parser.add_argument('--endpoints', nargs='+', required=True, help='OpenAI-compatible model servers')
+    parser.add_argument('--out', required=True, help='append-only JSON lines store of summaries')
+    parser.add_argument('--csv', help='write the trials with their cohorts here')
+    parser.add_argument('--cohorts', help='write one row per cohort here')
+    parser.add_argument('--per-endpoint', type=int, default=2, help='requests in flight per server')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    trials = pd.read_csv(args.trials)
+    output = asyncio.run(summarize_trials(trials, args.endpoints, args.out, per_endpoint=args.per_endpoint))
+    if args.csv:
+        output.to_csv(args.csv)
+    if args.cohorts:
+        explode_cohorts(output).to_csv(args.cohorts)
+
+
+if __name__ == '__main__':
+    main()